@@ -1,5 +1,8 @@
 from ._logger import *
 from .kymFlowFile import kymFlowFile
 from .kymFlowRadon import batchAnalyzeFolder
+from .kymFlowRadon import kymFlowExecutor
+from .kymFlowStream import kymFlowStream
+from .kymFlowEngines import kymFlowEngine, registerEngine
 
 from .kymPlots import showScatterPlots
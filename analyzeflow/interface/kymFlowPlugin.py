@@ -59,7 +59,9 @@ class kymFlowWidget(QtWidgets.QMainWindow):
 
     def doVelocityAnalysis(self):
         # todo, add interface with (window, start, stop)
-        self._kymFlow.analyzeFlowWithRadon(windowSize = 16, startPixel=None, stopPixel=None)
+        # threads, forking a Qt process is fragile
+        self._kymFlow.analyzeFlowWithRadon(windowSize = 16, startPixel=None, stopPixel=None,
+                                            backend='thread')
         
         # update interface
         self.refreshVelocityPlot()
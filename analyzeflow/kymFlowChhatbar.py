@@ -0,0 +1,385 @@
+"""
+Hybrid image filtering and iterative Radon transform, Chhatbar and Kara (2013).
+
+Port of matlab/bChhatbar0.m (hybridvel). Each image segment of hi lines is
+filtered with a 3x3 vertical Sobel and its streak angle is found with an
+iterative Radon transform whose step is halved until the angle resolves the
+velocity to dv/v (Eq. 11-17 of the paper).
+
+All segments are iterated together, each iteration is one batched projection
+of the segments that are not done yet (no per segment radon()). The
+projection is the one of MATLAB radon() (pixels split in 4, linear binning)
+so that, as in bChhatbar0.m, empty bins are exactly 0 and are excluded from
+the variance.
+
+Segments can be spread over a kymFlowExecutor, same as mpAnalyzeFlow().
+
+See: Chhatbar PY, Kara P (2013) Improved blood velocity measurements with a
+    hybrid image filtering and iterative Radon transform algorithm.
+    Front Neurosci 7:106.
+"""
+
+import functools
+import math
+import time
+
+import numpy as np
+
+from analyzeflow.kymFlowRadon import (kymFlowExecutor, backends, _autoCandidates,
+                                        _probeThreads, _threadParallelFraction,
+                                        _chooseBackend, autoChunkSize)
+
+from analyzeflow import get_logger
+logger = get_logger(__name__)
+
+dvov = 0.1/100  # dv/v to determine minimum step-size
+firstThetaStep = 45  # degrees, first iteration is 4 angles 45 degrees apart
+ds = 4  # um, streak distance
+
+# stop iterating a segment after this many, thetastep is then 45/2**29 degrees.
+# bChhatbar0.m has no limit and does not stop if the angle is 0 (blank segment)
+maxIterations = 30
+
+def sobelFilter(data : np.ndarray) -> np.ndarray:
+    """3x3 vertical Sobel filter, Eq. 5,6.
+
+    Same as filter2([1 2 1; 0 0 0; -1 -2 -1], data, 'valid') in bChhatbar0.m.
+
+    Return:
+        (nlines-2, npoints-2) float64
+    """
+    data = np.asarray(data, dtype=np.float64)
+    _rows = data[:, :-2] + 2*data[:, 1:-1] + data[:, 2:]
+    return _rows[:-2] - _rows[2:]
+
+def _radonBins(shape : tuple):
+    """First bin and number of bins of MATLAB radon() for an image shape.
+    """
+    M, N = shape
+    center = [(s+1)//2 for s in shape]  # floor((size+1)/2), 1 based
+    rLast = math.ceil(math.sqrt((M - center[0])**2 + (N - center[1])**2)) + 1
+    rFirst = -rLast
+    return rFirst, rLast - rFirst + 1
+
+def radonProjections(segments : np.ndarray, angles : np.ndarray,
+                        maxElements : int = 2**16) -> np.ndarray:
+    """MATLAB radon() of each segment at its own angles.
+
+    Each pixel is split into 4 subpixels, each projected onto the two nearest
+    bins with linear weights, as radonc.c. Bins with no pixel are 0.
+
+    Args:
+        segments: (nSegments, M, N)
+        angles: (nSegments, nAngles) in degrees
+        maxElements: Bound on the (subpixel, angle) coordinates per batch
+
+    Return:
+        (nSegments, nAngles, nBins)
+    """
+    nSegments, M, N = segments.shape
+    nAngles = angles.shape[1]
+    rFirst, nBins = _radonBins((M, N))
+    center = [(s+1)//2 for s in (M, N)]
+
+    x = np.arange(N) - (center[1] - 1)
+    y = (center[0] - 1) - np.arange(M)  # y is up
+    subOffsets = (-0.25, 0.25)
+
+    P = np.zeros((nSegments, nAngles, nBins))
+    batchSize = max(1, maxElements // (nAngles * M * N))
+    for _start in range(0, nSegments, batchSize):
+        _stop = min(_start + batchSize, nSegments)
+        _segments = segments[_start:_stop, None] * 0.25  # (b, 1, M, N)
+        _rad = np.deg2rad(angles[_start:_stop])[:, :, None, None]  # (b, a, 1, 1)
+        _cos, _sin = np.cos(_rad), np.sin(_rad)
+        # one bin row per (segment, angle)
+        _offset = (np.arange((_stop - _start) * nAngles) * nBins).reshape(-1, nAngles, 1, 1)
+        _P = np.zeros((_stop - _start) * nAngles * nBins)
+        for dx in subOffsets:
+            _xCos = (x[None, None, None, :] + dx) * _cos
+            for dy in subOffsets:
+                r = _xCos + (y[None, None, :, None] + dy) * _sin - rFirst
+                r_int = np.floor(r)
+                delta = r - r_int
+                _index = (r_int.astype(np.int64) + _offset).ravel()
+                _pixel = np.broadcast_to(_segments, r.shape)
+                _P += np.bincount(_index, weights=(_pixel * (1 - delta)).ravel(),
+                                    minlength=_P.size)[:_P.size]
+                _P += np.bincount(_index + 1, weights=(_pixel * delta).ravel(),
+                                    minlength=_P.size + 1)[:_P.size]
+        P[_start:_stop] = _P.reshape(_stop - _start, nAngles, nBins)
+    return P
+
+def _nonzeroVariance(P : np.ndarray) -> np.ndarray:
+    """nanvar(R) with R(R==0) = nan, the sample variance of the nonzero bins.
+
+    Args:
+        P: (..., nBins)
+    """
+    mask = P != 0
+    n = np.count_nonzero(mask, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.sum(P, axis=-1) / n
+        var = np.sum(np.where(mask, P - mean[..., None], 0)**2, axis=-1) / (n - 1)
+    return np.where(n > 1, var, np.nan)
+
+def _angleResolution(curangle : np.ndarray, hi : int, wi : int, delx : float):
+    """Smallest resolvable angle step of each segment, Eq. 11-14.
+
+    Return:
+        dels1: Step of one streak (degrees), Eq. 12
+        deln: Step of ns streaks (degrees), Eq. 11
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        _tan = np.abs(np.tan(np.deg2rad(curangle)))
+        ws = np.minimum(wi, np.ceil(hi*_tan))  # Eq. 14
+        hs = np.minimum(hi, np.ceil(wi/_tan))  # Eq. 14
+        ns = np.floor(wi*delx/ds)*(hs == hi) + ((hi*delx*ws)/(ds*hs))*(ws == wi)  # Eq. 13
+        dels1 = np.abs(np.rad2deg(np.arctan(ws/hs))
+                        - np.rad2deg(np.arctan((ws-1)/hs))*(ws > hs)
+                        - np.rad2deg(np.arctan(ws/(hs-1)))*(ws <= hs))  # Eq. 12
+        deln = dels1/ns  # Eq. 11
+    return dels1, deln
+
+def _atand(x):
+    return np.rad2deg(np.arctan(x))
+
+def _tand(x):
+    return np.tan(np.deg2rad(x))
+
+def iterativeRadon(segments : np.ndarray, delx : float = 1):
+    """Iterative Radon transform of each (filtered) segment, see bChhatbar0.m.
+
+    Args:
+        segments: (nSegments, hi, wi) Sobel filtered image segments
+        delx: um per pixel, sets the number of streaks in a segment (Eq. 13)
+
+    Return:
+        dict of per segment arrays
+            'angle': degrees in [-90, 90), nan if no projection has variance
+            'minStep': last angle step (degrees)
+            'dels1', 'deln': see _angleResolution()
+            'dvov': actual dv/v (percent), Eq. 16
+            'iterations': number of radon iterations
+            'irl': iterative radon level
+    """
+    nSegments, hi, wi = segments.shape
+
+    firstiter = np.arange(0, 180, firstThetaStep)
+    firstiter = firstiter - (firstiter[-1] - firstiter[0])/2 + 1
+    stepOffsets = np.array([-3, -1, 1, 3])
+
+    curangle = np.zeros(nSegments)
+    curvarmax = np.zeros(nSegments)
+    thetastep = np.full(nSegments, float(firstThetaStep))
+    irl = np.ones(nSegments, dtype=int)
+    iterations = np.zeros(nSegments, dtype=int)
+    curmpa = np.zeros(nSegments)
+    deln = np.zeros(nSegments)
+    done = np.zeros(nSegments, dtype=bool)
+
+    for iteration in range(1, maxIterations+1):
+        active = np.flatnonzero(~done)
+        if len(active) == 0:
+            break
+        step = firstThetaStep / 2**(iteration-1)
+        if iteration == 1:
+            theta = np.broadcast_to(firstiter, (len(active), len(firstiter)))
+        else:
+            theta = curangle[active, None] + stepOffsets[None, :]*step
+        theta = np.mod(theta + 90, 180) - 90  # ensures angle range of [-90,+90)
+
+        curvar = _nonzeroVariance(radonProjections(segments[active], theta))  # Eq. 7
+        _curvar = np.where(np.isnan(curvar), -np.inf, curvar)
+        _index = np.argmax(_curvar, axis=1)
+        _max = _curvar[np.arange(len(active)), _index]
+        _better = _max > curvarmax[active]  # Eq. 8
+        curangle[active[_better]] = theta[_better, _index[_better]]
+        curvarmax[active[_better]] = _max[_better]
+        thetastep[active] = step
+        iterations[active] = iteration
+
+        # angle resolution less than 1 deg, level 2 where step-size is decided for given dv/v
+        _level2 = active[(irl[active] == 1) & (step < 1)]
+        irl[_level2] = 2
+        _angle = curangle[_level2]
+        curmpa[_level2] = np.abs(_atand((dvov+1)*_tand(_angle)) - _angle)  # Eq. 17
+        deln[_level2] = _angleResolution(_angle, hi, wi, delx)[1]
+
+        _check = active[(irl[active] > 1) & (step < deln[active])]  # Eq. 11
+        deln[_check] = _angleResolution(curangle[_check], hi, wi, delx)[1]
+        done[_check[step < deln[_check]]] = True
+
+        _check = active[~done[active] & (irl[active] > 1) & (step < curmpa[active])]  # Eq. 17
+        _angle = curangle[_check]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            actdvovper = np.abs(_tand(step + _angle)/_tand(_angle) - 1)*100  # Eq. 16
+        _stop = dvov > actdvovper/100
+        done[_check[_stop]] = True
+        _next = _check[~_stop]
+        irl[_next] += 1
+        _angle = np.abs(curangle[_next])
+        curmpa[_next] = _atand((dvov+1)*_tand(_angle)) - _angle  # Eq. 17
+
+    if not np.all(done):
+        logger.info(f'  {np.count_nonzero(~done)} segments did not converge in {maxIterations} iterations')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        actdvovper = np.abs(_tand(thetastep + curangle)/_tand(curangle) - 1)*100  # Eq. 16
+    dels1, deln = _angleResolution(curangle, hi, wi, delx)
+
+    # no peak was found, e.g. a blank segment
+    curangle[curvarmax == 0] = np.nan
+
+    return {
+        'angle': curangle,
+        'minStep': thetastep,
+        'dels1': dels1,
+        'deln': deln,
+        'dvov': actdvovper,
+        'iterations': iterations,
+        'irl': irl,
+    }
+
+def chhatbarChunkWorker(block : np.ndarray, hi : int, lineskip : int, delx : float = 1) -> dict:
+    """Multiprocessing worker to calculate flow for a contiguous block of segments.
+
+    Args:
+        block: Kymograph lines (and pixels) spanning all segments of the chunk,
+            with the one line (pixel) border of the Sobel filter, see _segmentBounds()
+        hi: Lines per segment
+        lineskip: Lines between the start of segments
+
+    Return:
+        See iterativeRadon()
+    """
+    filtered = sobelFilter(block)
+    nSegments = (filtered.shape[0] - hi) // lineskip + 1
+    segments = np.lib.stride_tricks.sliding_window_view(filtered, hi, axis=0)[::lineskip][:nSegments]
+    segments = np.ascontiguousarray(np.moveaxis(segments, -1, 1))  # (nSegments, hi, wi)
+    return iterativeRadon(segments, delx)
+
+def _segmentBounds(kStart : int, kStop : int, hi : int, lineskip : int):
+    """Lines of the kymograph spanning segments kStart..kStop, with the Sobel border.
+    """
+    return kStart*lineskip, (kStop-1)*lineskip + hi + 2
+
+def _pixelBounds(npoints : int, startPixel : int = None, stopPixel : int = None):
+    """Pixels of the kymograph to filter, with the Sobel border.
+
+    Filtered pixel j is kymograph pixel j+1, the first and last pixel of the
+    line are never analyzed (as xrange in bChhatbar0.m).
+    """
+    _start = 0 if startPixel is None else max(startPixel - 1, 0)
+    _stop = npoints - 2 if stopPixel is None else min(stopPixel - 1, npoints - 2)
+    if _stop <= _start:
+        raise ValueError(f'no pixels to analyze between startPixel {startPixel} and stopPixel {stopPixel}')
+    return _start, _stop + 2
+
+def chhatbarAnalyzeFlow(data : np.ndarray,
+                        hi : int = 100,
+                        lineskip : int = 25,
+                        startPixel : int = None,
+                        stopPixel : int = None,
+                        delx : float = 1,
+                        executor : kymFlowExecutor = None,
+                        backend : str = 'auto',
+                        chunkSize : int = None,
+                        returnInfo : bool = False):
+    """Given a blood flow kymograph, calculate blood flow velocity with hybridvel.
+
+    Args:
+        data: 2-D kymograph (time, space)
+        hi: Lines per image segment
+        lineskip: Lines before the next image segment starts
+        startPixel, stopPixel: Pixels (space) to analyze, None for all (xrange)
+        delx: um per pixel, sets the angle resolution (Eq. 13)
+        executor: Reuse an existing kymFlowExecutor
+        backend: Same as mpAnalyzeFlow(), 'auto' is serial when the pool
+            overhead dominates
+        chunkSize: Number of contiguous segments per worker task,
+            if None then use autoChunkSize()
+        returnInfo: If True, also return the per segment dict of iterativeRadon()
+
+    Return:
+        thetas: (nSegments,) angle of each segment (degrees),
+            velocity is tan(theta)*delx/delt, see kymFlowRadon.thetaToVelocity()
+        the_t: (nSegments,) center line of each segment (1 based, as bChhatbar0.m)
+        info: Only if returnInfo
+    """
+    startSec = time.time()
+
+    if backend not in backends:
+        raise ValueError(f'backend must be one of {list(backends)}, got "{backend}"')
+
+    nlines, npoints = data.shape
+    _pixelStart, _pixelStop = _pixelBounds(npoints, startPixel, stopPixel)
+    nSegments = (nlines - 2 - hi) // lineskip + 1
+    if nSegments < 1:
+        raise ValueError(f'need at least {hi+2} lines for hi {hi}, got {nlines}')
+
+    if backend == 'auto':
+        candidates = _autoCandidates(executor)
+        # seconds per segment, iterations are batched so time a few together
+        _numProbe = min(nSegments, 4)
+        _start, _stop = _segmentBounds(0, _numProbe, hi, lineskip)
+        _startSec = time.time()
+        chhatbarChunkWorker(data[_start:_stop, _pixelStart:_pixelStop], hi, lineskip, delx)
+        segmentSec = (time.time() - _startSec) / _numProbe
+        # fraction of a segment that runs in parallel on threads, two probes of 2 segments
+        threadFraction = 0.0
+        if _probeThreads(candidates) and nSegments >= 4:
+            tasks = [functools.partial(chhatbarChunkWorker,
+                                        data[slice(*_segmentBounds(kStart, kStart+2, hi, lineskip)),
+                                                _pixelStart:_pixelStop],
+                                        hi, lineskip, delx)
+                        for kStart in (0, 2)]
+            threadFraction = _threadParallelFraction(tasks)
+        backend = _chooseBackend([(nSegments, segmentSec, threadFraction)], candidates,
+                                    chunkSize=chunkSize)
+
+    ownExecutor = False
+    if backend != 'serial' and executor is None:
+        executor = kymFlowExecutor(backend=backend)
+        ownExecutor = True
+
+    try:
+        if backend == 'serial':
+            _chunkSize = nSegments
+        else:
+            _chunkSize = chunkSize or autoChunkSize(nSegments, executor.numWorkers)
+        result_objs = []
+        for kStart in range(0, nSegments, _chunkSize):
+            kStop = min(kStart + _chunkSize, nSegments)
+            _start, _stop = _segmentBounds(kStart, kStop, hi, lineskip)
+            block = data[_start:_stop, _pixelStart:_pixelStop]
+            _params = (block, hi, lineskip, delx)
+            if backend == 'serial':
+                result_objs.append((kStart, kStop, chhatbarChunkWorker(*_params)))
+            else:
+                result_objs.append((kStart, kStop, executor.apply_async(chhatbarChunkWorker, _params)))
+        if backend != 'serial':
+            result_objs = [(kStart, kStop, result.get()) for kStart, kStop, result in result_objs]
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+
+    segmentInfo = {key: np.concatenate([result[key] for _, _, result in result_objs])
+                    for key in result_objs[0][2].keys()}
+    thetas = segmentInfo['angle']
+
+    # location in bChhatbar0.m, segstart(jj)+hi/2
+    the_t = 1 + np.arange(nSegments)*lineskip + hi/2
+
+    logger.info(f'  chhatbar took {round(time.time()-startSec, 2)} seconds')
+
+    if returnInfo:
+        info = dict(segmentInfo)
+        info['hi'] = hi
+        info['lineskip'] = lineskip
+        info['startPixel'] = _pixelStart + 1
+        info['stopPixel'] = _pixelStop - 1
+        info['backend'] = backend
+        info['seconds'] = time.time() - startSec
+        return thetas, the_t, info
+    return thetas, the_t
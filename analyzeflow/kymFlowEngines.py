@@ -0,0 +1,387 @@
+"""
+Velocity engines, one per 'algorithm' in the analysis of a kymFlowFile.
+
+Each engine estimates velocity over windows of a kymograph and returns one
+row per window, see kymFlowEngine.estimate(). kymFlowFile.analyzeFlow(engine=)
+runs any registered engine and keeps the rows of all engines in one table.
+
+Built in engines are 'mpRadon' (kymFlowRadon), 'lspiv' (kymFlowLspiv),
+'chhatbar' (kymFlowChhatbar) and the fast 'structureTensor'
+(kymFlowStructureTensor). Other packages register engines with
+registerEngine() or an entry point in the 'analyzeflow.engines' group, e.g.
+in their setup.py:
+
+    entry_points={
+        'analyzeflow.engines': [
+            'myEngine = mypackage.engines:myEngine',
+        ],
+    }
+
+where myEngine is a kymFlowEngine subclass.
+"""
+
+import importlib.metadata
+import math
+
+import numpy as np
+import pandas as pd
+
+import analyzeflow.kymFlowRadon
+import analyzeflow.kymFlowLspiv
+import analyzeflow.kymFlowChhatbar
+import analyzeflow.kymFlowStructureTensor
+
+from analyzeflow import get_logger
+logger = get_logger(__name__)
+
+# entry point group of third-party engines, see loadEntryPointEngines()
+entryPointGroup = 'analyzeflow.engines'
+
+class kymFlowEngine():
+    """Base class of a velocity engine.
+
+    Subclass, set name and params, implement estimate() and register an
+    instance with registerEngine().
+    """
+
+    name : str = None
+    """The 'algorithm' column of the rows of this engine."""
+
+    params : dict = {}
+    """Analysis params of estimate() and their defaults."""
+
+    windowSizeParam : str = None
+    """Param that is in the 'windowSize' column, e.g. lines per window."""
+
+    usesExecutor : bool = False
+    """True if estimate() runs its windows on a kymFlowExecutor."""
+
+    fast : bool = False
+    """True if the cost per window is a few convolutions or FFTs (no angle sweep)."""
+
+    def getParams(self, **params) -> dict:
+        """Check params against the declared ones and fill in the defaults.
+
+        Raises:
+            ValueError: If a param is not declared
+        """
+        unknown = [key for key in params.keys() if key not in self.params.keys()]
+        if unknown:
+            raise ValueError(f'engine "{self.name}" has no params {unknown}, params are {list(self.params.keys())}')
+        _params = dict(self.params)
+        _params.update(params)
+        return _params
+
+    def estimate(self, data : np.ndarray, delx : float, delt : float, rois : dict,
+                    executor : "analyzeflow.kymFlowRadon.kymFlowExecutor" = None,
+                    **params) -> pd.DataFrame:
+        """Estimate velocity over windows of a kymograph.
+
+        Args:
+            data: 2-D kymograph (time, space)
+            delx: um per pixel
+            delt: seconds per line
+            rois: Dict of name to (startPixel, stopPixel), None for the line start/stop
+            executor: A kymFlowExecutor to share, engines that do not use one ignore it
+            params: See params
+
+        Return:
+            One row per window with at least the columns 'time' (s),
+            'velocity' (mm/s), 'windowSize', 'roi', 'startPixel' and 'stopPixel'.
+        """
+        raise NotImplementedError
+
+    def numWindows(self, shape : tuple, **params) -> int:
+        """Number of windows (rows) of one roi of a kymograph with shape.
+        """
+        raise NotImplementedError
+
+    def costHint(self, shape : tuple, **params) -> dict:
+        """Cost of estimate() on one roi of a kymograph with shape, before running it.
+
+        Return:
+            dict with 'numWindows', 'pixelsPerWindow' (lines x pixels of a window),
+            'usesExecutor' and 'fast'
+        """
+        params = self.getParams(**params)
+        windowSizes = params[self.windowSizeParam] if self.windowSizeParam else None
+        windowSizes = [windowSizes] if np.isscalar(windowSizes) or windowSizes is None else windowSizes
+        numWindows = 0
+        pixelsPerWindow = []
+        for _windowSize in windowSizes:
+            _params = dict(params)
+            if self.windowSizeParam:
+                _params[self.windowSizeParam] = _windowSize
+            numWindows += self.numWindows(shape, **_params)
+            pixelsPerWindow.append((_windowSize or shape[0]) * shape[1])
+        return {
+            'numWindows': numWindows,
+            'pixelsPerWindow': max(pixelsPerWindow),
+            'usesExecutor': self.usesExecutor,
+            'fast': self.fast,
+        }
+
+def _pixelSpan(data : np.ndarray, startPixel : int, stopPixel : int):
+    """(startPixel, stopPixel) with None as the line start/stop.
+    """
+    startPixel = 0 if startPixel is None else startPixel
+    stopPixel = data.shape[1] if stopPixel is None else stopPixel
+    return startPixel, stopPixel
+
+class radonEngine(kymFlowEngine):
+    """Radon transform of sliding windows (Drew lab), see kymFlowRadon.mpAnalyzeFlow().
+
+    All rois and window sizes are analyzed in one mpAnalyzeFlow() call.
+    """
+    name = 'mpRadon'
+    params = {
+        'windowSize': 16,  # int or list of int, multiple of 4
+        'radonEngine': 'radon',  # mpAnalyzeFlow(engine=)
+        'angleSearch': 'exhaustive',
+        'tracking': False,
+        'trackingHalfWidth': 10,
+        'refine': 'sweep',
+        'precision': 'float64',
+        'backend': 'auto',
+        'sharedMemory': False,
+        'chunkSize': None,
+        'minIntensity': None,
+        'minContrast': None,
+        'cascade': False,  # structure tensor first, Radon only on escalated windows
+        'cascadeMinCoherence': analyzeflow.kymFlowRadon.cascadeMinCoherence,
+        'cascadeMaxDiff': analyzeflow.kymFlowRadon.cascadeMaxDiff,
+        'verbose': False,
+    }
+    windowSizeParam = 'windowSize'
+    usesExecutor = True
+
+    def numWindows(self, shape : tuple, windowSize : int = 16, **params) -> int:
+        stepsize = int(.25 * windowSize)
+        return max(0, math.floor(shape[0]/stepsize)-3)
+
+    def estimate(self, data, delx, delt, rois, executor=None, **params):
+        params = self.getParams(**params)
+        windowSize = params.pop('windowSize')
+        params['engine'] = params.pop('radonEngine')
+        windowSizes = [windowSize] if np.isscalar(windowSize) else list(windowSize)
+
+        results = analyzeflow.kymFlowRadon.mpAnalyzeFlow(data,
+                                    windowSizes,
+                                    executor=executor,
+                                    rois=rois,
+                                    returnInfo=True,
+                                    **params)
+
+        dfList = []
+        for roiName in rois.keys():
+            for _windowSize in windowSizes:
+                thetas, the_t, spread_matrix, info = results[roiName][_windowSize]
+                logger.info(f"  roi:{roiName} pixels:{info['startPixel']}..{info['stopPixel']} windowSize:{_windowSize} angleSearch:{info['angleSearch']} meanAngles:{info['meanAngles']} took {round(info['seconds'],2)} s")
+                if info['numSkipped'] > 0:
+                    logger.info(f"  skipped {info['numSkipped']} dark/blank windows")
+                if info['cascade']:
+                    logger.info(f"  escalated {info['numEscalated']} windows to the radon ({round(100*info['escalatedFraction'], 1)}%)")
+
+                df = pd.DataFrame()
+                df['time'] = the_t * delt  #seconds
+                # convert angle to velocity (mm/s), nan for inf and 0 tan()
+                df['velocity'] = analyzeflow.kymFlowRadon.thetaToVelocity(thetas, delx, delt)
+                df['nAngles'] = info['nAngles']  # number of angles evaluated per window
+                df['curvature'] = info['curvature']  # peak curvature (confidence), nan for refine='sweep'
+                df['skipped'] = info['skipped']  # dark/blank window, no radon, nan velocity
+                if info['cascade']:
+                    df['escalated'] = info['escalated']  # radon, otherwise structure tensor angle
+                    df['coherence'] = info['coherence']
+                df['windowSize'] = _windowSize
+                df['roi'] = roiName
+                df['startPixel'] = info['startPixel']
+                df['stopPixel'] = info['stopPixel']
+                dfList.append(df)
+        return pd.concat(dfList, ignore_index=True)
+
+class lspivEngine(kymFlowEngine):
+    """Line-scanning PIV (Kim et al. 2012), see kymFlowLspiv.lspivAnalyzeFlow().
+
+    The 'windowSize' column is numavgs.
+    """
+    name = 'lspiv'
+    params = {
+        'numavgs': 100,
+        'skipamt': 25,
+        'shiftamt': 5,  # 5 for capillaries and 1 for arteries, see lspivPresets
+        'maxGaussWidth': 100,
+        'numstd': 3,
+        'badWindowsize': 2600,
+    }
+    windowSizeParam = 'numavgs'
+    fast = True
+
+    def numWindows(self, shape : tuple, numavgs : int = 100, skipamt : int = 25,
+                    shiftamt : int = 5, **params) -> int:
+        return len(range(skipamt, shape[0] - shiftamt - numavgs + 1, skipamt))
+
+    def estimate(self, data, delx, delt, rois, executor=None, **params):
+        params = self.getParams(**params)
+        dfList = []
+        for roiName, (startPixel, stopPixel) in rois.items():
+            velocity, the_t, xcorr, info = analyzeflow.kymFlowLspiv.lspivAnalyzeFlow(data,
+                                        startPixel=startPixel,
+                                        stopPixel=stopPixel,
+                                        returnInfo=True,
+                                        **params)
+            df = pd.DataFrame()
+            df['time'] = the_t * delt  #seconds
+            df['velocity'] = analyzeflow.kymFlowLspiv.shiftToVelocity(velocity, delx, delt)
+            df['windowSize'] = params['numavgs']
+            df['roi'] = roiName
+            df['startPixel'], df['stopPixel'] = _pixelSpan(data, startPixel, stopPixel)
+            df['skipamt'] = params['skipamt']
+            df['shiftamt'] = params['shiftamt']
+            df['badFit'] = info['badFit']  # outlier in the moving window (bKim.m)
+            dfList.append(df)
+        return pd.concat(dfList, ignore_index=True)
+
+class chhatbarEngine(kymFlowEngine):
+    """Hybrid iterative Radon (Chhatbar and Kara 2013), see kymFlowChhatbar.chhatbarAnalyzeFlow().
+
+    The 'windowSize' column is hi.
+    """
+    name = 'chhatbar'
+    params = {
+        'hi': 100,
+        'lineskip': 25,
+        'backend': 'auto',
+        'chunkSize': None,
+    }
+    windowSizeParam = 'hi'
+    usesExecutor = True
+
+    def numWindows(self, shape : tuple, hi : int = 100, lineskip : int = 25, **params) -> int:
+        return max(0, (shape[0] - 2 - hi) // lineskip + 1)
+
+    def estimate(self, data, delx, delt, rois, executor=None, **params):
+        params = self.getParams(**params)
+        dfList = []
+        for roiName, (startPixel, stopPixel) in rois.items():
+            thetas, the_t, info = analyzeflow.kymFlowChhatbar.chhatbarAnalyzeFlow(data,
+                                        startPixel=startPixel,
+                                        stopPixel=stopPixel,
+                                        delx=delx,
+                                        executor=executor,
+                                        returnInfo=True,
+                                        **params)
+            df = pd.DataFrame()
+            df['time'] = the_t * delt  #seconds
+            df['velocity'] = analyzeflow.kymFlowRadon.thetaToVelocity(thetas, delx, delt)
+            df['windowSize'] = params['hi']
+            df['roi'] = roiName
+            df['startPixel'] = info['startPixel']
+            df['stopPixel'] = info['stopPixel']
+            df['lineskip'] = params['lineskip']
+            df['theta'] = thetas
+            df['minStep'] = info['minStep']  # degrees
+            df['dvov'] = info['dvov']  # actual dv/v (percent)
+            df['iterations'] = info['iterations']
+            dfList.append(df)
+        return pd.concat(dfList, ignore_index=True)
+
+class structureTensorEngine(kymFlowEngine):
+    """Streak angle from the gradient structure tensor, see kymFlowStructureTensor.
+
+    Same windows as 'mpRadon', the 'coherence' column is the per window confidence.
+    """
+    name = 'structureTensor'
+    params = {
+        'windowSize': 16,  # int or list of int, multiple of 4
+        'sigma': 1.0,
+        'removeBackground': True,
+    }
+    windowSizeParam = 'windowSize'
+    fast = True
+
+    def numWindows(self, shape : tuple, windowSize : int = 16, **params) -> int:
+        return radonEngine().numWindows(shape, windowSize)
+
+    def estimate(self, data, delx, delt, rois, executor=None, **params):
+        params = self.getParams(**params)
+        windowSize = params.pop('windowSize')
+        windowSizes = [windowSize] if np.isscalar(windowSize) else list(windowSize)
+        dfList = []
+        for roiName, (startPixel, stopPixel) in rois.items():
+            for _windowSize in windowSizes:
+                thetas, the_t, info = analyzeflow.kymFlowStructureTensor.structureTensorAnalyzeFlow(data,
+                                            _windowSize,
+                                            startPixel=startPixel,
+                                            stopPixel=stopPixel,
+                                            returnInfo=True,
+                                            **params)
+                df = pd.DataFrame()
+                df['time'] = the_t * delt  #seconds
+                df['velocity'] = analyzeflow.kymFlowRadon.thetaToVelocity(thetas, delx, delt)
+                df['coherence'] = info['coherence']  # 0 (no orientation) to 1 (streaks)
+                df['windowSize'] = _windowSize
+                df['roi'] = roiName
+                df['startPixel'], df['stopPixel'] = _pixelSpan(data, startPixel, stopPixel)
+                dfList.append(df)
+        return pd.concat(dfList, ignore_index=True)
+
+# registered engines, name ('algorithm' column) to kymFlowEngine
+velocityEngines = {}
+
+def registerEngine(engine : kymFlowEngine, replace : bool = False):
+    """Register a velocity engine under its name.
+
+    Args:
+        engine: A kymFlowEngine instance (or subclass, it is instantiated)
+        replace: If True, replace an engine with the same name
+
+    Raises:
+        ValueError: If the engine has no name or the name is taken
+    """
+    if isinstance(engine, type):
+        engine = engine()
+    if not isinstance(engine, kymFlowEngine):
+        raise ValueError(f'engine must be a kymFlowEngine, got {type(engine)}')
+    if not engine.name:
+        raise ValueError(f'engine {type(engine).__name__} has no name')
+    if engine.name in velocityEngines.keys() and not replace:
+        raise ValueError(f'engine "{engine.name}" is already registered')
+    velocityEngines[engine.name] = engine
+
+for _engine in (radonEngine, lspivEngine, chhatbarEngine, structureTensorEngine):
+    registerEngine(_engine)
+
+_entryPointsLoaded = False
+
+def loadEntryPointEngines():
+    """Register the engines of installed packages, see entryPointGroup.
+
+    Only done once, an engine that fails to load is logged and skipped.
+    Engines already registered are not replaced.
+    """
+    global _entryPointsLoaded
+    if _entryPointsLoaded:
+        return
+    _entryPointsLoaded = True
+    for entryPoint in importlib.metadata.entry_points(group=entryPointGroup):
+        try:
+            registerEngine(entryPoint.load())
+        except Exception as e:
+            logger.error(f'could not load engine "{entryPoint.name}" from {entryPoint.value}: {e}')
+
+def getEngine(name : str) -> kymFlowEngine:
+    """Get a registered engine by name, see getEngineNames().
+
+    Raises:
+        ValueError: If there is no engine with name
+    """
+    loadEntryPointEngines()
+    if name not in velocityEngines.keys():
+        raise ValueError(f'engine must be one of {list(velocityEngines.keys())}, got "{name}"')
+    return velocityEngines[name]
+
+def getEngineNames() -> list:
+    """Get the names of the registered engines, e.g. ['mpRadon', 'lspiv', 'chhatbar', 'structureTensor'].
+    """
+    loadEntryPointEngines()
+    return list(velocityEngines.keys())
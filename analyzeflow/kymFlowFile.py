@@ -8,10 +8,52 @@ import scipy.signal
 
 import analyzeflow.kymFlowUtil
 import analyzeflow.kymFlowRadon
+import analyzeflow.kymFlowEngines
 
 from analyzeflow import get_logger
 logger = get_logger(__name__)
 
+# roi name in the analysis when no rois are defined, see kymFlowFile.addRoi()
+defaultRoiName = 'default'
+
+def _isValue(column : pd.Series, value) -> pd.Series:
+    """Rows of column equal to value, nan (missing) matches nan.
+    """
+    if pd.isna(value):
+        return column.isna()
+    return column == value
+
+def _legacyWindowSize(df : pd.DataFrame) -> int:
+    """Window size of an older mpRadon analysis, from its time step.
+
+    Windows are windowSize/4 lines apart, see mpAnalyzeFlow(). Older
+    analysis used the default of analyzeFlowWithRadon() (16).
+    """
+    if len(df) > 1 and 'delt' in df.columns:
+        stepLines = (df['time'].iloc[1] - df['time'].iloc[0]) / df['delt'].iloc[0]
+        if np.isfinite(stepLines) and round(stepLines) > 0:
+            return 4 * int(round(stepLines))
+    return 16
+
+def _fillLegacyColumns(df : pd.DataFrame) -> pd.DataFrame:
+    """Fill the 'roi' and 'windowSize' of rows from an older analysis.
+
+    Older analysis (one roi and window size) has no 'roi'/'windowSize'
+    columns, they are nan once concatenated with newer rows. Missing 'roi'
+    is defaultRoiName, missing 'windowSize' is from the time step of the
+    rows of each algorithm, see _legacyWindowSize().
+    """
+    df = df.copy()
+    if 'roi' not in df.columns:
+        df['roi'] = defaultRoiName
+    else:
+        df['roi'] = df['roi'].astype(object).where(df['roi'].notna(), defaultRoiName)
+    if 'windowSize' not in df.columns:
+        df['windowSize'] = np.nan
+    for algorithm, algorithmDf in df[df['windowSize'].isna()].groupby('algorithm', sort=False):
+        df.loc[algorithmDf.index, 'windowSize'] = _legacyWindowSize(algorithmDf)
+    return df
+
 class kymFlowFile():
     """Class to hold a kym for flow analysis.
         - tif data
@@ -21,7 +63,17 @@ class kymFlowFile():
     def __init__(self,
                  tifPath : str = None,
                  loadTif=True,
-                 ba : "sanpy.bAnalysis" = None):
+                 ba : "sanpy.bAnalysis" = None,
+                 memmap : bool = False):
+        """
+        Args:
+            tifPath: Path to the kymograph tif
+            loadTif: If False, do not load the tif data
+            ba: Get tif data and path from a sanpy bAnalysis
+            memmap: If True, memory-map the tif rather than reading it into memory.
+                Analysis and intensity stats then read the file a chunk at a time.
+                Falls back to reading the tif if it is not contiguous (e.g. compressed).
+        """
 
         # load tif data
         self._ba = None
@@ -34,7 +86,13 @@ class kymFlowFile():
             self._tifPath = tifPath
             self._tifData = None
             if loadTif:
-                self._tifData = tifffile.imread(tifPath)
+                self._tifData = self._loadTif(tifPath, memmap)
+
+        # (mean, min, max) intensity, see _getIntensityStats()
+        self._intensityStats = None
+
+        # named spatial rois, name to (startPixel, stopPixel), see addRoi()
+        self._rois = {}
 
         # don't rotate, only for plot, see getTifCopy()
         #self._tifData = np.rot90(self._tifData)  # for plot
@@ -56,6 +114,70 @@ class kymFlowFile():
         self._dfMatlab = None
         self.loadMatlabAnalysis()
 
+    def _loadTif(self, tifPath : str, memmap : bool = False) -> np.ndarray:
+        """Load tif data, optionally memory-mapped (read only).
+        """
+        if memmap:
+            try:
+                return tifffile.memmap(tifPath, mode='r')
+            except ValueError as e:
+                logger.warning(f'can not memory-map, reading into memory: {e}')
+                logger.warning(f'  tifPath:{tifPath}')
+        return tifffile.imread(tifPath)
+
+    def _getIntensityStats(self, linesPerBlock : int = 4096):
+        """Get (mean, min, max) of the tif data.
+
+        Computed one block of lines at a time so a memory-mapped tif is
+        streamed from disk. Cached after the first call.
+        """
+        if self._intensityStats is None:
+            tifData = self._tifData
+            _sum = 0.0
+            _min = None
+            _max = None
+            for _start in range(0, tifData.shape[0], linesPerBlock):
+                _block = np.asarray(tifData[_start:_start+linesPerBlock])
+                _sum += np.sum(_block, dtype=np.float64)
+                _blockMin = np.min(_block)
+                _blockMax = np.max(_block)
+                _min = _blockMin if _min is None else min(_min, _blockMin)
+                _max = _blockMax if _max is None else max(_max, _blockMax)
+            self._intensityStats = (_sum / tifData.size, _min, _max)
+        return self._intensityStats
+
+    def getVesselEdges(self, **kwargs):
+        """Find the (startPixel, stopPixel) of the vessel lumen.
+
+        Args:
+            kwargs: Passed to kymFlowRadon.detectVesselEdges()
+        """
+        return analyzeflow.kymFlowRadon.detectVesselEdges(self._tifData, **kwargs)
+
+    def addRoi(self, name : str, startPixel : int = None, stopPixel : int = None):
+        """Add (or replace) a named spatial roi, e.g. one per vessel in the line scan.
+
+        All rois are analyzed by analyzeFlowWithRadon().
+
+        Args:
+            name: Name of the roi, the 'roi' column of the analysis
+            startPixel, stopPixel: Pixels (space) of the roi, None for the line start/stop
+        """
+        self._rois[name] = (startPixel, stopPixel)
+
+    def deleteRoi(self, name : str):
+        """Delete a named roi, see addRoi().
+        """
+        if name not in self._rois.keys():
+            logger.warning(f'no roi named "{name}"')
+            return
+        self._rois.pop(name)
+
+    def getRois(self) -> dict:
+        """Get the named rois, name to (startPixel, stopPixel).
+        """
+        return dict(self._rois)
+
     def isKymograph(self):
         return True
 
@@ -82,6 +204,8 @@ class kymFlowFile():
         return self.delt() * self.numLines()
 
     def getTifCopy(self, doRotate=False):
+        """Get a copy of the tif data, in memory even if memory-mapped.
+        """
         if self._tifData is None:
             logger.warning(f'no tif data {self._tifPath}')
             return
@@ -111,127 +235,156 @@ class kymFlowFile():
     def delt(self):
         return self._header['secondsPerLine']
 
-    def analyzeFlowWithRadon(self, windowSize : int = 16,
+    def analyzeFlow(self, engine : str = 'mpRadon',
                     startPixel : int = None,
                     stopPixel : int = None,
-                    ):
-        """Analyze flow using Radon transform.
-        
-        This generates a pd.DataFrame, one row per line scan.
+                    executor : "analyzeflow.kymFlowRadon.kymFlowExecutor" = None,
+                    autoRoi : bool = False,
+                    **params):
+        """Analyze flow with a registered velocity engine, see kymFlowEngines.
+
+        This generates a pd.DataFrame, one row per window, with 'algorithm'
+        the engine name. Rows of other engines are kept, see getVelocity(algorithm=).
         This is what we save.
 
         Args:
-            windowSize: must be multiple of 4
-        
-        Note:
-            the speed scales with window size, larger window size is faster
+            engine: Name of the engine, see kymFlowEngines.getEngineNames(),
+                e.g. 'mpRadon', 'lspiv' or 'chhatbar'
+            startPixel, stopPixel: If both None, analyze all rois (see addRoi()),
+                rows of each roi are in the 'roi' column, see getVelocity(roi=).
+                Otherwise (or if there are no rois) one span named defaultRoiName.
+            executor: Reuse a kymFlowExecutor across files, engines that do
+                not use one ignore it
+            autoRoi: If True and there are no rois or startPixel/stopPixel,
+                analyze the vessel lumen found by getVesselEdges(). The span
+                is in the 'startPixel'/'stopPixel' columns, 'autoRoi' is True.
+            params: Params of the engine, see kymFlowEngine.params
         """
+        _engine = analyzeflow.kymFlowEngines.getEngine(engine)
+        _engine.getParams(**params)  # check before the analysis
 
-        _analysisVerion = 0.2
-        
-        # TODO:
-        # self._dateAnalyzed = datetime.today().strftime('%Y%m%d')
-        # self._timeAnalyzed = datetime.today().strftime('%H:%M:%S')
-
-        delx = self.delx()
-        delt = self.delt()
         tifData = self._tifData
 
-        logger.info(f'calling mpAnalyzeFlow() for {self.getFileName()}')
-        thetas,the_t,spread_matrix = analyzeflow.kymFlowRadon.mpAnalyzeFlow(tifData,
-                                    windowSize,
-                                    startPixel=startPixel,
-                                    stopPixel=stopPixel)
-        
-        doDebugVar = False
-        # need to figure out how to use variance to reject individual velocity measurements
-        if doDebugVar:
-            logger.info('=== DEBUG spread_matrix:')
-            print('  shape:', spread_matrix.shape, 'dtype:', spread_matrix.dtype)
-            
-            # normalize spread matrix?
-            spread_matrix_mean = np.mean(spread_matrix, axis=1)
-            spread_matrix = spread_matrix / spread_matrix_mean[:,None]
-
-            minSpread = np.min(spread_matrix, axis=1)
-            maxSpread = np.max(spread_matrix, axis=1)
-            print('  minSpread.shape:', minSpread.shape)
-            print('  maxSpread.shape:', maxSpread.shape)
-            print('    min of minSpread:', np.min(minSpread))
-            print('    min of maxSpread:', np.min(maxSpread))
-
-            import matplotlib.pyplot as plt
-            fig, axs = plt.subplots(2, sharex=True)
-            
-            axs[0].plot(the_t * delt, minSpread, 'o')
-            axs[0].set(ylabel='min spead')
-            
-            axs[1].plot(the_t * delt, maxSpread, 'o')
-            axs[1].set(ylabel='max spead')
-            
-            plt.show()
-            sys.exit(1)
-
-        # convert to physical units
-        drewTime = the_t * delt
-        
-        # convert radians to angle
-        _rad = np.deg2rad(thetas)
-        drewVelocity = (delx/delt) * np.tan(_rad)
-        drewVelocity = drewVelocity / 1000  # mm/s
+        logger.info(f'calling engine {engine} for {self.getFileName()}')
+        useAutoRoi = False
+        if startPixel is None and stopPixel is None and self._rois:
+            rois = self._rois
+        else:
+            if autoRoi and startPixel is None and stopPixel is None:
+                startPixel, stopPixel = self.getVesselEdges()
+                useAutoRoi = True
+                logger.info(f'  autoRoi vessel lumen pixels:{startPixel}..{stopPixel} of {tifData.shape[1]}')
+            rois = {defaultRoiName: (startPixel, stopPixel)}
+
+        df = _engine.estimate(tifData, self.delx(), self.delt(), rois,
+                                executor=executor, **params)
+
+        # file columns after 'time' and 'velocity'
+        fileColumns = {
+            'parentFolder': analyzeflow.kymFlowUtil._getFolderName(self._tifPath),
+            'file': self.getFileName(),
+            'algorithm': _engine.name,
+            'delx': self.delx(),
+            'delt': self.delt(),
+            'numLines': self.numLines(),
+            'pntsPerLine': self.pntsPerLine(),
+        }
+        for idx, (column, value) in enumerate(fileColumns.items()):
+            df.insert(2 + idx, column, value)
+        df['autoRoi'] = useAutoRoi  # startPixel/stopPixel from getVesselEdges()
 
-        # debug, count inf and 0 tan
-        # numZeros = np.count_nonzero(drewVelocity==0)
-        # logger.info(f'  1) numZeros:{numZeros}')
+        self._setAlgorithmRows(_engine.name, df)
 
-        # remove inf and 0 tan()
-        # np.tan(90 deg) is returning 1e16 rather than inf
-        tan90or0 = (drewVelocity > 1e6) | (drewVelocity == 0)
-        drewVelocity[tan90or0] = float('nan')
+    def analyzeFlowWithRadon(self, windowSize = 16,
+                    startPixel : int = None,
+                    stopPixel : int = None,
+                    executor : "analyzeflow.kymFlowRadon.kymFlowExecutor" = None,
+                    autoRoi : bool = False,
+                    **kwargs
+                    ):
+        """Analyze flow using Radon transform, analyzeFlow(engine='mpRadon').
+        
+        Args:
+            windowSize: must be multiple of 4. Can be a list of window sizes,
+                analyzed in one mpAnalyzeFlow() call, rows of each window size
+                are in the 'windowSize' column, see getVelocity(windowSize=)
+            startPixel, stopPixel, executor, autoRoi: See analyzeFlow()
+            kwargs: Passed to mpAnalyzeFlow(), e.g. sharedMemory=True,
+                precision='float32' or minIntensity= to skip dark windows
+        
+        Note:
+            the speed scales with window size, larger window size is faster
+        """
+        if 'engine' in kwargs.keys():
+            # mpAnalyzeFlow(engine=)
+            kwargs['radonEngine'] = kwargs.pop('engine')
+        self.analyzeFlow('mpRadon', startPixel=startPixel, stopPixel=stopPixel,
+                            executor=executor, autoRoi=autoRoi,
+                            windowSize=windowSize, **kwargs)
 
-        # debug, count inf and 0 tan
-        # numZeros = np.count_nonzero(drewVelocity==0)
-        # logger.info(f'  2) numZeros:{numZeros}')
+    def _setAlgorithmRows(self, algorithm : str, df : pd.DataFrame):
+        """Replace the analysis rows of one algorithm, rows of other algorithms are kept.
 
-        # don't do this here, do it when we call getVelocity() in getReport()
-        # 20230125, check if we have both pos/neg valocities
-        # do this after removing outliers
-        # in our main analysis we have already removed artifacts from usnig tan, e.g. (1e6, 0)
-        # velocityDrew_no_outliers = self.getVelocity(removeOutliers=True, medianFilter=5)
-        # _minVelSign = np.sign(np.nanmin(velocityDrew_no_outliers))
-        # _maxVelSign = np.sign(np.nanmax(velocityDrew_no_outliers))
-        # if _minVelSign != _maxVelSign:
-        #     logger.error(f'  VELOCITY HAS BOTH POS AND NEGATIVE')
-        #     logger.error(f'    file:{self.getFileName()}')
-        #     logger.error(f'    minVel:{np.nanmin(velocityDrew_no_outliers)} maxVel:{np.nanmax(velocityDrew_no_outliers)}')
-        # if self.checkPosNeg():
-        #     logger.warning('')
+        Adds the 'cleanVelocity' and 'absVelocity' columns of each roi and window size.
+        """
+        if self._df is not None and 'algorithm' in self._df.columns:
+            otherDf = self._df[ self._df['algorithm']!=algorithm ]
+            if len(otherDf) > 0:
+                df = pd.concat([_fillLegacyColumns(otherDf), df], ignore_index=True)
+        self._df = df
 
         # feb 6, order matters
-        #velocityDrew_no_outliers = self.getVelocity(removeOutliers=True, medianFilter=5)
-
-        logger.info(f'  ')
-
-        # create a df (saved in saveAnalysis())
-        df = pd.DataFrame()
-        df['time'] = drewTime  #seconds
-        df['velocity'] = drewVelocity
-        # df['cleanVelocity'] = velocityDrew_no_outliers
-        # df['absVelocity'] = np.abs(velocityDrew_no_outliers)
-        df['parentFolder'] = analyzeflow.kymFlowUtil._getFolderName(self._tifPath)
-        df['file'] = self.getFileName()
-        df['algorithm'] = 'mpRadon'
-        df['delx'] = delx
-        df['delt'] = delt
-        df['numLines'] = self.numLines()
-        df['pntsPerLine'] = self.pntsPerLine()
+        _algorithmRows = self._df['algorithm'] == algorithm
+        for roiName in pd.unique(self._df.loc[_algorithmRows, 'roi']):
+            for _windowSize in pd.unique(self._df.loc[_algorithmRows, 'windowSize']):
+                velocityDrew_no_outliers = self.getVelocity(removeOutliers=True, medianFilter=5,
+                                                            windowSize=_windowSize, roi=roiName,
+                                                            algorithm=algorithm)
+                _rows = _algorithmRows & (self._df['roi'] == roiName) & (self._df['windowSize'] == _windowSize)
+                self._df.loc[_rows, 'cleanVelocity'] = velocityDrew_no_outliers
+                self._df.loc[_rows, 'absVelocity'] = np.abs(velocityDrew_no_outliers)
+
+    def analyzeFlowWithLspiv(self, numavgs : int = 100,
+                                skipamt : int = 25,
+                                shiftamt : int = 5,
+                                startPixel : int = None,
+                                stopPixel : int = None,
+                                **kwargs):
+        """Analyze flow using line-scanning PIV (Kim et al. 2012), analyzeFlow(engine='lspiv').
+
+        Rows have algorithm 'lspiv' and are kept next to the 'mpRadon' rows,
+        see getVelocity(algorithm='lspiv'). The 'windowSize' column is numavgs.
 
-        self._df = df
+        Args:
+            numavgs, skipamt, shiftamt: See kymFlowLspiv.lspivAnalyzeFlow(),
+                e.g. shiftamt=5 for capillaries and 1 for arteries
+            startPixel, stopPixel: See analyzeFlow()
+            kwargs: Passed to analyzeFlow()
+        """
+        self.analyzeFlow('lspiv', startPixel=startPixel, stopPixel=stopPixel,
+                            numavgs=numavgs, skipamt=skipamt, shiftamt=shiftamt,
+                            **kwargs)
+
+    def analyzeFlowWithChhatbar(self, hi : int = 100,
+                                lineskip : int = 25,
+                                startPixel : int = None,
+                                stopPixel : int = None,
+                                executor : "analyzeflow.kymFlowRadon.kymFlowExecutor" = None,
+                                **kwargs):
+        """Analyze flow with the hybrid iterative Radon (Chhatbar and Kara 2013), analyzeFlow(engine='chhatbar').
+
+        Rows have algorithm 'chhatbar' (as the Matlab csv of bChhatbar.m) and are
+        kept next to the 'mpRadon' rows, see getVelocity(algorithm='chhatbar').
+        The 'windowSize' column is hi.
 
-        # feb 6, order matters
-        velocityDrew_no_outliers = self.getVelocity(removeOutliers=True, medianFilter=5)
-        self._df['cleanVelocity'] = velocityDrew_no_outliers
-        self._df['absVelocity'] = np.abs(velocityDrew_no_outliers)
+        Args:
+            hi, lineskip: Lines per image segment and between segments,
+                see kymFlowChhatbar.chhatbarAnalyzeFlow()
+            startPixel, stopPixel, executor: See analyzeFlow()
+            kwargs: Passed to analyzeFlow(), e.g. backend=
+        """
+        self.analyzeFlow('chhatbar', startPixel=startPixel, stopPixel=stopPixel,
+                            executor=executor, hi=hi, lineskip=lineskip, **kwargs)
 
     def checkPosNeg(self):
         """Check for both positive and negative vel AFTER removing outliers
@@ -255,10 +408,18 @@ class kymFlowFile():
                         medianFilter : int = 0,
                         absValue : bool = True,
                         startSec = None,
-                        stopSec = None) -> np.ndarray:
+                        stopSec = None,
+                        windowSize : int = None,
+                        roi : str = None,
+                        algorithm : str = 'mpRadon') -> np.ndarray:
         """Get velocity from analysis.
+
+        Args:
+            windowSize: If None, the first window size analyzed, see getWindowSizes()
+            roi: If None, the first roi analyzed, see getRoiNames()
+            algorithm: The 'algorithm' column, e.g. 'mpRadon', see kymFlowEngines.getEngineNames()
         """
-        df = self._df
+        df = self._getRows(windowSize, roi, algorithm)
         
         # feb 2023, reduce by startSec/stopSec        
         if startSec is None:
@@ -268,7 +429,8 @@ class kymFlowFile():
 
         df = df[ (df['time']>=startSec) & (df['time']<=stopSec) ]
 
-        velocityDrew = df[ df['algorithm']=='mpRadon' ]['velocity'].to_numpy()
+        # copy, filters below are in place (to_numpy() is read only with pandas copy-on-write)
+        velocityDrew = df['velocity'].to_numpy(copy=True)
         
         if removeZero:
             velocityDrew[velocityDrew==0] = np.nan
@@ -286,27 +448,86 @@ class kymFlowFile():
 
         return velocityDrew
 
-    def getTime(self):
+    def getTime(self, windowSize : int = None, roi : str = None,
+                    algorithm : str = 'mpRadon'):
         """Get time from analysis.
         
         Different than time of line scan.
+
+        Args:
+            windowSize: If None, the first window size analyzed, see getWindowSizes()
+            roi: If None, the first roi analyzed, see getRoiNames()
+            algorithm: The 'algorithm' column, e.g. 'mpRadon', see kymFlowEngines.getEngineNames()
         """
-        timeDrew = self._df[ self._df['algorithm']=='mpRadon' ]['time'].to_numpy()
+        timeDrew = self._getRows(windowSize, roi, algorithm)['time'].to_numpy()
         return timeDrew
+
+    def getWindowSizes(self, algorithm : str = 'mpRadon') -> list:
+        """Get the window sizes in the analysis, see analyzeFlowWithRadon().
+
+        Older analysis without a 'windowSize' column returns [].
+        """
+        if self._df is None or 'windowSize' not in self._df.columns:
+            return []
+        df = self._df[ self._df['algorithm']==algorithm ]
+        return [int(w) for w in pd.unique(df['windowSize'])]
+
+    def getRoiNames(self, algorithm : str = 'mpRadon') -> list:
+        """Get the roi names in the analysis, see analyzeFlowWithRadon().
+
+        Older analysis without a 'roi' column returns [].
+        """
+        if self._df is None or 'roi' not in self._df.columns:
+            return []
+        df = self._df[ self._df['algorithm']==algorithm ]
+        return [str(roi) for roi in pd.unique(df['roi'])]
+
+    def getAlgorithms(self) -> list:
+        """Get the algorithms in the analysis, e.g. ['mpRadon', 'lspiv'].
+        """
+        if self._df is None:
+            return []
+        return [str(algorithm) for algorithm in pd.unique(self._df['algorithm'])]
+
+    def _getRows(self, windowSize : int = None, roi : str = None,
+                    algorithm : str = 'mpRadon') -> pd.DataFrame:
+        """Get the rows of one algorithm for one window size and roi.
+
+        Args:
+            windowSize: If None, the first window size analyzed.
+                Older analysis (no 'windowSize' column) has one window size.
+            roi: If None, the first roi analyzed.
+                Older analysis (no 'roi' column) has one roi.
+            algorithm: The 'algorithm' column
+        """
+        df = self._df[ self._df['algorithm']==algorithm ]
+        if 'roi' in df.columns and len(df) > 0:
+            if roi is None:
+                roi = df['roi'].iloc[0]
+            df = df[ _isValue(df['roi'], roi) ]
+        if 'windowSize' in df.columns and len(df) > 0:
+            if windowSize is None:
+                windowSize = df['windowSize'].iloc[0]
+            df = df[ _isValue(df['windowSize'], windowSize) ]
+        return df
         
     #def getReport(self, removeOutliers=True, removeZeros=True, medianFilter=0) -> dict:
     def getReport(self, removeOutliers=True,
                     medianFilter=5,
                     startSec=None,
-                    stopSec=None) -> dict:
+                    stopSec=None,
+                    windowSize=None,
+                    roi=None,
+                    algorithm='mpRadon') -> dict:
         """
+        Args:
+            windowSize: If None, the first window size analyzed, see getWindowSizes()
+            roi: If None, the first roi analyzed, see getRoiNames()
+            algorithm: The 'algorithm' column, e.g. 'mpRadon', see kymFlowEngines.getEngineNames()
         """
 
         # image intensity stats
-        tifData = self._tifData
-        meanInt = np.mean(tifData)
-        minInt = np.min(tifData)
-        maxInt = np.max(tifData)
+        meanInt, minInt, maxInt = self._getIntensityStats()
         rangeInt = maxInt - minInt  # new 20230125
 
         # refine analysis per file
@@ -318,21 +539,25 @@ class kymFlowFile():
         #     oneDf = oneDf[ (oneDf['time'] >= minTime) & (oneDf['time'] <= maxTime)]  # seconds
 
         # count the number of nan in original analysis (nan is from tan of 1e6 or 0)
-        velRaw = self.getVelocity(removeOutliers=False, medianFilter=0, startSec=startSec, stopSec=stopSec)
+        velRaw = self.getVelocity(removeOutliers=False, medianFilter=0, startSec=startSec, stopSec=stopSec,
+                                        windowSize=windowSize, roi=roi, algorithm=algorithm)
         nNanTan = np.count_nonzero(np.isnan(velRaw))
 
         vel_no_zero = self.getVelocity(removeZero=True, removeOutliers=True, medianFilter=medianFilter,
-                                        startSec=startSec, stopSec=stopSec)
+                                        startSec=startSec, stopSec=stopSec,
+                                        windowSize=windowSize, roi=roi, algorithm=algorithm)
         meanVelNoZero = np.nanmean(vel_no_zero)
 
         vel_no_abs = self.getVelocity(removeOutliers=removeOutliers, medianFilter=medianFilter, absValue=False,
-                                        startSec=startSec, stopSec=stopSec)
+                                        startSec=startSec, stopSec=stopSec,
+                                        windowSize=windowSize, roi=roi, algorithm=algorithm)
         meanVel_no_abs = np.nanmean(vel_no_abs)
         signMeanVel = np.sign(meanVel_no_abs)
 
 
         vel = self.getVelocity(removeOutliers=removeOutliers, medianFilter=medianFilter,
-                                    startSec=startSec, stopSec=stopSec)
+                                    startSec=startSec, stopSec=stopSec,
+                                        windowSize=windowSize, roi=roi, algorithm=algorithm)
 
         # count the number of zeros and set them to nan
         # Jan 2023, now that we remove both tan 1e6 and 0, we should never have zeros
@@ -369,6 +594,35 @@ class kymFlowFile():
 
         nNanOutliers = nNanFinal - nNanTan
     
+        # number of angles evaluated per window, older analysis does not have this column
+        df = self._getRows(windowSize, roi, algorithm)
+        if 'nAngles' in df.columns and np.any(~np.isnan(df['nAngles'])):
+            meanAngles = round(np.nanmean(df['nAngles']), 1)
+        else:
+            meanAngles = float('nan')
+
+        # number of dark/blank windows skipped before radon, older analysis does not have this column
+        # rows of other engines are nan, and the column is object after loadAnalysis()
+        if 'skipped' in df.columns:
+            nSkipped = int(df['skipped'].fillna(False).astype(bool).sum())
+        else:
+            nSkipped = 0
+
+        if 'windowSize' in df.columns and len(df) > 0:
+            reportWindowSize = df['windowSize'].iloc[0]
+        else:
+            reportWindowSize = float('nan')
+
+        # roi of this report, older analysis does not have these columns
+        if 'roi' in df.columns and len(df) > 0:
+            reportRoi = df['roi'].iloc[0]
+            reportStartPixel = df['startPixel'].iloc[0]
+            reportStopPixel = df['stopPixel'].iloc[0]
+        else:
+            reportRoi = ''
+            reportStartPixel = float('nan')
+            reportStopPixel = float('nan')
+
         # make a column with parentFolder+'/'+file
         parentFolder = analyzeflow.kymFlowUtil._getFolderName(self._tifPath)
 
@@ -379,6 +633,7 @@ class kymFlowFile():
             'parentFolder': parentFolder,  # for Declan this is date
             'file': self.getFileName(),
             'uniqueFile': parentFolder + '/' + self.getFileName(),
+            'algorithm': algorithm,
 
             'pntsPerLine': self.pntsPerLine(),
             'numLines': self.numLines(),
@@ -411,6 +666,12 @@ class kymFlowFile():
             'percentNanFinal': round(nNanFinal / nTotal * 100, 2),
             'percentGoodFinal': round(nNonNan / nTotal * 100, 2),
             'nZero': numZeros,  # added 20230125, will have 0 when (i) the image goes dark or (2) there is actually no flow
+            'meanAngles': meanAngles,  # mean number of radon angles evaluated per window, nan for older analysis
+            'nSkipped': nSkipped,  # number of dark/blank windows skipped (nan) before radon
+            'windowSize': reportWindowSize,  # window size of this report, nan for older analysis
+            'roi': reportRoi,  # roi of this report, '' for older analysis
+            'startPixel': reportStartPixel,
+            'stopPixel': reportStopPixel,
             
             'aStartSec': startSec,
             'aStopSec': stopSec,
@@ -503,11 +764,27 @@ class kymFlowFile():
         else:
             header = 1
 
-        self._df = pd.read_csv(loadFilePath, header=header)
+        self._df = pd.read_csv(loadFilePath, header=header, dtype={'roi': str})
 
         if 'Unnamed: 0' in self._df.columns:
             self._df = self._df.drop(columns=['Unnamed: 0'])
 
+        # older analysis has one roi and window size, no 'roi'/'windowSize' columns
+        if 'roi' in self._df.columns or 'windowSize' in self._df.columns:
+            self._df = _fillLegacyColumns(self._df)
+
+        # restore the rois that were analyzed, rows of third-party engines
+        # may not have (or have nan) startPixel/stopPixel
+        if 'roi' in self._df.columns:
+            for roi, roiDf in self._df.groupby('roi', sort=False):
+                if roi == defaultRoiName:
+                    continue
+                try:
+                    self._rois[str(roi)] = (int(roiDf['startPixel'].iloc[0]),
+                                            int(roiDf['stopPixel'].iloc[0]))
+                except (KeyError, TypeError, ValueError):
+                    logger.warning(f'roi "{roi}" has no startPixel/stopPixel, not restored')
+
     def loadMatlabAnalysis(self):
         csvFile = analyzeflow.kymFlowUtil._getCsvFile(self._tifPath)
         if os.path.isfile(csvFile):
@@ -0,0 +1,143 @@
+"""
+Optional Numba-compiled Radon-variance kernel, see mpAnalyzeFlow(engine='numba').
+
+The variance of each projection is computed in one fused loop per (window, angle).
+Each rotated row is summed into one projection of length N and reduced to its
+variance, the (N, nAngles) sinogram of skimage radon() is never allocated.
+
+The rotation (bilinear, zero padding) is the same as skimage radon(circle=False),
+see kymFlowRadon._buildRadonOperator().
+
+Numba is optional. If it is not installed, hasNumba() is False and
+kymFlowRadon falls back to the skimage engine.
+"""
+
+import numpy as np
+
+from analyzeflow import get_logger
+logger = get_logger(__name__)
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def hasNumba() -> bool:
+    """True if numba is installed and the kernel is compiled.
+    """
+    return numba is not None
+
+def _radonGeometry(shape : tuple):
+    """Padding and size of the rotated image in skimage radon(circle=False).
+
+    Return:
+        N: Size of the (square) padded image, number of bins in one projection
+        padBefore: (rows, cols) of zero padding before the window
+    """
+    diagonal = np.sqrt(2) * max(shape)
+    pad = [int(np.ceil(diagonal - s)) for s in shape]
+    new_center = [(s + p) // 2 for s, p in zip(shape, pad)]
+    old_center = [s // 2 for s in shape]
+    padBefore = [nc - oc for oc, nc in zip(old_center, new_center)]
+    N = shape[0] + pad[0]
+    return N, padBefore
+
+def _rowRange(slope, offset, size, N):
+    """Rows y in [0, N) where -1 < offset + slope*y < size, padded by one row.
+    """
+    if abs(slope) < 1e-12:
+        if -1 < offset < size:
+            return 0, N
+        return 0, 0
+    y0 = (-1 - offset) / slope
+    y1 = (size - offset) / slope
+    if y0 > y1:
+        y0, y1 = y1, y0
+    return max(0, int(np.floor(y0)) - 1), min(N, int(np.ceil(y1)) + 2)
+
+def _spreadKernel(windows, angles, N, padBefore0, padBefore1, out):
+    """Variance of the Radon projections of each window at its angles.
+
+    Compiled once per dtype of windows (float64 or float32). The projections
+    and variances are in that dtype, the bilinear weights are float64.
+
+    Args:
+        windows: (nWindows, H, W) float64 or float32, mean subtracted
+        angles: (nWindows, nAngles) in degrees
+        N, padBefore0, padBefore1: See _radonGeometry()
+        out: (nWindows, nAngles) same dtype as windows, the variances
+    """
+    nWindows, H, W = windows.shape
+    nAngles = angles.shape[1]
+    center = N // 2
+    projection = np.zeros(N, dtype=windows.dtype)
+    for k in range(nWindows):
+        for a in range(nAngles):
+            _angle = np.deg2rad(angles[k, a])
+            cos_a = np.cos(_angle)
+            sin_a = np.sin(_angle)
+            # input coordinates of output (0, 0), see _buildRadonOperator()
+            xOffset = -center*(cos_a + sin_a - 1) - padBefore1
+            yOffset = -center*(cos_a - sin_a - 1) - padBefore0
+            for x in range(N):
+                p = 0.0
+                # only the rows y of the rotated image that sample the window
+                yStart, yStop = _rowRange(sin_a, cos_a*x + xOffset, W, N)
+                _yStart, _yStop = _rowRange(cos_a, -sin_a*x + yOffset, H, N)
+                yStart = max(yStart, _yStart)
+                yStop = min(yStop, _yStop)
+                for y in range(yStart, yStop):
+                    xIn = cos_a*x + sin_a*y + xOffset
+                    yIn = -sin_a*x + cos_a*y + yOffset
+                    x0 = int(np.floor(xIn))
+                    y0 = int(np.floor(yIn))
+                    if x0 < -1 or x0 >= W or y0 < -1 or y0 >= H:
+                        continue
+                    fx = xIn - x0
+                    fy = yIn - y0
+                    if y0 >= 0:
+                        if x0 >= 0:
+                            p += (1-fy)*(1-fx) * windows[k, y0, x0]
+                        if x0+1 < W:
+                            p += (1-fy)*fx * windows[k, y0, x0+1]
+                    if y0+1 < H:
+                        if x0 >= 0:
+                            p += fy*(1-fx) * windows[k, y0+1, x0]
+                        if x0+1 < W:
+                            p += fy*fx * windows[k, y0+1, x0+1]
+                projection[x] = p
+            # two pass variance, same as np.var()
+            mean = 0.0
+            for x in range(N):
+                mean += projection[x]
+            mean /= N
+            var = 0.0
+            for x in range(N):
+                var += (projection[x] - mean)**2
+            out[k, a] = var / N
+
+if numba is not None:
+    # nogil so the 'thread' backend runs kernels in parallel
+    _rowRange = numba.njit(cache=True, nogil=True)(_rowRange)
+    _spreadKernel = numba.njit(cache=True, nogil=True)(_spreadKernel)
+
+def numbaSpread(windows : np.ndarray, angles : np.ndarray) -> np.ndarray:
+    """Variance of the Radon projections, same as np.var(radon(window, angles), axis=0).
+
+    Args:
+        windows: (nWindows, H, W), mean subtracted. float32 windows are computed
+            in float32 (see mpAnalyzeFlow(precision=)), others in float64
+        angles: (nAngles,) for all windows or (nWindows, nAngles) in degrees
+
+    Return:
+        (nWindows, nAngles) in the dtype of the computation
+    """
+    nWindows = windows.shape[0]
+    dtype = np.float32 if windows.dtype == np.float32 else np.float64
+    angles = np.ascontiguousarray(np.broadcast_to(angles, (nWindows, np.shape(angles)[-1])),
+                                    dtype=np.float64)
+    N, padBefore = _radonGeometry(windows.shape[1:])
+    out = np.zeros(angles.shape, dtype=dtype)
+    _spreadKernel(np.ascontiguousarray(windows, dtype=dtype), angles,
+                    N, padBefore[0], padBefore[1], out)
+    return out
@@ -9,104 +9,190 @@ Implementing MultiProcessing version of this. mp version takes 15 versus normal
 Now 80 down to 11 seconds !!!
 """
 
+import collections
+import functools
 import math
+import mmap
 import os
 import sys
+import threading
 import time
+import warnings
 import numpy as np
+import scipy.fft
+import scipy.sparse
 from skimage.transform import radon
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
 
 from analyzeflow import get_logger
 logger = get_logger(__name__)
 
-def old_non_mp_analyzeFlow(data : np.ndarray, windowsize : int):
-    """Original Radon algorithm (slow)
-    See: mpAnalyzeFlow().
-    """
-    startSec = time.time()
-    
-    stepsize = .25 * windowsize
-    stepsize = int(stepsize)
-
-    nlines = data.shape[0]
-    npoints = data.shape[1]
-    nsteps = math.floor(nlines/stepsize)-3
-    
-    # print(' .   windowsize:', windowsize)
-    # print(' .   stepsize:', stepsize)
-    # print(' .   nlines:', nlines)
-    # print(' .   npoints:', npoints)
-    # print(' .   nsteps:', nsteps)
-
-    # find the edges
-    angles = np.arange(180)
-    #print(' .   angles:', angles.shape, len(angles))
-
-    _step = 0.25
-    angles_fine= np.arange(-2, 2+_step, _step)  # [start, stop), step
-    #print(' .   angles_fine:', angles_fine.shape, len(angles_fine))
-
-    spread_matrix = np.zeros( (nsteps,len(angles)) )
-    spread_matrix_fine = np.zeros( (nsteps,len(angles_fine)) )
-    #thetas = np.zeros( (nsteps,1) )
-    thetas = np.zeros(nsteps)
+from analyzeflow.kymFlowNumba import hasNumba, numbaSpread
+from analyzeflow.kymFlowStructureTensor import structureTensorWindowSums, tensorOrientation
 
-    #hold_matrix = np.ones( (windowsize,npoints) )
-    # blank_matrix = np.ones( (nsteps,len(angles)) )
-    the_t = np.ones(nsteps) * float('nan')
+def _initWorker():
+    """Initialize one worker process of a kymFlowExecutor.
 
-    # print(' .   spread_matrix:', spread_matrix.shape)
-    # print(' .   spread_matrix_fine:', spread_matrix_fine.shape)
-    # print(' .   thetas:', thetas.shape)
-    # print(' .   the_t:', the_t.shape)
-
-    doDebug = False
-    if doDebug:
-        nsteps = 100 # debug
-    
-    print(f'analyzeFlow() for tif data {tifData.shape}, nsteps: {nsteps}')
-    print(' . THIS IS SUPER SLOW !!!')
+    Import the heavy modules once per worker rather than on first task.
+    """
+    import numpy
+    import skimage.transform
 
-    for k in range(nsteps):
-        if doDebug: print(' .   k:', k, 'of', nsteps)
+# see kymFlowExecutor(backend=)
+executorBackends = ('process', 'thread', 'serial')
 
-        the_t[k] = 1 + k*stepsize + windowsize/2
+def _defaultNumWorkers(backend : str = 'process') -> int:
+    """Default number of workers, at least 1.
 
-        _start = k * stepsize
-        _stop = k * stepsize + windowsize
-        data_hold = data[_start:_stop,:]
-        
-        # subtract the mean
-        _mean = np.mean(data_hold[:])
-        data_hold = data_hold - _mean # * hold_matrix
-        
-        radon_hold = radon(data_hold, theta=angles, circle=False) # radon_hold will be (windowSize, num angles))
-                
-        #take variance (one variance per column)
-        _var = np.var(radon_hold, axis=0)
-        spread_matrix[k,:] = _var
-
-        # find max variace
-        the_theta = np.argmax(spread_matrix[k,:])
-        thetas[k]= angles[the_theta]     
-        
-        # re-do radon with finer increments around first estimate of the maximum
-        _fineAngles = thetas[k]+angles_fine
-        radon_hold_fine = radon(data_hold, theta=_fineAngles, circle=False)
+    os.cpu_count()-1 processes (leave one for the main process), os.cpu_count()
+    threads (the main thread only waits), 1 for serial.
+    """
+    if backend == 'serial':
+        return 1
+    numCpu = os.cpu_count() or 1
+    if backend == 'thread':
+        return numCpu
+    return max(1, numCpu - 1)
+
+class _futureResult():
+    """Give a concurrent.futures.Future the get() of a multiprocessing AsyncResult.
+    """
+    def __init__(self, future):
+        self._future = future
 
-        _var = np.var(radon_hold_fine, axis=0)
-        spread_matrix_fine[k,:] = _var
-        the_theta = np.argmax(spread_matrix_fine[k,:])
+    def get(self, timeout : float = None):
+        return self._future.result(timeout)
 
-        thetas[k] = thetas[k] + angles_fine[the_theta]
-    
-    #thetas=thetas-90; %rotate
+class _serialResult():
+    """Result of a task already run in this thread, see kymFlowExecutor(backend='serial').
+    """
+    def __init__(self, func, args : tuple):
+        self._value = None
+        self._exception = None
+        try:
+            self._value = func(*args)
+        except Exception as e:
+            self._exception = e
+
+    def get(self, timeout : float = None):
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+class kymFlowExecutor():
+    """Long-lived pool of workers to analyze many kymographs.
+
+    mpAnalyzeFlow() used to create (and tear down) a new multiprocessing.Pool
+    for every kymograph. Create one kymFlowExecutor and share it across
+    files to only pay for process spawn and module import once.
+
+    Backends:
+        'process': multiprocessing.Pool, tasks and results are pickled
+        'thread': concurrent.futures.ThreadPoolExecutor, no spawn, no pickle,
+            no copy of the data. NumPy, scipy and skimage release the GIL in
+            their C loops. Use this from a GUI where forking Qt is fragile.
+        'serial': run each task in apply_async(), no workers
+
+    Example:
+        with kymFlowExecutor() as executor:
+            for tifPath in tifList:
+                kff = kymFlowFile(tifPath)
+                kff.analyzeFlowWithRadon(executor=executor)
+    """
+    def __init__(self, numWorkers : int = None, backend : str = 'process'):
+        """
+        Args:
+            numWorkers: Number of workers, default is _defaultNumWorkers()
+            backend: One of executorBackends
+        """
+        if backend not in executorBackends:
+            raise ValueError(f'backend must be one of {list(executorBackends)}, got "{backend}"')
+
+        if numWorkers is None:
+            numWorkers = _defaultNumWorkers(backend)
+        numWorkers = max(1, numWorkers)
+        if backend == 'serial':
+            numWorkers = 1
+
+        self._numWorkers = numWorkers
+        self._backend = backend
+
+        if backend == 'process':
+            # workers share our resource tracker, o.w. each worker attaching to
+            # shared memory starts its own and reports it as leaked
+            resource_tracker.ensure_running()
+            self._pool = Pool(processes=numWorkers, initializer=_initWorker)
+        elif backend == 'thread':
+            self._pool = ThreadPoolExecutor(max_workers=numWorkers,
+                                            thread_name_prefix='kymFlow')
+        else:
+            self._pool = 'serial'  # no pool, not None while running
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # on error, do not wait for pending tasks
+        self.shutdown(wait=exc_type is None)
+
+    @property
+    def numWorkers(self) -> int:
+        return self._numWorkers
+
+    @property
+    def backend(self) -> str:
+        return self._backend
+
+    def isRunning(self) -> bool:
+        return self._pool is not None
+
+    def apply_async(self, func, args : tuple = ()):
+        """Submit one task, return an object with get() like a multiprocessing AsyncResult.
+        """
+        if self._pool is None:
+            raise RuntimeError('kymFlowExecutor has been shut down')
+        if self._backend == 'process':
+            return self._pool.apply_async(func, args)
+        elif self._backend == 'thread':
+            return _futureResult(self._pool.submit(func, *args))
+        return _serialResult(func, args)
+
+    def shutdown(self, wait : bool = True):
+        """Stop all workers.
+
+        Args:
+            wait: If True, wait for pending tasks to finish, otherwise terminate
+                them (threads can not be terminated, pending tasks are cancelled)
+        """
+        if self._pool is None:
+            return
+        if self._backend == 'process':
+            if wait:
+                self._pool.close()
+            else:
+                self._pool.terminate()
+            self._pool.join()
+        elif self._backend == 'thread':
+            self._pool.shutdown(wait=wait, cancel_futures=not wait)
+        self._pool = None
+
+def serialAnalyzeFlow(data : np.ndarray,
+                        windowsize : int,
+                        startPixel : int = None,
+                        stopPixel : int = None,
+                        **kwargs):
+    """Original Radon algorithm in this process, no worker processes.
+
+    Same result as mpAnalyzeFlow(), see tests/test_kymFlow.py.
 
-    stopSec = time.time()
-    print('analyzeFlow took', round(stopSec-startSec,3), 'seconds')
-    
-    return thetas,the_t,spread_matrix
+    Args:
+        kwargs: Passed to mpAnalyzeFlow(), e.g. engine='sparse'
+    """
+    return mpAnalyzeFlow(data, windowsize, startPixel=startPixel, stopPixel=stopPixel,
+                            backend='serial', **kwargs)
 
 #def radonWorker(k, data, stepsize, windowsize, angles, angles_fine):
 def radonWorker(data_hold, angles, angles_fine):
@@ -163,20 +249,1375 @@ def radonWorker(data_hold, angles, angles_fine):
     # return all worker_ variables
     #return worker_thetas, worker_spread_matrix
     return worker_thetas, worker_spread_matrix_fine
-    
+
+# shared memory blocks attached in this (worker) process, see _attachSharedKymograph()
+_workerSharedMemory = {}
+
+def _toSharedMemory(data : np.ndarray) -> shared_memory.SharedMemory:
+    """Copy a kymograph into a new shared memory block.
+
+    Caller is responsible for close() and unlink().
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+    sharedData = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+    sharedData[:] = data
+    return shm
+
+def _attachSharedKymograph(shmName : str, shape : tuple, dtype : str) -> np.ndarray:
+    """Get a zero-copy view of a kymograph in shared memory.
+
+    Called in worker processes. Only the most recent kymograph stays attached,
+    previous ones are closed.
+    """
+    shm = _workerSharedMemory.get(shmName)
+    if shm is None:
+        for _name in list(_workerSharedMemory.keys()):
+            _workerSharedMemory.pop(_name).close()
+        shm = shared_memory.SharedMemory(name=shmName)
+        _workerSharedMemory[shmName] = shm
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+# worker process cache of the most recent memory-mapped kymograph
+_workerMemmap = {}
+
+def _memmapParams(data : np.ndarray):
+    """Get (filename, dtype, shape, offset) if data is a whole memory-mapped file.
+
+    For example from tifffile.memmap(). Slices of a memmap return None,
+    their offset is not updated by numpy.
+    """
+    if not isinstance(data, np.memmap) or not isinstance(data.base, mmap.mmap):
+        return None
+    if data.filename is None or not data.flags.c_contiguous:
+        return None
+    return (data.filename, data.dtype.str, data.shape, data.offset)
+
+def _attachMemmap(filename : str, dtype : str, shape : tuple, offset : int) -> np.ndarray:
+    """Memory-map a kymograph file (read only) in a worker process.
+
+    Only the lines of a block are read from disk when it is used.
+    Only the most recent file stays mapped.
+    """
+    key = (filename, dtype, shape, offset)
+    data = _workerMemmap.get(key)
+    if data is None:
+        _workerMemmap.clear()
+        data = np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+        _workerMemmap[key] = data
+    return data
+
+def _getWindows(block : np.ndarray, windowsize : int, stepsize : int) -> np.ndarray:
+    """Get a (nWindows, windowsize, npoints) view of all sliding windows in block.
+
+    No data is copied.
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(block, windowsize, axis=0)
+    windows = windows[::stepsize]  # (nWindows, npoints, windowsize)
+    return np.moveaxis(windows, -1, 1)
+
+def _chunkBounds(kStart : int, kStop : int, stepsize : int, windowsize : int):
+    """Get the lines [start, stop) spanned by windows [kStart, kStop).
+    """
+    return kStart * stepsize, (kStop-1) * stepsize + windowsize
+
+def _radonLength(shape : tuple) -> int:
+    """Number of bins in one projection of skimage radon(circle=False).
+    """
+    diagonal = np.sqrt(2) * max(shape)
+    return shape[0] + int(np.ceil(diagonal - shape[0]))
+
+def _fourierPowerSpectra(windows : np.ndarray, oversample : int = 4):
+    """2-D power spectrum of each mean-subtracted window.
+
+    Windows are zero padded to (M, M) so projections do not wrap around.
+    Padding more than 2x finely samples the spectrum, this reduces the
+    error of interpolating it along radial lines. Windows are real so only
+    the non-negative spatial frequencies are kept (rfft2).
+
+    Args:
+        windows: (nWindows, windowsize, npoints)
+        oversample: M is oversample * max(windowsize, npoints)
+
+    Return:
+        power: (nWindows, M, M//2+1), axis 1 is time and axis 2 is space frequency
+        M: Size of the padded FFT
+    """
+    M = scipy.fft.next_fast_len(oversample * max(windows.shape[1:]))
+    _mean = np.mean(windows, axis=(1,2), keepdims=True)
+    spectra = scipy.fft.rfft2(windows - _mean, s=(M, M), axes=(1,2))
+    power = spectra.real**2 + spectra.imag**2
+    return power, M
+
+def _radialLineWeights(M : int, angles : np.ndarray):
+    """Bilinear interpolation of radial lines in a half plane (M, M//2+1) power spectrum.
+
+    Sample k along the line at angle theta is at frequency
+    (-sin(theta)*k, cos(theta)*k) for k in [-M/2, M/2), same convention as radon().
+    Samples with negative spatial frequency use power[-f] == power[f].
+
+    Args:
+        angles: (..., nAngles) in degrees
+
+    Return:
+        flatIdx: (..., nAngles, M, 4) index into power.reshape(-1, M*(M//2+1))
+        weights: (..., nAngles, M, 4)
+    """
+    nHalf = M//2 + 1
+    _rad = np.deg2rad(np.asarray(angles, dtype=float))[..., None]
+    k = np.arange(-(M//2), M - M//2)
+    kr = -np.sin(_rad) * k
+    kc = np.cos(_rad) * k
+    flip = kc < 0
+    kr = np.where(flip, -kr, kr)
+    kc = np.where(flip, -kc, kc)
+
+    r0 = np.floor(kr)
+    c0 = np.floor(kc)
+    fr = (kr - r0)[..., None]
+    fc = (kc - c0)[..., None]
+    r0 = r0.astype(int)[..., None]
+    c0 = c0.astype(int)[..., None]
+
+    rows = (r0 + np.array([0, 0, 1, 1])) % M  # unshifted, negative time frequency wraps
+    cols = np.minimum(c0 + np.array([0, 1, 0, 1]), nHalf-1)  # only clipped with 0 weight
+    weights = np.concatenate([(1-fr)*(1-fc), (1-fr)*fc, fr*(1-fc), fr*fc], axis=-1)
+    return rows*nHalf + cols, weights
+
+def _fourierSpread(power : np.ndarray, M : int, N : int, angles : np.ndarray) -> np.ndarray:
+    """Variance of Radon projections read off the power spectrum.
+
+    By the projection-slice theorem the 1-D FFT of the projection at angle
+    theta is the 2-D FFT of the window along a radial line at theta. By
+    Parseval, sum(p**2) is the sum of the power along that line (over M).
+    The windows are mean subtracted so sum(p) is 0 and var(p) = sum(p**2)/N.
+
+    Args:
+        power: (nWindows, M, M//2+1) from _fourierPowerSpectra()
+        M: Size of the padded FFT
+        N: Number of bins in one projection, see _radonLength()
+        angles: (nAngles,) or (nWindows, nAngles) in degrees, same convention as radon()
+
+    Return:
+        (nWindows, nAngles)
+    """
+    nWindows = power.shape[0]
+    angles = np.broadcast_to(angles, (nWindows, np.shape(angles)[-1]))
+    flatIdx, weights = _radialLineWeights(M, angles)
+    power = power.reshape(nWindows, -1)
+    windowIdx = np.arange(nWindows)[:, None, None, None]
+    lines = power[windowIdx, flatIdx] * weights
+    return lines.sum(axis=(2,3)) / (M * N)
+
+@functools.lru_cache(maxsize=8)
+def _getFourierLineOperator(M : int, N : int, angles : tuple):
+    """Sparse matrix summing a half plane power spectrum along radial lines.
+
+    (S @ power.ravel()) is _fourierSpread(power, M, N, angles) for one window,
+    the interpolation weights are computed once per (M, N, angles).
+
+    Return:
+        S: scipy.sparse.csr_matrix (nAngles, M*(M//2+1))
+    """
+    flatIdx, weights = _radialLineWeights(M, np.asarray(angles))
+    angleIdx = np.broadcast_to(np.arange(len(angles))[:, None, None], flatIdx.shape)
+    S = scipy.sparse.csr_matrix((weights.ravel() / (M * N),
+                                    (angleIdx.ravel(), flatIdx.ravel())),
+                                    shape=(len(angles), M*(M//2+1)))
+    return S
+
+# angle search strategies for mpAnalyzeFlow(angleSearch=), a list of (step, halfWidth) in degrees.
+# The first level is a full sweep of [0, 180) (halfWidth is None), each next level
+# searches +/- halfWidth around the best angle of the previous level.
+angleSearchPresets = {
+    'exhaustive': [(1, None), (0.25, 2)],  # original algorithm, 180 + 17 angles
+    'hierarchical': [(4, None), (1, 4), (0.25, 2)],  # 45 + 9 + 17 angles
+}
+
+def _getAngleLevels(angleSearch) -> list:
+    """Get the list of (step, halfWidth) from a preset name or a list.
+    """
+    if isinstance(angleSearch, str):
+        if angleSearch not in angleSearchPresets.keys():
+            raise ValueError(f'angleSearch must be one of {list(angleSearchPresets.keys())}, got "{angleSearch}"')
+        return angleSearchPresets[angleSearch]
+    levels = [tuple(level) for level in angleSearch]
+    if len(levels) == 0 or levels[0][1] is not None:
+        raise ValueError('the first level of angleSearch must be a full sweep, e.g. (1, None)')
+    return levels
+
+def _lastLevelSize(levels : list) -> int:
+    """Number of angles in the last level of an angle search.
+    """
+    step, halfWidth = levels[-1]
+    if halfWidth is None:
+        return len(np.arange(0, 180, step))
+    return len(np.arange(-halfWidth, halfWidth+step, step))
+
+def _searchAngles(spreadFn, nWindows : int, levels : list):
+    """Coarse to fine search for the angle with the max projection variance.
+
+    Args:
+        spreadFn: spreadFn(angles) -> (nWindows, nAngles) variance of the projections,
+            angles is (nAngles,) for all windows or (nWindows, nAngles).
+            spreadFn(angles, index) -> (nAngles,) is for the one window at index.
+        levels: See angleSearchPresets
+
+    Return:
+        thetas: (nWindows,)
+        spread: (nWindows, nAngles) of the last level
+        nAngles: (nWindows,) number of angles evaluated per window
+    """
+    thetas = None
+    nAngles = 0
+    for step, halfWidth in levels:
+        if halfWidth is None:
+            angles = np.arange(0, 180, step)
+            spread = spreadFn(angles)
+            thetas = angles[np.argmax(spread, axis=1)]
+        else:
+            offsets = np.arange(-halfWidth, halfWidth+step, step)
+            spread = spreadFn(thetas[:, None] + offsets[None, :])
+            thetas = thetas + offsets[np.argmax(spread, axis=1)]
+        nAngles += spread.shape[1]
+    return thetas, spread, np.full(nWindows, nAngles)
+
+# tracking mode, fall back to a full sweep when the peak in the band around
+# the prior is weaker than this, (max-min)/max of the projection variance
+trackingMinContrast = 0.1
+
+def _trackAngles(spreadFn, nWindows : int, levels : list,
+                    halfWidth : float, prior : float = None):
+    """Angle search seeded by the angle of the previous window.
+
+    The full sweep (first level) is replaced by a band of +/- halfWidth around
+    the prior, on the same grid. If the band peak is on the band edge or is weak
+    (see trackingMinContrast), or there is no prior, do the full sweep.
+    The next levels are the same as _searchAngles().
+    Windows are sequential, each window is the prior of the next one.
+
+    Args:
+        prior: Angle of the window before the first one, None for no prior
+
+    Return:
+        Same as _searchAngles()
+    """
+    step = levels[0][0]
+    fullAngles = np.arange(0, 180, step)
+    bandOffsets = np.arange(-halfWidth, halfWidth+step, step)
+
+    thetas = np.zeros(nWindows)
+    spread = np.zeros((nWindows, _lastLevelSize(levels)))
+    nAngles = np.zeros(nWindows, dtype=int)
+    for k in range(nWindows):
+        theta = None
+        if prior is not None:
+            # snap to the full sweep grid so tracked and full sweeps agree
+            angles = (np.round(prior / step) * step + bandOffsets) % 180
+            _spread = spreadFn(angles, k)
+            nAngles[k] += len(angles)
+            peak = np.argmax(_spread)
+            _maxSpread = _spread[peak]
+            _contrast = (_maxSpread - np.min(_spread)) / _maxSpread if _maxSpread > 0 else 0
+            if 0 < peak < len(angles)-1 and _contrast >= trackingMinContrast:
+                theta = angles[peak]
+        if theta is None:
+            _spread = spreadFn(fullAngles, k)
+            nAngles[k] += len(fullAngles)
+            theta = fullAngles[np.argmax(_spread)]
+        for _step, _halfWidth in levels[1:]:
+            angles = theta + np.arange(-_halfWidth, _halfWidth+_step, _step)
+            _spread = spreadFn(angles, k)
+            nAngles[k] += len(angles)
+            theta = angles[np.argmax(_spread)]
+        thetas[k] = theta
+        spread[k] = _spread
+        prior = theta
+    return thetas, spread, nAngles
+
+def _searchBatch(spreadFn, nWindows : int, levels : list,
+                    trackingHalfWidth : float, previousResults : list):
+    """Search one batch, tracking continues from the last window of the previous batch.
+    """
+    if trackingHalfWidth is None:
+        return _searchAngles(spreadFn, nWindows, levels)
+    prior = previousResults[-1][0][-1] if previousResults else None
+    return _trackAngles(spreadFn, nWindows, levels, trackingHalfWidth, prior)
+
+def _runBatches(windows : np.ndarray, levels : list, batchSize : int, makeSpreadFn,
+                    trackingHalfWidth : float = None):
+    """Run _searchAngles() on consecutive batches of windows.
+
+    Args:
+        makeSpreadFn: makeSpreadFn(batchWindows) -> spreadFn, see _searchAngles()
+        trackingHalfWidth: If not None, use _trackAngles() with this band
+
+    Return:
+        Same as _searchAngles() for all windows
+    """
+    results = []
+    for _start in range(0, windows.shape[0], batchSize):
+        _windows = windows[_start:_start+batchSize]
+        spreadFn = makeSpreadFn(_windows)
+        results.append(_searchBatch(spreadFn, _windows.shape[0], levels,
+                                    trackingHalfWidth, results))
+    return tuple(np.concatenate(_result) for _result in zip(*results))
+
+# how to get sub-degree resolution, see mpAnalyzeFlow(refine=)
+refineMethods = ('sweep', 'parabola', 'gaussian')
+
+def _refinePeaks(thetas : np.ndarray, spread : np.ndarray, step : float,
+                    circular : bool, method : str = 'parabola'):
+    """Interpolate the peak of the variance curve, no extra projections.
+
+    Fit a parabola (or a Gaussian, a parabola to log(spread)) to the argmax
+    and its two neighbours.
+
+    Args:
+        thetas: (nWindows,) angle of the argmax of spread
+        spread: (nWindows, nAngles) variance at angles step degrees apart
+        step: Angle step of spread (degrees)
+        circular: If True then spread is a full sweep of [0, 180)
+            and the neighbours of the ends wrap around
+        method: 'parabola' or 'gaussian'
+
+    Return:
+        thetas: (nWindows,) refined (continuous) angle
+        curvature: (nWindows,) curvature of the fit at the peak (1/deg^2),
+            relative to the peak height for 'parabola' and 1/sigma^2 for 'gaussian'.
+            Larger is a sharper (more confident) peak. nan if the peak is on
+            the edge of a (non circular) spread.
+    """
+    nWindows, nAngles = spread.shape
+    peak = np.argmax(spread, axis=1)
+    rows = np.arange(nWindows)
+    if circular:
+        left = (peak - 1) % nAngles
+        right = (peak + 1) % nAngles
+        onEdge = np.zeros(nWindows, dtype=bool)
+    else:
+        onEdge = (peak == 0) | (peak == nAngles-1)
+        left = np.clip(peak - 1, 0, nAngles-1)
+        right = np.clip(peak + 1, 0, nAngles-1)
+    y = np.stack([spread[rows, left], spread[rows, peak], spread[rows, right]])
+    if method == 'gaussian':
+        y = np.log(np.maximum(y, np.finfo(float).tiny))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        secondDiff = y[0] - 2*y[1] + y[2]  # < 0 at a peak
+        offset = np.where(secondDiff < 0, 0.5 * (y[0] - y[2]) / secondDiff, 0)
+        curvature = -secondDiff / step**2
+        if method == 'parabola':
+            curvature = curvature / y[1]
+    offset[onEdge] = 0
+    curvature[onEdge] = float('nan')
+    return thetas + offset * step, curvature
+
+# compute precision, see mpAnalyzeFlow(precision=)
+precisions = ('float64', 'float32')
+
+def _computeDtype(windows : np.ndarray):
+    """Engines compute in the float dtype of the windows, float64 for integer windows.
+    """
+    if np.issubdtype(windows.dtype, np.floating):
+        return windows.dtype
+    return np.dtype(np.float64)
+
+def _meanSubtracted(windows : np.ndarray) -> np.ndarray:
+    """Copy of windows with the mean of each window subtracted.
+    """
+    return windows - np.mean(windows, axis=(1,2), keepdims=True)
+
+def _radonEngineSkimage(windows : np.ndarray, levels : list, batchSize : int = 64,
+                            trackingHalfWidth : float = None):
+    """Engine using skimage radon(), one window at a time, see radonWorker().
+
+    Args:
+        windows: (nWindows, windowsize, npoints)
+        levels: Angle search, see angleSearchPresets
+        trackingHalfWidth: If not None, seed each window from the previous one,
+            see _trackAngles()
+
+    Return:
+        thetas: (nWindows,)
+        spreadFine: (nWindows, nAngles) variance of the last search level
+        nAngles: (nWindows,) number of angles evaluated per window
+    """
+    def makeSpreadFn(_windows):
+        _windows = _meanSubtracted(_windows)
+        def spreadFn(angles, index=None):
+            if index is not None:
+                return np.var(radon(_windows[index], theta=angles, circle=False), axis=0)
+            angles = np.broadcast_to(angles, (len(_windows), np.shape(angles)[-1]))
+            return np.stack([np.var(radon(_window, theta=_angles, circle=False), axis=0)
+                                for _window, _angles in zip(_windows, angles)])
+        return spreadFn
+    return _runBatches(windows, levels, batchSize, makeSpreadFn, trackingHalfWidth)
+
+def _fourierSpreadFn(power : np.ndarray, M : int, N : int):
+    """Get a spreadFn for _searchAngles() from a batch of power spectra.
+
+    Angles shared by all windows use the cached _getFourierLineOperator(),
+    per window angles use _fourierSpread().
+    """
+    def spreadFn(angles, index=None):
+        if index is not None:
+            return _fourierSpread(power[index:index+1], M, N, angles)[0]
+        if np.ndim(angles) == 1:
+            S = _getFourierLineOperator(M, N, tuple(np.asarray(angles).tolist()))
+            return (S @ power.reshape(power.shape[0], -1).T).T
+        return _fourierSpread(power, M, N, angles)
+    return spreadFn
+
+def _radonEngineFourier(windows : np.ndarray, levels : list, batchSize : int = 16,
+                            trackingHalfWidth : float = None):
+    """Engine reading projection variance off the 2-D power spectrum.
+
+    No explicit projections, one batched FFT per batchSize windows.
+    All levels of the angle search are sampled on the same spectrum.
+    See _radonEngineSkimage() for args and return.
+
+    Compared to 'radon' on exampleData/drew_synthetic.tif (windowsize 16),
+    thetas differ by 0.5 deg (median) and 1.25 deg (95th percentile),
+    see sandbox/benchmarkEngines.py.
+    """
+    N = _radonLength(windows.shape[1:])
+    def makeSpreadFn(_windows):
+        power, M = _fourierPowerSpectra(_windows)
+        return _fourierSpreadFn(power, M, N)
+    return _runBatches(windows, levels, batchSize, makeSpreadFn, trackingHalfWidth)
+
+def _buildRadonOperator(shape : tuple, angles : tuple, dtype : str = 'float64'):
+    """Sparse matrix equivalent to skimage radon(circle=False) for one window shape.
+
+    Replicates the padding, rotation (bilinear warp) and column sums of
+    radon() so that (A @ window.ravel()).reshape(nAngles, N) is radon(window).T
+
+    Not cached, see _getRadonOperator() and _getAngleOperator().
+
+    Args:
+        shape: (windowsize, npoints)
+        angles: Tuple of angles in degrees
+        dtype: Of the operator, matches the windows so the matmul does not upcast
+
+    Return:
+        A: scipy.sparse.csr_matrix (nAngles*N, windowsize*npoints)
+        N: Number of bins in one projection
+    """
+    H, W = shape
+
+    # padding as in radon(circle=False)
+    diagonal = np.sqrt(2) * max(shape)
+    pad = [int(np.ceil(diagonal - s)) for s in shape]
+    new_center = [(s + p) // 2 for s, p in zip(shape, pad)]
+    old_center = [s // 2 for s in shape]
+    pad_before = [nc - oc for oc, nc in zip(old_center, new_center)]
+    N = H + pad[0]
+    center = N // 2
+
+    # output grid of the rotated (padded) image
+    y, x = np.mgrid[0:N, 0:N]
+    x = x.ravel()
+    y = y.ravel()
+
+    rows = []
+    cols = []
+    weights = []
+    for i, _angle in enumerate(np.deg2rad(angles)):
+        cos_a, sin_a = np.cos(_angle), np.sin(_angle)
+        # input coordinates in the (unpadded) window
+        xIn = cos_a*x + sin_a*y - center*(cos_a + sin_a - 1) - pad_before[1]
+        yIn = -sin_a*x + cos_a*y - center*(cos_a - sin_a - 1) - pad_before[0]
+        x0 = np.floor(xIn)
+        y0 = np.floor(yIn)
+        fx = xIn - x0
+        fy = yIn - y0
+        x0 = x0.astype(int)
+        y0 = y0.astype(int)
+        # bilinear interpolation, padding is 0 so only keep pixels in the window
+        for dy, dx, w in ((0, 0, (1-fy)*(1-fx)), (0, 1, (1-fy)*fx),
+                            (1, 0, fy*(1-fx)), (1, 1, fy*fx)):
+            _y = y0 + dy
+            _x = x0 + dx
+            keep = (_y >= 0) & (_y < H) & (_x >= 0) & (_x < W) & (w != 0)
+            rows.append(i*N + x[keep])  # sum over rows of the rotated image
+            cols.append(_y[keep]*W + _x[keep])
+            weights.append(w[keep])
+
+    A = scipy.sparse.csr_matrix((np.concatenate(weights),
+                                    (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=(len(angles)*N, H*W), dtype=dtype)
+    return A, N
+
+@functools.lru_cache(maxsize=8)
+def _getRadonOperator(shape : tuple, angles : tuple, dtype : str = 'float64'):
+    """Cached _buildRadonOperator() for angles shared by all windows (the full sweep).
+
+    Built once per (shape, angles) in each process, the LRU bound keeps
+    mixed-geometry batches from accumulating operators. Only full sweeps go
+    through this cache so per window angles never evict them.
+    """
+    return _buildRadonOperator(shape, angles, dtype)
+
+# memory bound of the _getAngleOperator() cache, bytes in each process (each
+# worker has its own). A block takes about 12 bytes per nonzero, e.g. 0.02 MB
+# for 16x40 windows and 3.5 MB for 128x1024 windows. With 128 MB up to
+# about 36 blocks of 128x1024 windows are kept, 1024 angles would take 3.5 GB.
+angleOperatorCacheBytes = 128 * 2**20
+
+# (shape, angle, dtype) to block, least recently used first
+_angleOperatorCache = collections.OrderedDict()
+_angleOperatorCacheNbytes = 0
+_angleOperatorCacheLock = threading.Lock()  # thread backend
+
+def _operatorNbytes(A : scipy.sparse.csr_matrix) -> int:
+    """Bytes of the arrays of a csr matrix.
+    """
+    return A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+
+def _getAngleOperator(shape : tuple, angle : float, dtype : str = 'float64'):
+    """Cached _buildRadonOperator() of a single angle, (N, windowsize*npoints).
+
+    Per window angles (next levels of the search) are stacked from these
+    blocks, fine angles around different coarse angles mostly overlap so a
+    block is built once and reused across groups and batches.
+    Least recently used blocks are evicted above angleOperatorCacheBytes,
+    the block just built is always kept.
+    """
+    global _angleOperatorCacheNbytes
+    key = (shape, angle, dtype)
+    with _angleOperatorCacheLock:
+        A = _angleOperatorCache.get(key)
+        if A is not None:
+            _angleOperatorCache.move_to_end(key)
+            return A
+    A = _buildRadonOperator(shape, (angle,), dtype)[0]
+    with _angleOperatorCacheLock:
+        if key not in _angleOperatorCache.keys():
+            _angleOperatorCache[key] = A
+            _angleOperatorCacheNbytes += _operatorNbytes(A)
+            while (_angleOperatorCacheNbytes > angleOperatorCacheBytes
+                    and len(_angleOperatorCache) > 1):
+                _, _A = _angleOperatorCache.popitem(last=False)
+                _angleOperatorCacheNbytes -= _operatorNbytes(_A)
+    return A
+
+def _getGroupOperator(shape : tuple, angles : tuple, dtype : str = 'float64'):
+    """Operator of one group of per window angles, stacked from _getAngleOperator().
+
+    Return:
+        A: scipy.sparse.csr_matrix (nAngles*N, windowsize*npoints)
+        N: Number of bins in one projection
+    """
+    blocks = [_getAngleOperator(shape, _angle, dtype) for _angle in angles]
+    return scipy.sparse.vstack(blocks, format='csr'), blocks[0].shape[0]
+
+def _sparseSpreadFn(windows : np.ndarray, groupOperators : bool):
+    """Get a spreadFn for _searchAngles() projecting with sparse Radon operators.
+
+    Angles shared by all windows are one sparse matmul with the cached
+    _getRadonOperator(). For per window angles, either use radon() on each
+    window or (groupOperators) group windows with the same angles and
+    project each group with an operator stacked from cached single angle
+    blocks, see _getGroupOperator().
+
+    Args:
+        windows: (nWindows, windowsize, npoints)
+    """
+    nWindows, windowsize, npoints = windows.shape
+    _windows = _meanSubtracted(windows)
+    X = _windows.reshape(nWindows, -1).T  # (windowsize*npoints, nWindows)
+
+    def _project(angles, columns, getOperator=_getRadonOperator):
+        A, N = getOperator((windowsize, npoints), tuple(np.asarray(angles).tolist()),
+                            X.dtype.name)
+        projections = (A @ X[:, columns]).reshape(len(angles), N, -1)
+        return np.var(projections, axis=1).T  # (nColumns, nAngles)
+
+    def spreadFn(angles, index=None):
+        if index is not None:
+            return np.var(radon(_windows[index], theta=angles, circle=False), axis=0)
+        if np.ndim(angles) == 1:
+            return _project(angles, slice(None))
+        spread = np.zeros(angles.shape, dtype=X.dtype)
+        if groupOperators:
+            _uniqueAngles, _inverse = np.unique(angles, axis=0, return_inverse=True)
+            for _idx, _angles in enumerate(_uniqueAngles):
+                _group = np.nonzero(_inverse.ravel() == _idx)[0]
+                spread[_group] = _project(_angles, _group, _getGroupOperator)
+        else:
+            for k in range(nWindows):
+                spread[k] = np.var(radon(_windows[k], theta=angles[k], circle=False), axis=0)
+        return spread
+    return spreadFn
+
+def _radonEngineSparse(windows : np.ndarray, levels : list, batchSize : int = 64,
+                            trackingHalfWidth : float = None):
+    """Engine projecting all windows with one cached sparse Radon operator.
+
+    The full sweep is one sparse-dense matmul per batchSize windows, see
+    _getRadonOperator(). Next levels (angles depend on each window) use radon().
+    Same result as 'radon', see _radonEngineSkimage() for args and return.
+    """
+    makeSpreadFn = lambda _windows: _sparseSpreadFn(_windows, groupOperators=False)
+    return _runBatches(windows, levels, batchSize, makeSpreadFn, trackingHalfWidth)
+
+def _autoBatchSize(windowShape : tuple, nAngles : int, maxBytes : int = 2**26) -> int:
+    """Number of windows whose projections fit in maxBytes (float64).
+    """
+    N = _radonLength(windowShape)
+    return max(1, int(maxBytes // (nAngles * N * 8)))
+
+def _radonEngineVectorized(windows : np.ndarray, levels : list, batchSize : int = None,
+                            trackingHalfWidth : float = None):
+    """Engine with all levels of the angle search batched, no per-window radon().
+
+    The full sweep of a batch is one sparse matmul (see _radonEngineSparse).
+    For the next levels, windows are grouped by their best angle and each group
+    is projected with an operator stacked from cached single angle blocks
+    (see _getGroupOperator()), the full sweep operator keeps its own cache.
+    Same result as 'radon', see _radonEngineSkimage() for args and return.
+
+    Args:
+        batchSize: Number of windows per batch, if None then bound the
+            projections to about 64 MB, see _autoBatchSize()
+    """
+    if batchSize is None:
+        nAngles = len(np.arange(0, 180, levels[0][0]))
+        batchSize = _autoBatchSize(windows.shape[1:], nAngles)
+    makeSpreadFn = lambda _windows: _sparseSpreadFn(_windows, groupOperators=True)
+    return _runBatches(windows, levels, batchSize, makeSpreadFn, trackingHalfWidth)
+
+def _radonEngineNumba(windows : np.ndarray, levels : list, batchSize : int = 64,
+                        trackingHalfWidth : float = None):
+    """Engine with a Numba-compiled fused projection-variance loop, see kymFlowNumba.
+
+    No sinogram is allocated. If numba is not installed, use _radonEngineSkimage().
+    Same result as 'radon', see _radonEngineSkimage() for args and return.
+    """
+    if not hasNumba():
+        return _radonEngineSkimage(windows, levels, batchSize, trackingHalfWidth)
+    def makeSpreadFn(_windows):
+        _windows = _meanSubtracted(_windows)
+        def spreadFn(angles, index=None):
+            if index is not None:
+                return numbaSpread(_windows[index:index+1], angles)[0]
+            return numbaSpread(_windows, angles)
+        return spreadFn
+    return _runBatches(windows, levels, batchSize, makeSpreadFn, trackingHalfWidth)
+
+# engines selectable with mpAnalyzeFlow(engine=),
+# 'fourier' approximates 'radon', the others are exact
+radonEngines = {
+    'radon': _radonEngineSkimage,
+    'fourier': _radonEngineFourier,
+    'sparse': _radonEngineSparse,
+    'vectorized': _radonEngineVectorized,
+    'numba': _radonEngineNumba,
+}
+
+def windowStats(windows : np.ndarray):
+    """Mean intensity and contrast of each window, one vectorized pass.
+
+    Args:
+        windows: (nWindows, windowsize, npoints), see _getWindows()
+
+    Return:
+        mean: (nWindows,) mean intensity
+        contrast: (nWindows,) std / mean, 0 where the mean is not positive
+    """
+    mean = np.mean(windows, axis=(1, 2), dtype=np.float64)
+    std = np.std(windows, axis=(1, 2), dtype=np.float64)
+    contrast = np.divide(std, mean, out=np.zeros_like(std), where=mean > 0)
+    return mean, contrast
+
+def lineProfile(data : np.ndarray, linesPerBlock : int = 4096):
+    """Time averaged line profile and temporal std of each pixel (space).
+
+    One pass over the kymograph, a block of lines at a time so a
+    memory-mapped kymograph is streamed from disk.
+
+    Return:
+        mean: (npoints,)
+        std: (npoints,)
+    """
+    nlines = data.shape[0]
+    # shift by the first line so the sum of squares does not cancel
+    shift = np.asarray(data[0], dtype=np.float64)
+    _sum = np.zeros(data.shape[1])
+    _sumSquares = np.zeros(data.shape[1])
+    for _start in range(0, nlines, linesPerBlock):
+        _block = np.asarray(data[_start:_start+linesPerBlock], dtype=np.float64) - shift
+        _sum += np.sum(_block, axis=0)
+        _sumSquares += np.sum(_block**2, axis=0)
+    mean = _sum / nlines
+    var = np.maximum(_sumSquares / nlines - mean**2, 0)
+    return mean + shift, np.sqrt(var)
+
+def detectVesselEdges(data : np.ndarray, threshold : float = 0.25,
+                        minContrast : float = 0.2, smooth : int = 3,
+                        margin : int = 1):
+    """Find the vessel lumen in a kymograph, the (startPixel, stopPixel) to analyze.
+
+    Flowing cells make the lumen bright and variable in time, background
+    columns are dark and (nearly) constant. Both the time averaged profile
+    and the temporal std are smoothed and scaled to 0..1 (min..max), the
+    lumen is the longest run of pixels where both are above threshold.
+
+    Args:
+        data: 2-D kymograph (time, space), can be a np.memmap
+        threshold: Fraction (0..1) of the min..max range of mean and std
+        minContrast: If the std (max-min)/max is smaller, there is no
+            background, return the whole line
+        smooth: Boxcar width (pixels) for the profiles
+        margin: Pixels added on each side of the lumen
+
+    Return:
+        startPixel, stopPixel: (0, npoints) if no vessel edge is found
+    """
+    npoints = data.shape[1]
+    mean, std = lineProfile(data)
+    if smooth > 1:
+        kernel = np.ones(smooth) / smooth
+        mean = np.convolve(np.pad(mean, smooth//2, mode='edge'), kernel, mode='valid')[:npoints]
+        std = np.convolve(np.pad(std, smooth//2, mode='edge'), kernel, mode='valid')[:npoints]
+
+    if np.max(std) <= 0 or (np.max(std) - np.min(std)) / np.max(std) < minContrast:
+        return 0, npoints
+
+    def _scaled(x):
+        return (x - np.min(x)) / max(np.max(x) - np.min(x), np.finfo(float).tiny)
+
+    lumen = (_scaled(mean) >= threshold) & (_scaled(std) >= threshold)
+    if not np.any(lumen):
+        return 0, npoints
+
+    # longest run of lumen pixels
+    _edges = np.flatnonzero(np.diff(np.concatenate([[False], lumen, [False]])))
+    _starts, _stops = _edges[0::2], _edges[1::2]
+    _longest = np.argmax(_stops - _starts)
+    startPixel = max(0, int(_starts[_longest]) - margin)
+    stopPixel = min(npoints, int(_stops[_longest]) + margin)
+    return startPixel, stopPixel
+
+def _prescreenWindows(windows : np.ndarray, minIntensity : float = None,
+                        minContrast : float = None) -> np.ndarray:
+    """Get a bool mask of windows worth a Radon, False for dark or blank windows.
+
+    A dark window (mean below minIntensity) or a blank one (contrast below
+    minContrast) has no bright/dark bands, its angle is noise or 0 (nan velocity).
+    """
+    valid = np.ones(windows.shape[0], dtype=bool)
+    if minIntensity is None and minContrast is None:
+        return valid
+    mean, contrast = windowStats(windows)
+    if minIntensity is not None:
+        valid &= mean >= minIntensity
+    if minContrast is not None:
+        valid &= contrast >= minContrast
+    return valid
+
+# mpAnalyzeFlow(cascade=True), when the fast angle of a window is escalated to the Radon
+cascadeMinCoherence = 0.5
+cascadeMaxDiff = 2.0  # degrees
+cascadeNeighbours = 2  # windows on each side
+
+def _escalateWindows(thetas : np.ndarray, coherence : np.ndarray,
+                        minCoherence : float = cascadeMinCoherence,
+                        maxDiff : float = cascadeMaxDiff,
+                        neighbours : int = cascadeNeighbours) -> np.ndarray:
+    """Get a bool mask of windows whose fast (structure tensor) angle is not trusted.
+
+    A window is escalated if its coherence is below minCoherence (or its angle
+    is nan), or if it disagrees with its neighbours: the median circular
+    difference (mod 180) to the angles of the neighbours windows on each side
+    is above maxDiff degrees. A single outlier disagrees with all its neighbours,
+    each of them only with one.
+    """
+    n = len(thetas)
+    escalate = ~(coherence >= minCoherence) | np.isnan(thetas)
+    if n < 2:
+        return escalate
+    padded = np.concatenate([np.full(neighbours, np.nan), thetas, np.full(neighbours, np.nan)])
+    diffs = []
+    for offset in list(range(-neighbours, 0)) + list(range(1, neighbours+1)):
+        _neighbour = padded[neighbours+offset:neighbours+offset+n]
+        diffs.append(np.abs(np.mod(thetas - _neighbour + 90, 180) - 90))
+    with warnings.catch_warnings():
+        # all neighbours nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        disagreement = np.nanmedian(np.stack(diffs), axis=0)
+    escalate |= disagreement > maxDiff
+    return escalate
+
+def _cascadePrepass(data : np.ndarray, windowsize : int, stepsize : int, nsteps : int,
+                        startPixel : int, stopPixel : int,
+                        minIntensity : float, minContrast : float, chunkSize : int):
+    """Structure tensor angle, coherence and prescreen of every window, chunk by chunk.
+
+    Chunks of windows are the same as radonChunkWorker() (see _chunkBounds()),
+    only their lines are read so a memory-mapped kymograph is streamed. The
+    background (mean of each pixel over time) is one pass, see lineProfile().
+
+    Return:
+        thetas, coherence: (nsteps,) see kymFlowStructureTensor.tensorOrientation()
+        skipped: (nsteps,) bool, see _prescreenWindows()
+    """
+    background, _ = lineProfile(data[:, startPixel:stopPixel])
+    sums = np.zeros((3, nsteps))  # Jxx, Jxt, Jtt
+    skipped = np.zeros(nsteps, dtype=bool)
+    for kStart in range(0, nsteps, chunkSize):
+        kStop = min(kStart + chunkSize, nsteps)
+        sums[:, kStart:kStop] = structureTensorWindowSums(data[:, startPixel:stopPixel],
+                                                            windowsize, stepsize, kStart, kStop,
+                                                            background=background)
+        _start, _stop = _chunkBounds(kStart, kStop, stepsize, windowsize)
+        _windows = _getWindows(data[_start:_stop, startPixel:stopPixel], windowsize, stepsize)
+        skipped[kStart:kStop] = ~_prescreenWindows(_windows, minIntensity, minContrast)
+    thetas, coherence = tensorOrientation(*sums)
+    return thetas, coherence, skipped
+
+def _analyzeWindows(windows : np.ndarray, levels : list, engine : str,
+                        trackingHalfWidth : float, refine : str):
+    """Run an engine on windows and refine the peaks, see radonChunkWorker().
+
+    Return:
+        thetas, spreadFine, nAngles, curvature
+    """
+    thetas, spreadFine, nAngles = radonEngines[engine](windows, levels,
+                                            trackingHalfWidth=trackingHalfWidth)
+    if refine == 'sweep':
+        curvature = np.full(len(thetas), float('nan'))
+    else:
+        circular = len(levels) == 1  # the full sweep
+        thetas, curvature = _refinePeaks(thetas, spreadFine, levels[-1][0],
+                                            circular, method=refine)
+    return thetas, spreadFine, nAngles, curvature
+
+def radonChunkWorker(block : np.ndarray,
+                        stepsize : int, windowsize : int,
+                        levels : list,
+                        engine : str = 'radon',
+                        trackingHalfWidth : float = None,
+                        refine : str = 'sweep',
+                        precision : str = 'float64',
+                        minIntensity : float = None,
+                        minContrast : float = None,
+                        windowMask : np.ndarray = None) -> dict:
+    """Multiprocessing worker to calculate flow for a contiguous block of windows.
+
+    Args:
+        block: Kymograph lines spanning all windows of the chunk, see _chunkBounds()
+        levels: Angle search, see angleSearchPresets
+        engine: Key in radonEngines
+        trackingHalfWidth: If not None, seed each window from the previous one
+            in the block, see _trackAngles()
+        refine: One of refineMethods, if not 'sweep' the last level of the
+            angle search is replaced by _refinePeaks()
+        precision: One of precisions, engines compute in this dtype
+        minIntensity, minContrast: Skip windows below these, see _prescreenWindows()
+        windowMask: If not None, bool per window of the block, only these
+            windows are analyzed, see mpAnalyzeFlow(cascade=True)
+
+    Return:
+        dict with per window arrays 'thetas', 'spreadFine', 'nAngles', 'curvature'
+        and 'skipped'. Skipped windows have nan theta, spread and curvature, 0 angles.
+        So do windows not in windowMask (they are not 'skipped').
+    """
+    block = block.astype(precision, copy=False)
+    windows = _getWindows(block, windowsize, stepsize)
+    if refine != 'sweep':
+        levels = levels[:-1]
+
+    valid = _prescreenWindows(windows, minIntensity, minContrast)
+    analyze = valid if windowMask is None else valid & windowMask
+    if np.all(analyze):
+        thetas, spreadFine, nAngles, curvature = _analyzeWindows(windows, levels,
+                                            engine, trackingHalfWidth, refine)
+    else:
+        # only the valid (and masked) windows, skipped windows are nan (nan velocity)
+        nWindows = windows.shape[0]
+        thetas = np.full(nWindows, float('nan'))
+        spreadFine = np.full((nWindows, _lastLevelSize(levels)), float('nan'))
+        nAngles = np.zeros(nWindows, dtype=int)
+        curvature = np.full(nWindows, float('nan'))
+        # contiguous runs of valid windows, tracking expects consecutive
+        # overlapping windows
+        _edges = np.flatnonzero(np.diff(np.concatenate([[False], analyze, [False]])))
+        for _start, _stop in zip(_edges[0::2], _edges[1::2]):
+            (thetas[_start:_stop], spreadFine[_start:_stop],
+                nAngles[_start:_stop], curvature[_start:_stop]) = _analyzeWindows(
+                                            windows[_start:_stop], levels,
+                                            engine, trackingHalfWidth, refine)
+    return {'thetas': thetas, 'spreadFine': spreadFine.astype(precision, copy=False),
+            'nAngles': nAngles, 'curvature': curvature, 'skipped': ~valid}
+
+def radonSharedChunkWorker(shmName : str, shape : tuple, dtype : str,
+                        start : int, stop : int,
+                        startPixel : int, stopPixel : int,
+                        stepsize : int, windowsize : int,
+                        levels : list,
+                        engine : str = 'radon',
+                        trackingHalfWidth : float = None,
+                        refine : str = 'sweep',
+                        precision : str = 'float64',
+                        minIntensity : float = None,
+                        minContrast : float = None,
+                        windowMask : np.ndarray = None) -> dict:
+    """Multiprocessing worker reading its block of windows from shared memory.
+
+    Only the block indices are pickled, not the data.
+
+    Args:
+        shmName, shape, dtype: The kymograph in shared memory
+        start, stop: Lines (time) of the block, see _chunkBounds()
+        startPixel, stopPixel: Pixels (space) of the block
+    """
+    data = _attachSharedKymograph(shmName, shape, dtype)
+    block = data[start:stop, startPixel:stopPixel]
+    return radonChunkWorker(block, stepsize, windowsize, levels, engine,
+                            trackingHalfWidth, refine, precision,
+                            minIntensity, minContrast, windowMask)
+
+# cost model for mpAnalyzeFlow(backend='auto'), seconds
+poolStartupSec = 0.25  # start a worker pool and warm up the workers
+taskOverheadSec = 0.002  # pickle a task and its result
+threadStartupSec = 0.005  # start a thread pool
+# backends 'auto' chooses from, serial first (wins a tie)
+autoBackends = ('serial', 'thread', 'process')
+
+# measured seconds per window, key is the window geometry and analysis params
+_windowCostCache = {}
+# measured fraction of a window that runs in parallel on threads, same key
+_threadFractionCache = {}
+
+def _costKey(block : np.ndarray, windowsize : int, workerParams : tuple) -> tuple:
+    """Key of _windowCostCache and _threadFractionCache.
+    """
+    return (windowsize, block.shape[1], block.dtype.str) + tuple(str(p) for p in workerParams)
+
+def _measureWindowCost(block : np.ndarray, stepsize : int, windowsize : int,
+                        workerParams : tuple, numWindows : int = 4) -> float:
+    """Seconds per window, time radonChunkWorker() on the first few windows.
+
+    One window is run first to warm up (operator caches, imports) so the
+    one-off costs are not counted per window.
+    Cached per (window shape, workerParams) for the life of the process.
+    """
+    key = _costKey(block, windowsize, workerParams)
+    if key not in _windowCostCache.keys():
+        radonChunkWorker(block[:windowsize], stepsize, windowsize, *workerParams)
+        _probe = block[:(numWindows - 1)*stepsize + windowsize]
+        numWindows = (_probe.shape[0] - windowsize) // stepsize + 1
+        _startSec = time.time()
+        radonChunkWorker(_probe, stepsize, windowsize, *workerParams)
+        _windowCostCache[key] = (time.time() - _startSec) / numWindows
+    return _windowCostCache[key]
+
+def _threadParallelFraction(tasks : list, repeat : int = 2) -> float:
+    """Fraction of the time of tasks that runs in parallel on threads.
+
+    Only code outside the GIL (NumPy, scipy, skimage C loops, nogil numba)
+    runs in parallel. The tasks are timed one after the other and then on
+    2 threads, the speed up S gives the fraction p = 2*(1 - 1/S) (Amdahl's law).
+
+    Args:
+        tasks: Callables without arguments and of about the same cost, e.g.
+            two chunks of windows
+        repeat: Best of repeat timings of each
+    """
+    serialSec = threadSec = float('inf')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for _ in range(repeat):
+            _startSec = time.time()
+            for task in tasks:
+                task()
+            serialSec = min(serialSec, time.time() - _startSec)
+            _startSec = time.time()
+            for future in [pool.submit(task) for task in tasks]:
+                future.result()
+            threadSec = min(threadSec, time.time() - _startSec)
+    speedup = serialSec / max(threadSec, 1e-9)
+    return float(np.clip(2 * (1 - 1 / speedup), 0, 1))
+
+def _measureThreadFraction(block : np.ndarray, stepsize : int, windowsize : int,
+                            workerParams : tuple, numWindows : int = 4) -> float:
+    """Fraction of a window that runs in parallel on threads, see _threadParallelFraction().
+
+    Probes two chunks of numWindows windows, call after _measureWindowCost()
+    (warm up). Cached like _measureWindowCost().
+    """
+    key = _costKey(block, windowsize, workerParams)
+    if key not in _threadFractionCache.keys():
+        numAvailable = (block.shape[0] - windowsize) // stepsize + 1
+        numWindows = min(numWindows, numAvailable // 2)
+        if numWindows < 1:
+            return 0.0
+        tasks = []
+        for kStart in (0, numWindows):
+            _start, _stop = _chunkBounds(kStart, kStart + numWindows, stepsize, windowsize)
+            tasks.append(functools.partial(radonChunkWorker, block[_start:_stop],
+                                            stepsize, windowsize, *workerParams))
+        _threadFractionCache[key] = _threadParallelFraction(tasks)
+        logger.info(f'  thread parallel fraction: {round(_threadFractionCache[key], 2)}')
+    return _threadFractionCache[key]
+
+def _estimateSeconds(backend : str, nsteps : int, windowSec : float,
+                        numWorkers : int, startPool : bool, chunkSize : int = None,
+                        threadFraction : float = 0) -> float:
+    """Estimated seconds to analyze nsteps windows with one of autoBackends.
+
+    Args:
+        windowSec: Seconds per window, see _measureWindowCost()
+        numWorkers: Number of workers of the executor
+        startPool: If True the executor has to be started
+        threadFraction: Fraction of a window that runs in parallel on threads,
+            see _measureThreadFraction()
+    """
+    serialSec = nsteps * windowSec
+    if backend == 'serial':
+        return serialSec
+    if backend == 'thread':
+        # only the part of a window outside the GIL runs in parallel
+        parallelSec = serialSec * threadFraction
+        return (serialSec - parallelSec + parallelSec / numWorkers
+                    + (threadStartupSec if startPool else 0))
+    if chunkSize is None:
+        chunkSize = autoChunkSize(nsteps, numWorkers)
+    numTasks = math.ceil(nsteps / chunkSize)
+    return (serialSec / numWorkers + numTasks * taskOverheadSec
+                + (poolStartupSec if startPool else 0))
+
+def _autoCandidates(executor : kymFlowExecutor = None) -> list:
+    """Candidates of _chooseBackend(), list of (backend, numWorkers, startPool).
+
+    Serial first (wins a tie). With an executor, serial or the executor.
+    """
+    if executor is None:
+        return [(_backend, _defaultNumWorkers(_backend), True) for _backend in autoBackends]
+    return [('serial', 1, False), (executor.backend, executor.numWorkers, False)]
+
+def _probeThreads(candidates : list) -> bool:
+    """True if candidates has more than one thread, only then the thread
+    fraction has to be measured (one thread is never faster than serial).
+    """
+    return any(_backend == 'thread' and numWorkers > 1 for _backend, numWorkers, _ in candidates)
+
+def _chooseBackend(runs : list, candidates : list,
+                    chunkSize : int = None) -> str:
+    """Pick the fastest backend for mpAnalyzeFlow(backend='auto').
+
+    Args:
+        runs: List of (nsteps, windowSec, threadFraction) run with one executor,
+            e.g. one per window size. windowSec is seconds per window, see
+            _measureWindowCost(), threadFraction is the fraction of it that runs
+            in parallel on threads, see _measureThreadFraction().
+        candidates: List of (backend, numWorkers, startPool), on a tie the first wins.
+            The executor is started once for all runs. See _autoCandidates().
+    """
+    if len(candidates) == 1:
+        return candidates[0][0]
+    estimates = {}
+    for backend, numWorkers, startPool in candidates:
+        estimates[backend] = sum(_estimateSeconds(backend, nsteps, windowSec,
+                                                    numWorkers, startPool and i == 0, chunkSize,
+                                                    threadFraction)
+                                    for i, (nsteps, windowSec, threadFraction) in enumerate(runs))
+    _estimates = ' '.join(f'{k}:{round(v,3)} s' for k, v in estimates.items())
+    logger.info(f'  estimated {_estimates}')
+    return min(estimates, key=estimates.get)
+
+def radonMemmapChunkWorker(filename : str, dtype : str, shape : tuple, offset : int,
+                        start : int, stop : int,
+                        startPixel : int, stopPixel : int,
+                        stepsize : int, windowsize : int,
+                        levels : list,
+                        engine : str = 'radon',
+                        trackingHalfWidth : float = None,
+                        refine : str = 'sweep',
+                        precision : str = 'float64',
+                        minIntensity : float = None,
+                        minContrast : float = None,
+                        windowMask : np.ndarray = None) -> dict:
+    """Multiprocessing worker reading its block of windows from a memory-mapped file.
+
+    Only the file name and block indices are pickled, only the block is read.
+
+    Args:
+        filename, dtype, shape, offset: See _memmapParams()
+        start, stop: Lines (time) of the block, see _chunkBounds()
+        startPixel, stopPixel: Pixels (space) of the block
+    """
+    data = _attachMemmap(filename, dtype, shape, offset)
+    block = data[start:stop, startPixel:stopPixel]
+    return radonChunkWorker(block, stepsize, windowsize, levels, engine,
+                            trackingHalfWidth, refine, precision,
+                            minIntensity, minContrast, windowMask)
+
+def autoChunkSize(nsteps : int, numWorkers : int, tasksPerWorker : int = 4) -> int:
+    """Get the default number of windows per task.
+
+    Aim for a few tasks per worker so workers stay balanced while the
+    per-task overhead (pickle, result round-trip) is paid only a few times.
+    """
+    numTasks = max(1, numWorkers * tasksPerWorker)
+    return max(1, math.ceil(nsteps / numTasks))
+
+# see mpAnalyzeFlow(backend=)
+backends = ('auto',) + executorBackends
+
+# windows per chunk in the serial backend for a memory-mapped kymograph
+memmapChunkSize = 256
+
+def _executorBackend(data : np.ndarray, nsteps : int, stepsize : int, windowsize : int,
+                        startPixel : int, stopPixel : int, workerParams : tuple,
+                        executor : kymFlowExecutor = None,
+                        backend : str = 'process',
+                        sharedMemory : bool = False,
+                        chunkSize : int = None,
+                        tasksPerWorker : int = 4,
+                        verbose : bool = False,
+                        shm : shared_memory.SharedMemory = None,
+                        windowMask : np.ndarray = None) -> list:
+    """Run chunks of windows with a kymFlowExecutor, see mpAnalyzeFlow().
+
+    Args:
+        workerParams: Params of radonChunkWorker() after windowsize
+        executor: If None, start (and shut down) one with backend
+        sharedMemory: Only used by the 'process' backend, threads share the data
+        shm: Existing shared memory copy of data (not unlinked here), e.g.
+            shared by all window sizes
+        tasksPerWorker: For autoChunkSize() if chunkSize is None
+        windowMask: If not None, (nsteps,) bool, only analyze these windows,
+            chunks without one are not run (not in the returned list)
+
+    Return:
+        list of (kStart, kStop, result dict from radonChunkWorker())
+    """
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = kymFlowExecutor(backend=backend)
+    isProcess = executor.backend == 'process'
+
+    # memory-mapped file, workers map it, no copy to shared memory
+    memmapParams = _memmapParams(data) if isProcess else None
+
+    ownShm = shm is None and sharedMemory and isProcess and memmapParams is None
+    if ownShm:
+        shm = _toSharedMemory(np.ascontiguousarray(data))
+    if shm is not None:
+        shmParams = (shm.name, data.shape, data.dtype.str)
+
+    if chunkSize is None:
+        chunkSize = autoChunkSize(nsteps, executor.numWorkers, tasksPerWorker=tasksPerWorker)
+    if verbose:
+        logger.info(f'  chunkSize: {chunkSize}')
+
+    precision = workerParams[4]  # see radonChunkWorker()
+    try:
+        result_objs = []
+        for kStart in range(0, nsteps, chunkSize):
+            kStop = min(kStart + chunkSize, nsteps)
+            _maskParams = ()
+            if windowMask is not None:
+                if not np.any(windowMask[kStart:kStop]):
+                    continue
+                _maskParams = (windowMask[kStart:kStop],)
+            _start, _stop = _chunkBounds(kStart, kStop, stepsize, windowsize)
+            if memmapParams is not None:
+                _params = memmapParams + (_start, _stop, startPixel, stopPixel,
+                                            stepsize, windowsize) + workerParams + _maskParams
+                result = executor.apply_async(radonMemmapChunkWorker, _params)
+            elif shm is not None:
+                _params = shmParams + (_start, _stop, startPixel, stopPixel,
+                                            stepsize, windowsize) + workerParams + _maskParams
+                result = executor.apply_async(radonSharedChunkWorker, _params)
+            else:
+                block = data[_start:_stop, startPixel:stopPixel]
+                if isProcess and block.dtype.itemsize > np.dtype(precision).itemsize:
+                    # cast before pickle, integer kymographs are sent as is
+                    block = block.astype(precision)
+                _params = (block, stepsize, windowsize) + workerParams + _maskParams
+                result = executor.apply_async(radonChunkWorker, _params)
+            result_objs.append((kStart, kStop, result))
+
+        return [(kStart, kStop, result.get()) for kStart, kStop, result in result_objs]
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+        if ownShm:
+            shm.close()
+            shm.unlink()
+
+def _getWorkerParams(engine : str, angleSearch, tracking : bool, trackingHalfWidth : float,
+                        refine : str, precision : str,
+                        minIntensity : float = None, minContrast : float = None):
+    """Check the analysis params of mpAnalyzeFlow().
+
+    Return:
+        levels: See _getAngleLevels()
+        workerParams: Params of radonChunkWorker() after windowsize
+    """
+    if engine not in radonEngines.keys():
+        raise ValueError(f'engine must be one of {list(radonEngines.keys())}, got "{engine}"')
+    if engine == 'numba' and not hasNumba():
+        logger.warning('numba is not installed, engine "numba" falls back to "radon"')
+
+    # find the edges, coarse to fine
+    levels = _getAngleLevels(angleSearch)
+    if precision not in precisions:
+        raise ValueError(f'precision must be one of {list(precisions)}, got "{precision}"')
+    if refine not in refineMethods:
+        raise ValueError(f'refine must be one of {list(refineMethods)}, got "{refine}"')
+    # levels that are evaluated, the last one is interpolated if not refine 'sweep'
+    _levels = levels if refine == 'sweep' else levels[:-1]
+    if len(_levels) < 1:
+        raise ValueError('refine needs an angleSearch with at least two levels')
+    if tracking and len(_levels) < 2:
+        raise ValueError('tracking needs at least two evaluated levels in angleSearch')
+    _trackingHalfWidth = trackingHalfWidth if tracking else None
+
+    workerParams = (levels, engine, _trackingHalfWidth, refine, precision,
+                    minIntensity, minContrast)
+    return levels, workerParams
+
+def _measureFlowCost(data : np.ndarray, windowsize : int, startPixel : int, stopPixel : int,
+                        workerParams : tuple, probeThreads : bool = False):
+    """Number of windows, seconds per window and thread fraction for one window size.
+
+    Args:
+        probeThreads: If False the thread fraction is not measured (0), see _probeThreads()
+
+    Return:
+        (nsteps, windowSec, threadFraction), see _chooseBackend()
+    """
+    stepsize = int(.25 * windowsize)
+    nsteps = math.floor(data.shape[0]/stepsize)-3
+    _start, _stop = _chunkBounds(0, nsteps, stepsize, windowsize)
+    block = data[_start:_stop, startPixel:stopPixel]
+    windowSec = _measureWindowCost(block, stepsize, windowsize, workerParams)
+    threadFraction = 0.0
+    if probeThreads:
+        threadFraction = _measureThreadFraction(block, stepsize, windowsize, workerParams)
+    return nsteps, windowSec, threadFraction
+
 def mpAnalyzeFlow(data : np.ndarray,
-                    windowsize : int,
+                    windowsize,
                     startPixel : int = None,
                     stopPixel : int = None,
-                    verbose=False):
+                    verbose=False,
+                    executor : kymFlowExecutor = None,
+                    sharedMemory : bool = False,
+                    chunkSize : int = None,
+                    engine : str = 'radon',
+                    angleSearch = 'exhaustive',
+                    tracking : bool = False,
+                    trackingHalfWidth : float = 10,
+                    refine : str = 'sweep',
+                    precision : str = 'float64',
+                    backend : str = 'auto',
+                    minIntensity : float = None,
+                    minContrast : float = None,
+                    rois : dict = None,
+                    cascade : bool = False,
+                    cascadeMinCoherence : float = cascadeMinCoherence,
+                    cascadeMaxDiff : float = cascadeMaxDiff,
+                    returnInfo : bool = False):
     """Given a blood flow kymograph, calculate blood flow velocity.
     
     Args:
-        data: 2-D numpy array kymograph with size (time, space)
+        data: 2-D numpy array kymograph with size (time, space).
+            Can be a np.memmap (e.g. tifffile.memmap), then only the lines
+            of one chunk are read at a time, worker processes map the file.
         windowsize: Number of line scans to use in estimating velocity
-            Must be a factor of 4
+            Must be a factor of 4.
+            Can be a list of window sizes, they are analyzed in one call with
+            one executor (and shared memory copy), see Return.
         startPixel:
         stopPixel:
+        executor: Reuse an existing kymFlowExecutor, if None then create
+            (and shut down) a temporary one with backend
+        sharedMemory: If True, copy the kymograph into shared memory once
+            and only send window indices to the workers. Otherwise each
+            window is pickled (with 75% overlap, each pixel about 4 times).
+            Only for the 'process' backend.
+        chunkSize: Number of contiguous windows per worker task,
+            if None then use autoChunkSize()
+        engine: How to get the variance of each projection, one of
+            'radon': skimage radon(), the original algorithm
+            'fourier': sample the 2-D power spectrum along radial lines
+                (projection-slice theorem), no explicit projections
+            'sparse': same result as 'radon', coarse angles use one cached
+                sparse projection operator per window shape
+            'vectorized': same result as 'radon', coarse and fine angles
+                both batched with sparse projection operators
+            'numba': same result as 'radon', fused Numba loop without the
+                sinogram, falls back to 'radon' if numba is not installed
+        angleSearch: Key in angleSearchPresets ('exhaustive', 'hierarchical')
+            or a list of (step, halfWidth) levels, see angleSearchPresets
+        tracking: If True, replace the full sweep of each window with a band
+            of +/- trackingHalfWidth degrees around the angle of the previous
+            window. Falls back to the full sweep if the peak is weak or on the
+            band edge, see _trackAngles(). Each task is a contiguous segment of
+            windows, the first window of a segment does a full sweep.
+        trackingHalfWidth: Half width of the tracking band (degrees)
+        refine: How to get the final (sub-degree) angle, one of
+            'sweep': evaluate the last level of angleSearch, the original algorithm
+            'parabola', 'gaussian': skip the last level and interpolate the
+                peak of the level before it, see _refinePeaks()
+        precision: 'float64' or 'float32', dtype of the windows in all engines.
+            float32 halves the memory traffic and the returned spread,
+            see sandbox/benchmarkEngines.py for the accuracy.
+        backend: Where to run the windows, one of
+            'process': worker processes, see kymFlowExecutor
+            'thread': worker threads, no pickle or copy of the data,
+                use this from the GUI
+            'serial': in this thread, no workers are started
+            'auto': from the measured cost of a window and the number of
+                windows, serial when the pool overhead dominates (short
+                kymographs, fast engines or one cpu), see _chooseBackend().
+                'thread' is estimated from a probe of a few windows on 2
+                threads, see _measureThreadFraction(). If an executor is
+                given, either serial or the executor.
+        minIntensity: If not None, skip (nan) windows with a lower mean intensity,
+            no Radon is done for them, see windowStats()
+        minContrast: If not None, skip (nan) windows with a lower contrast
+            (std / mean), e.g. blank windows without bands
+        rois: Dict of name to (startPixel, stopPixel), e.g. two vessels crossed
+            by one line scan. All are analyzed in one call with one executor
+            (and shared memory copy), see Return. Can not be used with
+            startPixel/stopPixel.
+        cascade: If True, get a fast angle of every window from the structure
+            tensor (see kymFlowStructureTensor) and only run the Radon (engine)
+            on the windows where it is not trusted, see _escalateWindows().
+            The other windows keep the structure tensor angle, their spread is
+            nan and nAngles 0. See sandbox/benchmarkEngines.py for the speed
+            and accuracy per threshold.
+        cascadeMinCoherence: Escalate windows with a lower structure tensor
+            coherence (0..1)
+        cascadeMaxDiff: Escalate windows whose angle differs from the angles
+            of their neighbour windows by more than this (median, degrees)
+        returnInfo: If True, also return a dict with analysis info,
+            'nAngles' is the number of angles evaluated per window,
+            'fullSweeps' the number of windows with a full sweep,
+            'curvature' the per window peak curvature (nan for refine='sweep'),
+            'backend' the backend that was used,
+            'startPixel', 'stopPixel' the pixels analyzed,
+            'skipped' the per window bool of dark/blank windows and
+            'numSkipped' their number, see minIntensity and minContrast.
+            With cascade, 'escalated' the per window bool of windows run with
+            the Radon, 'numEscalated', 'escalatedFraction' (of all windows)
+            and the per window structure tensor 'coherence'
+
+    Return:
+        thetas: (nsteps,) angle of each window (degrees)
+        the_t: (nsteps,) center line of each window
+        spread_matrix_fine: (nsteps, nAngles) projection variance of the last
+            evaluated level of the angle search
+        info: Only if returnInfo
+
+        If windowsize is a list, a dict with one (thetas, the_t, spread_matrix_fine[, info])
+        per window size (key).
+
+        If rois, a dict with the above per roi name (key).
     
     Algorithm:
         Calculates radon transform for a number of sliding windows.
@@ -184,29 +1625,148 @@ def mpAnalyzeFlow(data : np.ndarray,
             See: 
     """
     startSec = time.time()
-    
+
+    levels, workerParams = _getWorkerParams(engine, angleSearch, tracking, trackingHalfWidth,
+                                            refine, precision, minIntensity, minContrast)
+    if backend not in backends:
+        raise ValueError(f'backend must be one of {list(backends)}, got "{backend}"')
+    if executor is not None and backend not in ('auto', 'serial', executor.backend):
+        raise ValueError(f'backend "{backend}" does not match the executor backend "{executor.backend}"')
+
+    npoints = data.shape[1]
+
+    _cascade = (cascadeMinCoherence, cascadeMaxDiff) if cascade else None
+
+    multiRoi = rois is not None
+    if multiRoi and (startPixel is not None or stopPixel is not None):
+        raise ValueError('use either rois or startPixel/stopPixel')
+    if not multiRoi:
+        rois = {None: (startPixel, stopPixel)}
+    pixelSpans = {}
+    for roiName, (_startPixel, _stopPixel) in rois.items():
+        # None is the whole line
+        _startPixel = 0 if _startPixel is None else _startPixel
+        _stopPixel = npoints if _stopPixel is None else _stopPixel
+        pixelSpans[roiName] = (_startPixel, _stopPixel)
+
+    multiWindow = not np.isscalar(windowsize)
+    windowSizes = list(windowsize) if multiWindow else [windowsize]
+
+    # one run per (roi, window size)
+    flowRuns = [(roiName, _windowsize) for roiName in pixelSpans.keys()
+                    for _windowsize in windowSizes]
+
+    ownExecutor = False
+    shm = None
+    try:
+        if len(flowRuns) > 1 and executor is None and backend != 'serial':
+            # one executor for all rois and window sizes
+            if backend == 'auto':
+                candidates = _autoCandidates()
+                runs = [_measureFlowCost(data, _windowsize, *pixelSpans[roiName], workerParams,
+                                            probeThreads=_probeThreads(candidates))
+                            for roiName, _windowsize in flowRuns]
+                backend = _chooseBackend(runs, candidates, chunkSize=chunkSize)
+            if backend != 'serial':
+                executor = kymFlowExecutor(backend=backend)
+                ownExecutor = True
+        if (len(flowRuns) > 1 and sharedMemory and executor is not None and backend != 'serial'
+                and executor.backend == 'process' and _memmapParams(data) is None):
+            # one copy in shared memory for all rois and window sizes
+            shm = _toSharedMemory(np.ascontiguousarray(data))
+
+        results = {roiName: {} for roiName in pixelSpans.keys()}
+        for roiName, _windowsize in flowRuns:
+            startPixel, stopPixel = pixelSpans[roiName]
+            _startSec = time.time()
+            thetas, the_t, spread_matrix_fine, perWindow, _backend = _runAnalyzeFlow(data,
+                                        _windowsize, startPixel, stopPixel, workerParams,
+                                        executor, backend, sharedMemory, shm, chunkSize,
+                                        # tracking, one contiguous segment per worker
+                                        tasksPerWorker=1 if tracking else 4,
+                                        verbose=verbose, cascade=_cascade)
+            _stopSec = time.time()
+            _roiStr = '' if roiName is None else f'roi {roiName} '
+            if len(flowRuns) > 1:
+                logger.info(f'  {_roiStr}windowsize {_windowsize} took {round(_stopSec-_startSec, 2)} seconds')
+            if cascade:
+                numEscalated = int(np.count_nonzero(perWindow['escalated']))
+                escalatedFraction = numEscalated / len(thetas) if len(thetas) > 0 else float('nan')
+                logger.info(f'  {_roiStr}windowsize {_windowsize} escalated {numEscalated}'
+                            f' of {len(thetas)} windows ({round(100*escalatedFraction, 1)}%)')
+
+            if returnInfo:
+                info = _analysisInfo(engine, angleSearch, perWindow['nAngles'],
+                                        _stopSec-_startSec, levels)
+                info['tracking'] = tracking
+                info['refine'] = refine
+                info['precision'] = precision
+                info['backend'] = _backend
+                info['curvature'] = perWindow['curvature']
+                info['skipped'] = perWindow['skipped']
+                info['numSkipped'] = int(np.count_nonzero(perWindow['skipped']))
+                info['startPixel'] = startPixel
+                info['stopPixel'] = stopPixel
+                info['cascade'] = cascade
+                if cascade:
+                    info['escalated'] = perWindow['escalated']
+                    info['numEscalated'] = numEscalated
+                    info['escalatedFraction'] = escalatedFraction
+                    info['coherence'] = perWindow['coherence']
+                results[roiName][_windowsize] = (thetas, the_t, spread_matrix_fine, info)
+            else:
+                #return thetas, the_t, spread_matrix
+                results[roiName][_windowsize] = (thetas, the_t, spread_matrix_fine)
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    stopSec = time.time()
+    logger.info(f'  took {round(stopSec-startSec)} seconds')
+
+    if not multiWindow:
+        results = {roiName: _results[windowsize] for roiName, _results in results.items()}
+    if multiRoi:
+        return results
+    return results[None]
+
+def _runAnalyzeFlow(data : np.ndarray, windowsize : int,
+                        startPixel : int, stopPixel : int, workerParams : tuple,
+                        executor : kymFlowExecutor, backend : str,
+                        sharedMemory : bool, shm : shared_memory.SharedMemory,
+                        chunkSize : int, tasksPerWorker : int = 4, verbose : bool = False,
+                        cascade : tuple = None):
+    """Analyze all windows of one window size, see mpAnalyzeFlow().
+
+    Args:
+        cascade: If not None, (minCoherence, maxDiff), only the windows escalated
+            by _escalateWindows() are analyzed with the Radon, the others keep
+            their structure tensor angle
+
+    Return:
+        thetas, the_t, spread_matrix_fine: See mpAnalyzeFlow()
+        perWindow: dict of per window 'nAngles', 'curvature' and 'skipped',
+            with cascade also 'escalated' and 'coherence'
+        backend: The backend that was used
+    """
     stepsize = .25 * windowsize
     stepsize = int(stepsize)
 
     nlines = data.shape[0]
-    npoints = data.shape[1]
     nsteps = math.floor(nlines/stepsize)-3
-    
-    # TODO: allow user to specify start/stop pixels (space)
-    if startPixel is None:
-        startPixel = 0
-    if stopPixel is None:
-        stopPixel = npoints
-
-    # find the edges
-    angles = np.arange(180)
 
-    _step = 0.25
-    angles_fine= np.arange(-2, 2+_step, _step)  # [start, stop), step
+    levels, refine, precision = workerParams[0], workerParams[3], workerParams[4]
+    # levels that are evaluated, the last one is interpolated if not refine 'sweep'
+    _levels = levels if refine == 'sweep' else levels[:-1]
 
-    spread_matrix = np.zeros( (nsteps,len(angles)) )
-    spread_matrix_fine = np.zeros( (nsteps,len(angles_fine)) )
+    spread_matrix_fine = np.zeros( (nsteps, _lastLevelSize(_levels)), dtype=precision)
     thetas = np.zeros(nsteps)
+    nAngles = np.zeros(nsteps, dtype=int)
+    curvature = np.zeros(nsteps)
+    skipped = np.zeros(nsteps, dtype=bool)
 
     #hold_matrix = np.ones( (windowsize,npoints) )
     # blank_matrix = np.ones( (nsteps,len(angles)) )
@@ -223,39 +1783,175 @@ def mpAnalyzeFlow(data : np.ndarray,
         logger.info(f'  stopPixel: {stopPixel}')
         logger.info(f'  nsteps: {nsteps}')
 
-    result_objs = []
-    with Pool(processes=os.cpu_count() - 1) as pool:
+    the_t[:] = 1 + np.arange(nsteps)*stepsize + windowsize/2
+
+    escalated = None
+    if cascade is not None:
+        # fast angle of every window, the Radon only where it is not trusted
+        stThetas, coherence, skipped[:] = _cascadePrepass(data, windowsize, stepsize, nsteps,
+                                                            startPixel, stopPixel,
+                                                            *workerParams[5:7],
+                                                            chunkSize or memmapChunkSize)
+        escalated = _escalateWindows(stThetas, coherence, *cascade) & ~skipped
+        # windows that are not run, skipped ones are nan (nan velocity)
+        thetas[:] = np.where(skipped, float('nan'), stThetas)
+        spread_matrix_fine[:] = float('nan')
+        curvature[:] = float('nan')
+        if verbose:
+            logger.info(f'  escalated: {np.count_nonzero(escalated)} of {nsteps}')
+
+    if backend == 'auto':
+        candidates = _autoCandidates(executor)
+        runs = [_measureFlowCost(data, windowsize, startPixel, stopPixel, workerParams,
+                                    probeThreads=_probeThreads(candidates))]
+        if escalated is not None:
+            runs = [(int(np.count_nonzero(escalated)),) + runs[0][1:]]
+        backend = _chooseBackend(runs, candidates, chunkSize=chunkSize)
+    if verbose:
+        logger.info(f'  backend: {backend}')
+
+    if backend == 'serial':
+        if chunkSize is None and isinstance(data, np.memmap):
+            # only read a chunk of the file at a time
+            chunkSize = memmapChunkSize
+        _chunkSize = chunkSize or max(1, nsteps)
+        chunkResults = []
+        for kStart in range(0, nsteps, _chunkSize):
+            kStop = min(kStart + _chunkSize, nsteps)
+            _maskParams = ()
+            if escalated is not None:
+                if not np.any(escalated[kStart:kStop]):
+                    continue
+                _maskParams = (escalated[kStart:kStop],)
+            _start, _stop = _chunkBounds(kStart, kStop, stepsize, windowsize)
+            block = data[_start:_stop, startPixel:stopPixel]
+            result = radonChunkWorker(block, stepsize, windowsize, *workerParams, *_maskParams)
+            chunkResults.append((kStart, kStop, result))
+    else:
+        chunkResults = _executorBackend(data, nsteps, stepsize, windowsize,
+                                        startPixel, stopPixel, workerParams,
+                                        executor, backend, sharedMemory, chunkSize,
+                                        tasksPerWorker=tasksPerWorker,
+                                        verbose=verbose, shm=shm, windowMask=escalated)
+
+    for kStart, kStop, result in chunkResults:
+        if escalated is not None:
+            # only the escalated windows of the chunk were analyzed
+            _rows = np.flatnonzero(escalated[kStart:kStop])
+            _k = kStart + _rows
+            thetas[_k] = result['thetas'][_rows]
+            spread_matrix_fine[_k] = result['spreadFine'][_rows]
+            nAngles[_k] = result['nAngles'][_rows]
+            curvature[_k] = result['curvature'][_rows]
+            continue
+        thetas[kStart:kStop] = result['thetas']
+        spread_matrix_fine[kStart:kStop] = result['spreadFine']
+        nAngles[kStart:kStop] = result['nAngles']
+        curvature[kStart:kStop] = result['curvature']
+        skipped[kStart:kStop] = result['skipped']
+
+    perWindow = {'nAngles': nAngles, 'curvature': curvature, 'skipped': skipped}
+    if escalated is not None:
+        perWindow['escalated'] = escalated
+        perWindow['coherence'] = coherence
+    return thetas, the_t, spread_matrix_fine, perWindow, backend
+
+def _analysisInfo(engine : str, angleSearch, nAngles : np.ndarray, seconds : float,
+                    levels : list) -> dict:
+    """Info returned by mpAnalyzeFlow(returnInfo=True).
+    """
+    # a tracked window without fallback evaluates fewer angles than the full sweep
+    nFullSweep = len(np.arange(0, 180, levels[0][0]))
+    return {
+        'engine': engine,
+        'angleSearch': angleSearch if isinstance(angleSearch, str) else str(angleSearch),
+        'nAngles': nAngles,  # per window
+        'totalAngles': int(np.sum(nAngles)),
+        'meanAngles': float(np.mean(nAngles)) if len(nAngles) > 0 else float('nan'),
+        'fullSweeps': int(np.count_nonzero(nAngles >= nFullSweep)),
+        'seconds': seconds,
+    }
+
+def thetaToVelocity(thetas : np.ndarray, delx : float, delt : float) -> np.ndarray:
+    """Convert the angle of each window to velocity.
 
-        for k in range(nsteps):
+    Args:
+        thetas: Angles (degrees) from mpAnalyzeFlow()
+        delx: um per pixel
+        delt: seconds per line
 
-            the_t[k] = 1 + k*stepsize + windowsize/2
+    Return:
+        Velocity in mm/s, nan where tan(theta) is inf or 0
+    """
+    _rad = np.deg2rad(thetas)
+    velocity = (delx/delt) * np.tan(_rad)
+    velocity = velocity / 1000  # mm/s
 
-            _start = k * stepsize
-            _stop = k * stepsize + windowsize
-            #data_hold = data[_start:_stop,:]
-            data_hold = data[_start:_stop, startPixel:stopPixel]
+    # remove inf and 0 tan()
+    # np.tan(90 deg) is returning 1e16 rather than inf
+    tan90or0 = (velocity > 1e6) | (velocity == 0)
+    velocity[tan90or0] = float('nan')
+    return velocity
 
-            #radonWorker(data, stepsize, windowsize, angles, angles_fine)
-            #workerParams = (k, data, stepsize, windowsize, angles, angles_fine)
-            workerParams = (data_hold, angles, angles_fine)
-            result = pool.apply_async(radonWorker, workerParams)
-            result_objs.append(result)
+def vectorizedAnalyzeFlow(data : np.ndarray,
+                    windowsize : int,
+                    startPixel : int = None,
+                    stopPixel : int = None,
+                    batchSize : int = None,
+                    verbose=False,
+                    angleSearch = 'exhaustive',
+                    returnInfo : bool = False):
+    """Serial, batched alternative to mpAnalyzeFlow(), no worker processes.
+
+    All windows are a strided view (nsteps, windowsize, npoints) of the
+    kymograph, no copy. Windows are processed batchSize at a time with the
+    'vectorized' engine so memory stays bounded for long kymographs.
+    Nothing is shared between calls except the cached projection operators,
+    so this can also run in a thread (e.g. from a GUI).
+
+    Args:
+        See mpAnalyzeFlow()
+        batchSize: Number of windows per batch, if None then see _autoBatchSize()
+
+    Return:
+        Same as mpAnalyzeFlow()
+    """
+    startSec = time.time()
 
-        results = [result.get() for result in result_objs]
-        #print(len(results))
+    stepsize = int(.25 * windowsize)
 
-        # 20230609, i changed lhs from results to result (while working on pymapmanager)
-        # return worker_thetas, worker_spread_matrix
-        for k, result in enumerate(results):
-            # results is a tuple
-            thetas[k] = result[0]
-            #spread_matrix[k] = results[1]
-            spread_matrix_fine[k] = result[1]
+    nlines = data.shape[0]
+    npoints = data.shape[1]
+    nsteps = math.floor(nlines/stepsize)-3
+
+    if startPixel is None:
+        startPixel = 0
+    if stopPixel is None:
+        stopPixel = npoints
+
+    levels = _getAngleLevels(angleSearch)
+
+    the_t = 1 + np.arange(nsteps)*stepsize + windowsize/2
+
+    if verbose:
+        logger.info(f'tif data {data.shape}')
+        logger.info(f'  windowsize: {windowsize}')
+        logger.info(f'  startPixel: {startPixel}')
+        logger.info(f'  stopPixel: {stopPixel}')
+        logger.info(f'  nsteps: {nsteps}')
+
+    _start, _stop = _chunkBounds(0, nsteps, stepsize, windowsize)
+    windows = _getWindows(data[_start:_stop, startPixel:stopPixel], windowsize, stepsize)
+    thetas, spread_matrix_fine, nAngles = _radonEngineVectorized(windows, levels,
+                                                        batchSize=batchSize)
 
     stopSec = time.time()
     logger.info(f'  took {round(stopSec-startSec)} seconds')
 
-    #return thetas, the_t, spread_matrix
+    if returnInfo:
+        info = _analysisInfo('vectorized', angleSearch, nAngles, stopSec-startSec, levels)
+        return thetas, the_t, spread_matrix_fine, info
+
     return thetas, the_t, spread_matrix_fine
 
 def compareMatlabPythonRadon():
@@ -340,13 +2036,22 @@ def old_analyzeOne(tifPath):
 
     return df
 
-def batchAnalyzeFolderList(dataPath : str):
+def batchAnalyzeFolderList(dataPath : str, autoRoi : bool = False, lspiv : bool = False,
+                            chhatbar : bool = False):
     """Batch analyzed all tif file in a folder and its subfolders.
     
+    One kymFlowExecutor is shared across all folders.
+
     Parameters
     ==========
     dataPath : str
         Source folder.
+    autoRoi : bool
+        Analyze the vessel lumen of each file, see detectVesselEdges()
+    lspiv : bool
+        Also analyze each file with LSPIV, see batchAnalyzeFolder()
+    chhatbar : bool
+        Also analyze each file with the Chhatbar hybrid method, see batchAnalyzeFolder()
     """
     dateFolders = []
     for item in os.listdir(dataPath):
@@ -357,15 +2062,29 @@ def batchAnalyzeFolderList(dataPath : str):
     dateFolders = sorted(dateFolders)  # important to get date order
 
     numAnalyzed = 0
-    for oneFolder in dateFolders:
-        logger.info(f'=== running analysis on folder: {oneFolder}')
-        numAnalyzed += batchAnalyzeFolder(oneFolder)
+    with kymFlowExecutor() as executor:
+        for oneFolder in dateFolders:
+            logger.info(f'=== running analysis on folder: {oneFolder}')
+            numAnalyzed += batchAnalyzeFolder(oneFolder, executor=executor, autoRoi=autoRoi,
+                                                lspiv=lspiv, chhatbar=chhatbar)
 
     print(f'done analyzing {len(dateFolders)} folders with {numAnalyzed} tif files.')
 
-def batchAnalyzeFolder(folderPath) -> int:
+def batchAnalyzeFolder(folderPath, executor : kymFlowExecutor = None,
+                        autoRoi : bool = False, lspiv : bool = False,
+                        chhatbar : bool = False) -> int:
     """Analyze a folder of tif with mpRadon and save all analysis (one line per line scan).
     
+    Args:
+        folderPath: Folder with tif files
+        executor: Reuse an existing kymFlowExecutor, if None then create
+            one for all files in the folder
+        autoRoi: Analyze the vessel lumen of each file, see detectVesselEdges()
+        lspiv: Also analyze each file with LSPIV (algorithm 'lspiv', default
+            capillary settings), see kymFlowFile.analyzeFlowWithLspiv()
+        chhatbar: Also analyze each file with the Chhatbar hybrid method
+            (algorithm 'chhatbar'), see kymFlowFile.analyzeFlowWithChhatbar()
+
     Returns:
         (int) Number of tif files analyzed
     """
@@ -388,18 +2107,30 @@ def batchAnalyzeFolder(folderPath) -> int:
     
     numTif = len(tifList)
 
-    for idx, tifFile in enumerate(tifList):
-        # if not file.endswith('.tif'):
-        #     continue
-        tifPath = os.path.join(folderPath, tifFile)
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = kymFlowExecutor()
 
-        logger.info(f'=== tif file {idx+1} of {numTif}')
-        logger.info(f'  path: {tifPath}')
-        
-        kff = analyzeflow.kymFlowFile(tifPath)
+    try:
+        for idx, tifFile in enumerate(tifList):
+            # if not file.endswith('.tif'):
+            #     continue
+            tifPath = os.path.join(folderPath, tifFile)
 
-        kff.analyzeFlowWithRadon()  # do actual kym radon analysis
-        kff.saveAnalysis()  # save result to csv
+            logger.info(f'=== tif file {idx+1} of {numTif}')
+            logger.info(f'  path: {tifPath}')
+            
+            kff = analyzeflow.kymFlowFile(tifPath)
+
+            kff.analyzeFlowWithRadon(executor=executor, autoRoi=autoRoi)  # do actual kym radon analysis
+            if lspiv:
+                kff.analyzeFlowWithLspiv()
+            if chhatbar:
+                kff.analyzeFlowWithChhatbar(executor=executor)
+            kff.saveAnalysis()  # save result to csv
+    finally:
+        if ownExecutor:
+            executor.shutdown()
 
     logger.info(f'Done processing {numTif} tif files in folder {folderPath}.')
 
@@ -0,0 +1,153 @@
+"""
+Online velocity estimation while a kymograph is being acquired.
+
+Feed line scans as they arrive with kymFlowStream.addLines(), each time
+stepsize (windowsize/4) new lines complete a window the (time, theta, velocity)
+of that window is returned. Results are the same as mpAnalyzeFlow() on the
+whole kymograph, see tests/test_kymFlow.py.
+
+Example:
+    stream = kymFlowStream(delx, delt, windowsize=16)
+    for lines in acquisition:  # (numLines, pntsPerLine)
+        time, theta, velocity = stream.addLines(lines)
+    df = stream.getDataFrame()
+"""
+
+import numpy as np
+import pandas as pd
+
+import analyzeflow.kymFlowRadon
+
+from analyzeflow import get_logger
+logger = get_logger(__name__)
+
+class kymFlowStream():
+    """Estimate flow from a growing kymograph, a rolling buffer of lines.
+    """
+    def __init__(self,
+                    delx : float,
+                    delt : float,
+                    windowsize : int = 16,
+                    startPixel : int = None,
+                    stopPixel : int = None,
+                    engine : str = 'radon',
+                    angleSearch = 'exhaustive',
+                    refine : str = 'sweep',
+                    precision : str = 'float64',
+                    minIntensity : float = None,
+                    minContrast : float = None):
+        """
+        Args:
+            delx: um per pixel
+            delt: seconds per line
+            windowsize: Number of line scans per window, must be a multiple of 4
+            startPixel, stopPixel: Pixels (space) to analyze, None for all
+            engine, angleSearch, refine, precision, minIntensity, minContrast:
+                See mpAnalyzeFlow().
+                Tracking is not available, each window is independent.
+        """
+        if engine not in analyzeflow.kymFlowRadon.radonEngines.keys():
+            raise ValueError(f'engine must be one of {list(analyzeflow.kymFlowRadon.radonEngines.keys())}, got "{engine}"')
+        if refine not in analyzeflow.kymFlowRadon.refineMethods:
+            raise ValueError(f'refine must be one of {list(analyzeflow.kymFlowRadon.refineMethods)}, got "{refine}"')
+        if precision not in analyzeflow.kymFlowRadon.precisions:
+            raise ValueError(f'precision must be one of {list(analyzeflow.kymFlowRadon.precisions)}, got "{precision}"')
+
+        self._delx = delx
+        self._delt = delt
+        self._windowsize = windowsize
+        self._stepsize = int(.25 * windowsize)
+        self._startPixel = startPixel
+        self._stopPixel = stopPixel
+
+        levels = analyzeflow.kymFlowRadon._getAngleLevels(angleSearch)
+        # see radonChunkWorker()
+        self._workerParams = (levels, engine, None, refine, precision,
+                                minIntensity, minContrast)
+
+        self._buffer = None  # lines not yet used by a complete window, (numLines, numPixels)
+        self._numLines = 0  # total number of lines added
+        self._numWindows = 0  # number of windows analyzed
+
+        self._time = []
+        self._thetas = []
+        self._velocity = []
+
+    @property
+    def numLines(self) -> int:
+        return self._numLines
+
+    @property
+    def numWindows(self) -> int:
+        return self._numWindows
+
+    def addLines(self, lines : np.ndarray):
+        """Add line scans and analyze all windows they complete.
+
+        Args:
+            lines: (numLines, pntsPerLine), one line scan per row
+
+        Return:
+            time: (n,) seconds, center of each new window
+            thetas: (n,) degrees
+            velocity: (n,) mm/s
+        """
+        lines = np.atleast_2d(lines)
+        lines = lines[:, self._startPixel:self._stopPixel]
+        if self._buffer is None:
+            self._buffer = lines.copy()
+        else:
+            self._buffer = np.concatenate([self._buffer, lines])
+        self._numLines += lines.shape[0]
+
+        windowsize = self._windowsize
+        stepsize = self._stepsize
+        numNew = (self._buffer.shape[0] - windowsize) // stepsize + 1
+        if numNew <= 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+
+        _start, _stop = analyzeflow.kymFlowRadon._chunkBounds(0, numNew, stepsize, windowsize)
+        result = analyzeflow.kymFlowRadon.radonChunkWorker(self._buffer[_start:_stop],
+                                                stepsize, windowsize,
+                                                *self._workerParams)
+
+        # same as the_t in mpAnalyzeFlow()
+        k = self._numWindows + np.arange(numNew)
+        the_t = 1 + k*stepsize + windowsize/2
+        time = the_t * self._delt
+        thetas = result['thetas']
+        velocity = analyzeflow.kymFlowRadon.thetaToVelocity(thetas, self._delx, self._delt)
+
+        self._numWindows += numNew
+        self._buffer = self._buffer[numNew*stepsize:]  # first line of the next window
+
+        self._time.append(time)
+        self._thetas.append(thetas)
+        self._velocity.append(velocity)
+
+        return time, thetas, velocity
+
+    def getResults(self):
+        """Get all results so far.
+
+        Return:
+            time, thetas, velocity: See addLines()
+        """
+        if self._numWindows == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        return (np.concatenate(self._time), np.concatenate(self._thetas),
+                np.concatenate(self._velocity))
+
+    def getDataFrame(self) -> pd.DataFrame:
+        """Get all results so far, one row per window.
+
+        Same 'time' and 'velocity' columns as kymFlowFile.analyzeFlowWithRadon().
+        """
+        time, thetas, velocity = self.getResults()
+        df = pd.DataFrame()
+        df['time'] = time
+        df['velocity'] = velocity
+        df['theta'] = thetas
+        df['delx'] = self._delx
+        df['delt'] = self._delt
+        return df
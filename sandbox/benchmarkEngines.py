@@ -0,0 +1,94 @@
+"""
+Time the velocity engines on a kymograph and compare their angles to the Radon.
+
+Correctness is checked in tests/test_kymFlow.py, this only reports speed
+(and accuracy, circular angle difference to mpAnalyzeFlow(engine='radon')).
+The process and thread backends only help on a multi-core machine.
+From the repository folder, after `pip install -e .`:
+
+    python sandbox/benchmarkEngines.py exampleData/fig9im.tif
+"""
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import tifffile
+
+from analyzeflow.kymFlowRadon import mpAnalyzeFlow, kymFlowExecutor, autoChunkSize
+from analyzeflow.kymFlowStructureTensor import structureTensorAnalyzeFlow
+
+def _angleDiff(a, b):
+    """Absolute circular difference of angles (degrees, period 180).
+    """
+    return np.abs(np.mod(a - b + 90, 180) - 90)
+
+def _report(name : str, seconds : float, radonSec : float, thetas=None, radonThetas=None, extra=''):
+    _diff = ''
+    if thetas is not None:
+        diff = _angleDiff(thetas, radonThetas)
+        _diff = (f' diff to radon (deg) median:{np.nanmedian(diff):.2f}'
+                    f' 95th:{np.nanpercentile(diff, 95):.2f}')
+    print(f'  {name:36} {seconds:7.2f} s ({radonSec/seconds:6.1f}x){_diff}{extra}')
+
+if __name__ == '__main__':
+    tifPath = 'exampleData/drew_synthetic.tif'
+    if len(sys.argv) > 1:
+        tifPath = sys.argv[1]
+
+    windowSize = 16
+    tifData = tifffile.imread(tifPath)
+    print(f'{tifPath} {tifData.shape} cpu_count:{os.cpu_count()}')
+
+    startSec = time.time()
+    radonThetas, _, _ = mpAnalyzeFlow(tifData, windowSize, engine='radon', backend='serial')
+    radonSec = time.time() - startSec
+    _report('radon serial', radonSec, radonSec)
+
+    for engine in ['sparse', 'vectorized', 'numba', 'fourier']:
+        mpAnalyzeFlow(tifData[:64], windowSize, engine=engine, backend='serial')  # warm up
+        startSec = time.time()
+        thetas, _, _ = mpAnalyzeFlow(tifData, windowSize, engine=engine, backend='serial')
+        _report(f'{engine} serial', time.time() - startSec, radonSec, thetas, radonThetas)
+
+    for kwargs in [{'angleSearch': 'hierarchical'}, {'tracking': True}, {'refine': 'parabola'},
+                    {'precision': 'float32'}]:
+        startSec = time.time()
+        thetas, _, _ = mpAnalyzeFlow(tifData, windowSize, engine='sparse', backend='serial', **kwargs)
+        _report(f'sparse {kwargs}', time.time() - startSec, radonSec, thetas, radonThetas)
+
+    startSec = time.time()
+    thetas, _ = structureTensorAnalyzeFlow(tifData, windowSize)
+    _report('structureTensor', time.time() - startSec, radonSec, thetas, radonThetas)
+
+    for minCoherence, maxDiff in [(0.3, 5.0), (0.5, 2.0), (0.7, 2.0)]:
+        startSec = time.time()
+        thetas, _, _, info = mpAnalyzeFlow(tifData, windowSize, engine='radon', backend='serial',
+                                            cascade=True, cascadeMinCoherence=minCoherence,
+                                            cascadeMaxDiff=maxDiff, returnInfo=True)
+        _report(f'cascade ({minCoherence}, {maxDiff})', time.time() - startSec, radonSec,
+                    thetas, radonThetas,
+                    f' escalated:{100*info["escalatedFraction"]:.1f}%')
+
+    for backend in ['process', 'thread']:
+        with kymFlowExecutor(backend=backend) as executor:
+            startSec = time.time()
+            mpAnalyzeFlow(tifData, windowSize, engine='radon', executor=executor, backend=backend)
+            _report(f'radon {backend} x{executor.numWorkers}', time.time() - startSec, radonSec)
+
+    # windows per worker task, chunkSize=1 is one task per window and the
+    # default (autoChunkSize()) is about 4 tasks per worker
+    nsteps = tifData.shape[0] // (windowSize//4) - 3
+    with kymFlowExecutor(numWorkers=2) as executor:
+        chunkSizes = [1, 16, autoChunkSize(nsteps, executor.numWorkers)]
+        seconds = []
+        for chunkSize in chunkSizes:
+            startSec = time.time()
+            mpAnalyzeFlow(tifData, windowSize, engine='fourier', executor=executor,
+                            backend='process', chunkSize=chunkSize)
+            seconds.append(time.time() - startSec)
+            _report(f'fourier process x2 chunkSize:{chunkSize}', seconds[-1], radonSec)
+    numTasks = [math.ceil(nsteps / chunkSize) for chunkSize in chunkSizes]
+    overheadMs = 1000 * (seconds[0] - seconds[-1]) / (numTasks[0] - numTasks[-1])
+    print(f'  per task overhead (chunkSize 1 vs {chunkSizes[-1]}): {overheadMs:.2f} ms')
@@ -41,8 +41,13 @@ setup(
 			'PyQt5',
 			'qdarkstyle',
 		],
+        # pip install .[numba] for mpAnalyzeFlow(engine='numba')
+        'numba': [
+            'numba',
+        ],
         'dev': [
 			'jupyter',
+            'pytest',
             'mkdocs',
 			'mkdocs-material',
 			'mkdocs-jupyter',
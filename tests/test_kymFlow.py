@@ -0,0 +1,547 @@
+"""
+Behavioural checks of the velocity analysis, run with `python -m pytest tests`.
+
+Synthetic kymographs (a random texture moving a known number of pixels per
+line) keep each check to a few seconds. The original per window
+radonWorker() is the reference of the Radon engines.
+"""
+import collections
+import functools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.ndimage
+import tifffile
+
+import analyzeflow.kymFlowEngines
+import analyzeflow.kymFlowRadon
+from analyzeflow import kymFlowFile, kymFlowEngine, kymFlowStream, registerEngine
+from analyzeflow.kymFlowRadon import (mpAnalyzeFlow, kymFlowExecutor, radonWorker,
+                                        thetaToVelocity, detectVesselEdges, windowStats,
+                                        _getWindows, _getRadonOperator, _autoCandidates,
+                                        _chooseBackend, _threadParallelFraction)
+from analyzeflow.kymFlowNumba import numbaSpread
+from analyzeflow.kymFlowLspiv import lspivAnalyzeFlow, lspivCorrelation
+from analyzeflow.kymFlowChhatbar import chhatbarAnalyzeFlow, sobelFilter, iterativeRadon
+from analyzeflow.kymFlowStructureTensor import (structureTensorAnalyzeFlow, structureTensorSums,
+                                                structureTensorWindowSums)
+
+windowSize = 16
+delx = 0.5  # um per pixel
+delt = 0.001  # seconds per line
+
+def _streaks(slope : float, nlines : int = 256, npoints : int = 40, noise : float = 0,
+                seed : int = 0) -> np.ndarray:
+    """Smoothed random texture moving slope pixels per line.
+    """
+    rng = np.random.default_rng(seed)
+    texture = scipy.ndimage.gaussian_filter1d(rng.random(20000), 1.5)
+    pos = np.arange(npoints)[None, :] - slope*np.arange(nlines)[:, None] + 10000
+    data = np.interp(pos, np.arange(len(texture)), texture) * 1000
+    if noise > 0:
+        data = data + rng.normal(0, noise, data.shape)
+    return data
+
+def _slope(thetas : np.ndarray) -> float:
+    """Median pixels per line of the window angles.
+    """
+    return float(np.nanmedian(np.tan(np.deg2rad(thetas))))
+
+def _angleDiff(a : np.ndarray, b : np.ndarray) -> np.ndarray:
+    """Absolute circular difference of angles (degrees, period 180).
+    """
+    return np.abs(np.mod(a - b + 90, 180) - 90)
+
+def _radonWorkerThetas(data : np.ndarray, windowsize : int = windowSize):
+    """The original algorithm, radonWorker() on each window.
+    """
+    stepsize = windowsize // 4
+    nsteps = data.shape[0] // stepsize - 3
+    angles = np.arange(180)
+    angles_fine = np.arange(-2, 2+.25, .25)
+    results = [radonWorker(data[k*stepsize:k*stepsize+windowsize], angles, angles_fine)
+                for k in range(nsteps)]
+    return np.array([r[0] for r in results]), np.array([r[1] for r in results])
+
+def _kymFlowFile(tifData : np.ndarray, tifPath : str = 'synthetic.tif') -> kymFlowFile:
+    """A kymFlowFile without an Olympus header.
+    """
+    kff = kymFlowFile.__new__(kymFlowFile)
+    kff._tifPath = tifPath
+    kff._tifData = tifData
+    kff._intensityStats = None
+    kff._ba = None
+    kff._rois = {}
+    kff._df = None
+    kff._header = {'umPerPixel': delx, 'secondsPerLine': delt,
+                    'numLines': tifData.shape[0], 'pixelsPerLine': tifData.shape[1],
+                    'durImage_sec': tifData.shape[0] * delt}
+    return kff
+
+@pytest.fixture(scope='module')
+def streaks():
+    return _streaks(1.5, noise=20)
+
+@pytest.fixture(scope='module')
+def reference(streaks):
+    return _radonWorkerThetas(streaks)
+
+def test_executorSharedAcrossCalls(streaks, reference):
+    with kymFlowExecutor(numWorkers=2) as executor:
+        for _ in range(2):
+            thetas, the_t, spread = mpAnalyzeFlow(streaks, windowSize, executor=executor,
+                                                    backend='process')
+            assert np.array_equal(thetas, reference[0])
+            assert np.allclose(spread, reference[1], rtol=1e-6)
+            assert np.array_equal(the_t, 1 + np.arange(len(thetas))*4 + windowSize/2)
+
+@pytest.mark.parametrize('engine', ['radon', 'sparse', 'vectorized', 'numba'])
+def test_exactEnginesMatchRadonWorker(streaks, reference, engine):
+    thetas, the_t, spread = mpAnalyzeFlow(streaks, windowSize, engine=engine, backend='serial')
+    assert np.array_equal(thetas, reference[0])
+    assert np.allclose(spread, reference[1], rtol=1e-6)
+    assert np.array_equal(the_t, 1 + np.arange(len(thetas))*4 + windowSize/2)
+
+def test_fullSweepOperatorStaysCached(streaks):
+    # per window (fine) angles must not evict the full sweep operator
+    _getRadonOperator.cache_clear()
+    mpAnalyzeFlow(np.tile(streaks, (4, 1)), windowSize, engine='vectorized', backend='serial',
+                    chunkSize=16)
+    cacheInfo = _getRadonOperator.cache_info()
+    assert cacheInfo.misses == 1 and cacheInfo.hits > 0
+
+def test_angleOperatorCacheBounded(streaks, reference, monkeypatch):
+    # per window angles of the fine level use 25 blocks (0.45 MB), room for about 11
+    kymFlowRadon = analyzeflow.kymFlowRadon
+    monkeypatch.setattr(kymFlowRadon, '_angleOperatorCache', collections.OrderedDict())
+    monkeypatch.setattr(kymFlowRadon, '_angleOperatorCacheNbytes', 0)
+    monkeypatch.setattr(kymFlowRadon, 'angleOperatorCacheBytes', 200_000)
+    thetas, _, spread = mpAnalyzeFlow(streaks, windowSize, engine='vectorized', backend='serial')
+    assert np.array_equal(thetas, reference[0])
+    assert np.allclose(spread, reference[1], rtol=1e-6)
+    blocks = kymFlowRadon._angleOperatorCache.values()
+    assert 1 < len(blocks) < 25
+    assert kymFlowRadon._angleOperatorCacheNbytes == sum(kymFlowRadon._operatorNbytes(A)
+                                                            for A in blocks)
+    assert kymFlowRadon._angleOperatorCacheNbytes <= 200_000
+
+def test_fourierEngineCloseToRadonWorker(streaks, reference):
+    thetas, _, _ = mpAnalyzeFlow(streaks, windowSize, engine='fourier', backend='serial')
+    assert np.median(_angleDiff(thetas, reference[0])) < 1
+    assert abs(_slope(thetas) - 1.5) < 0.1
+
+@pytest.mark.parametrize('backend, sharedMemory', [('thread', False), ('process', False),
+                                                    ('process', True), ('auto', False)])
+def test_backendsMatchSerial(streaks, backend, sharedMemory):
+    serial = mpAnalyzeFlow(streaks, windowSize, engine='sparse', backend='serial')
+    result = mpAnalyzeFlow(streaks, windowSize, engine='sparse', backend=backend,
+                            sharedMemory=sharedMemory, chunkSize=7)
+    for _serial, _result in zip(serial, result):
+        assert np.array_equal(_serial, _result)
+
+def _busy(n : int):
+    """Python loop holding the GIL.
+    """
+    for _ in range(n):
+        pass
+
+def test_autoThreadsFromProbe(streaks):
+    # the thread speed up of 2 threads gives the parallel fraction
+    assert _threadParallelFraction([functools.partial(time.sleep, 0.1)] * 2) > 0.8
+    assert _threadParallelFraction([functools.partial(_busy, 2_000_000)] * 2) < 0.6
+    candidates = [('serial', 1, True), ('thread', 4, True), ('process', 3, True)]
+    assert _chooseBackend([(1000, 0.01, 1.0)], candidates) == 'thread'
+    assert _chooseBackend([(1000, 0.01, 0.0)], candidates) == 'process'
+    assert _chooseBackend([(10, 0.01, 1.0)], candidates[:2] + [('process', 3, False)]) == 'thread'
+
+    # 'auto' with a thread executor probes it against serial
+    serial = mpAnalyzeFlow(streaks, windowSize, engine='sparse', backend='serial')
+    with kymFlowExecutor(backend='thread', numWorkers=2) as executor:
+        assert _autoCandidates(executor) == [('serial', 1, False), ('thread', 2, False)]
+        result = mpAnalyzeFlow(streaks, windowSize, engine='sparse', backend='auto',
+                                executor=executor)
+    for _serial, _result in zip(serial, result):
+        assert np.array_equal(_serial, _result)
+
+def test_angleSearchTrackingRefine(streaks, reference):
+    exhaustive = reference[0]
+    for kwargs in [{'angleSearch': 'hierarchical'}, {'tracking': True},
+                    {'refine': 'parabola'}, {'refine': 'gaussian'}]:
+        thetas, _, _, info = mpAnalyzeFlow(streaks, windowSize, engine='sparse',
+                                            backend='serial', returnInfo=True, **kwargs)
+        assert np.median(_angleDiff(thetas, exhaustive)) <= 0.25, kwargs
+        assert info['meanAngles'] < 180 + 17, kwargs
+
+@pytest.mark.parametrize('engine', ['sparse', 'numba'])
+def test_precisionFloat32(streaks, reference, engine):
+    thetas, _, spread = mpAnalyzeFlow(streaks, windowSize, engine=engine, backend='serial',
+                                        precision='float32')
+    assert spread.dtype == np.float32
+    assert np.max(_angleDiff(thetas, reference[0])) <= 0.25
+
+def test_numbaSpreadFloat32(streaks):
+    windows = _getWindows(streaks, windowSize, windowSize//4)[:8]
+    windows = windows - np.mean(windows, axis=(1,2), keepdims=True)
+    spread = numbaSpread(windows, np.arange(180))
+    _spread = numbaSpread(windows.astype(np.float32), np.arange(180))
+    assert spread.dtype == np.float64 and _spread.dtype == np.float32
+    assert np.allclose(_spread, spread, rtol=1e-4)
+
+def test_prescreenSkipsDarkWindows():
+    data = _streaks(1.5, noise=20)
+    data[96:160] = 10 + np.random.default_rng(0).normal(0, 1, (64, data.shape[1]))
+    mean, _ = windowStats(_getWindows(data, windowSize, windowSize//4))
+    thetas, _, spread = mpAnalyzeFlow(data, windowSize, engine='sparse', backend='serial')
+    _thetas, _, _spread, info = mpAnalyzeFlow(data, windowSize, engine='sparse', backend='serial',
+                                                minIntensity=0.5*np.median(mean), returnInfo=True)
+    skipped = info['skipped']
+    assert 0 < info['numSkipped'] < len(thetas)
+    assert np.all(np.isnan(_thetas[skipped]))
+    assert np.array_equal(_thetas[~skipped], thetas[~skipped])
+    assert np.array_equal(_spread[~skipped], spread[~skipped])
+
+def test_windowSizesAndRoisMatchSeparateCalls(streaks):
+    windowSizes = [16, 32]
+    results = mpAnalyzeFlow(streaks, windowSizes, engine='fourier', backend='serial')
+    for _windowSize in windowSizes:
+        separate = mpAnalyzeFlow(streaks, _windowSize, engine='fourier', backend='serial')
+        for _separate, _multi in zip(separate, results[_windowSize]):
+            assert np.array_equal(_separate, _multi)
+
+    rois = {'left': (0, 20), 'right': (20, None)}
+    results = mpAnalyzeFlow(streaks, windowSize, rois=rois, engine='fourier', backend='process',
+                            sharedMemory=True)
+    for roiName, (startPixel, stopPixel) in rois.items():
+        separate = mpAnalyzeFlow(streaks, windowSize, startPixel, stopPixel,
+                                    engine='fourier', backend='serial')
+        for _separate, _roi in zip(separate, results[roiName]):
+            assert np.array_equal(_separate, _roi)
+
+@pytest.mark.parametrize('backend', ['serial', 'process'])
+def test_memmapSameAsInMemory(tmp_path, backend):
+    data = _streaks(2, nlines=1200).astype(np.uint16)
+    tifPath = os.path.join(tmp_path, 'kym.tif')
+    tifffile.imwrite(tifPath, data)
+    inMemory = mpAnalyzeFlow(tifffile.imread(tifPath), windowSize, engine='fourier',
+                                backend=backend)
+    memmap = mpAnalyzeFlow(tifffile.memmap(tifPath, mode='r'), windowSize, engine='fourier',
+                                backend=backend, chunkSize=64)
+    for _inMemory, _memmap in zip(inMemory, memmap):
+        assert np.array_equal(_inMemory, _memmap)
+
+@pytest.mark.parametrize('engine', ['radon', 'fourier'])
+def test_streamSameAsMpAnalyzeFlow(streaks, engine):
+    thetas, the_t, _ = mpAnalyzeFlow(streaks, windowSize, engine=engine, backend='serial')
+    stream = kymFlowStream(delx, delt, windowsize=windowSize, engine=engine)
+    rng = np.random.default_rng(0)
+    _start = 0
+    while _start < streaks.shape[0]:
+        _stop = _start + rng.integers(1, 50)
+        stream.addLines(streaks[_start:_stop])
+        _start = _stop
+    streamTime, streamThetas, streamVelocity = stream.getResults()
+    assert np.array_equal(streamThetas, thetas)
+    assert np.array_equal(streamTime, the_t * delt)
+    assert np.array_equal(streamVelocity, thetaToVelocity(thetas, delx, delt), equal_nan=True)
+
+def test_detectVesselEdges():
+    vessel = _streaks(1.5)
+    left, right = 30, 30
+    rng = np.random.default_rng(0)
+    background = np.median(vessel) * 0.05
+    data = rng.normal(background, background*0.1, (vessel.shape[0], left + vessel.shape[1] + right))
+    data[:, left:left+vessel.shape[1]] = vessel
+    startPixel, stopPixel = detectVesselEdges(data)
+    assert left - 3 <= startPixel <= left
+    assert left + vessel.shape[1] <= stopPixel <= left + vessel.shape[1] + 3
+
+def test_lspivAveragesSameAsLoop():
+    numavgs, skipamt, shiftamt = 100, 25, 1
+    data = _streaks(2, nlines=1000, noise=20)
+    LSPIVresult = lspivCorrelation(data, shiftamt)
+    velocity, the_t, xcorr = lspivAnalyzeFlow(data, numavgs, skipamt, shiftamt)
+    for k, index in enumerate(range(skipamt, skipamt*11, skipamt)):
+        _sum = np.sum(LSPIVresult[index-1:index+numavgs], axis=0)  # bKim.m, 1 based, inclusive
+        assert np.allclose(np.fft.fftshift(_sum) / np.max(_sum), xcorr[k])
+        # center of lines index .. index+numavgs+shiftamt, as the_t of mpAnalyzeFlow()
+        assert the_t[k] == index + (numavgs + shiftamt + 1) / 2
+
+def test_lspivTimeAlignedWithRadon():
+    # speed steps from 1 to 3 pixels/line at line 1000
+    data = np.concatenate([_streaks(1, nlines=1000, npoints=64, noise=20),
+                            _streaks(3, nlines=1000, npoints=64, noise=20, seed=1)])
+    velocity, the_t, _ = lspivAnalyzeFlow(data, 100, 25, 1)
+    thetas, radon_t, _ = mpAnalyzeFlow(data, 100, engine='fourier', backend='serial')
+    radon = np.tan(np.deg2rad(thetas))
+    def _stepLine(v, t):
+        # line where v first crosses the midpoint of the step
+        k = np.flatnonzero(v > 2)[0]
+        return np.interp(2, v[k-1:k+1], t[k-1:k+1])
+    # a 100 line window is 25 lines apart, the Radon of a window across the step
+    # is the angle of the dominant speed (not the mean)
+    assert abs(_stepLine(velocity, the_t) - 1000) < 5
+    assert abs(_stepLine(radon, radon_t) - 1000) < 15
+
+@pytest.mark.parametrize('slope', [0.5, 2, -2, 5])
+def test_lspivSlope(slope):
+    data = _streaks(slope, nlines=1000, npoints=64, noise=20)
+    velocity, _, _ = lspivAnalyzeFlow(data, 100, 25, 1)
+    assert abs(np.nanmedian(velocity) - slope) < 0.1
+
+@pytest.mark.parametrize('slope', [0.3, 2, -1.5])
+def test_chhatbarSlope(slope):
+    thetas, _ = chhatbarAnalyzeFlow(_streaks(slope, nlines=400, npoints=80), 100, 25,
+                                    backend='serial')
+    assert abs(_slope(thetas) - slope) < 0.05 * max(1, abs(slope))
+
+def test_chhatbarBatchedSameAsOneAtATime():
+    data = _streaks(1.5, nlines=400, noise=20)
+    hi, lineskip = 100, 25
+    thetas, the_t = chhatbarAnalyzeFlow(data, hi, lineskip, delx=delx, backend='serial')
+    filtered = sobelFilter(data)
+    oneAtATime = np.array([iterativeRadon(filtered[None, k*lineskip:k*lineskip+hi], delx)['angle'][0]
+                            for k in range(len(thetas))])
+    assert np.array_equal(oneAtATime, thetas, equal_nan=True)
+    for backend in ['thread', 'process']:
+        _thetas, _the_t = chhatbarAnalyzeFlow(data, hi, lineskip, delx=delx,
+                                                backend=backend, chunkSize=3)
+        assert np.array_equal(_thetas, thetas, equal_nan=True)
+        assert np.array_equal(_the_t, the_t)
+
+@pytest.mark.parametrize('slope', [0.3, 1, 2, -1.5])
+def test_structureTensorSlope(slope):
+    thetas, the_t, info = structureTensorAnalyzeFlow(_streaks(slope), windowSize, returnInfo=True)
+    assert abs(_slope(thetas) - slope) < 0.05 * max(1, abs(slope))
+    assert np.median(info['coherence']) > 0.8
+    assert np.array_equal(the_t, 1 + np.arange(len(thetas))*4 + windowSize/2)
+
+def test_structureTensorChunksSameAsWhole(streaks):
+    data = _streaks(2, noise=50)
+    nsteps = len(data)//4 - 3
+    whole = structureTensorSums(data, windowSize, 4, nsteps)
+    background = np.mean(data, axis=0)
+    chunks = [structureTensorWindowSums(data, windowSize, 4, kStart, min(kStart+7, nsteps),
+                                            background=background)
+                for kStart in range(0, nsteps, 7)]
+    for _whole, _chunks in zip(whole, zip(*chunks)):
+        assert np.array_equal(_whole, np.concatenate(_chunks))
+
+def test_cascadeMemmapSameAsInMemory(tmp_path):
+    data = _streaks(2, nlines=1200, noise=200).astype(np.uint16)
+    tifPath = os.path.join(tmp_path, 'kym.tif')
+    tifffile.imwrite(tifPath, data)
+    inMemory = mpAnalyzeFlow(tifffile.imread(tifPath), windowSize, engine='sparse',
+                                backend='serial', cascade=True, returnInfo=True)
+    memmap = mpAnalyzeFlow(tifffile.memmap(tifPath, mode='r'), windowSize, engine='sparse',
+                                backend='serial', cascade=True, chunkSize=64, returnInfo=True)
+    assert np.array_equal(inMemory[3]['escalated'], memmap[3]['escalated'])
+    assert np.allclose(inMemory[0], memmap[0], equal_nan=True)
+    assert np.allclose(inMemory[3]['coherence'], memmap[3]['coherence'])
+
+def test_cascade(streaks, reference):
+    data = streaks.copy()
+    data[100:140] = _streaks(-3, nlines=40, noise=200, seed=1)  # a few bad windows
+    radonThetas, _ = _radonWorkerThetas(data)
+    thetas, _, spread, info = mpAnalyzeFlow(data, windowSize, engine='sparse', backend='serial',
+                                            cascade=True, returnInfo=True)
+    escalated = info['escalated']
+    assert 0 < info['numEscalated'] < len(thetas)
+    assert info['escalatedFraction'] == info['numEscalated'] / len(thetas)
+    assert np.array_equal(thetas[escalated], radonThetas[escalated])
+    assert np.all(info['nAngles'][~escalated] == 0)
+    assert np.all(np.isnan(spread[~escalated]))
+    assert np.median(_angleDiff(thetas, radonThetas)) < 1
+
+    for backend in ['thread', 'process']:
+        result = mpAnalyzeFlow(data, windowSize, engine='sparse', backend=backend,
+                                cascade=True, chunkSize=5, returnInfo=True)
+        assert np.array_equal(result[0], thetas, equal_nan=True)
+        assert np.array_equal(result[2], spread, equal_nan=True)
+        assert np.array_equal(result[3]['escalated'], escalated)
+
+    # dark windows are skipped, not escalated
+    data[:64] = 10
+    thetas, _, _, info = mpAnalyzeFlow(data, windowSize, engine='sparse', backend='serial',
+                                        cascade=True, minIntensity=100, returnInfo=True)
+    assert info['numSkipped'] > 0
+    assert not np.any(info['escalated'] & info['skipped'])
+    assert np.all(np.isnan(thetas[info['skipped']]))
+
+class _zeroEngine(kymFlowEngine):
+    """Toy engine, 0 velocity every skip lines.
+    """
+    name = 'zero'
+    params = {'skip': 50}
+    windowSizeParam = 'skip'
+    fast = True
+
+    def numWindows(self, shape, skip=50, **params):
+        return shape[0] // skip
+
+    def estimate(self, data, delx, delt, rois, executor=None, **params):
+        params = self.getParams(**params)
+        dfList = []
+        for roiName, (startPixel, stopPixel) in rois.items():
+            df = pd.DataFrame()
+            df['time'] = np.arange(self.numWindows(data.shape, **params)) * params['skip'] * delt
+            df['velocity'] = 0.0
+            df['windowSize'] = params['skip']
+            df['roi'] = roiName
+            df['startPixel'] = startPixel
+            df['stopPixel'] = stopPixel
+            dfList.append(df)
+        return pd.concat(dfList, ignore_index=True)
+
+def _entryPointPackage(folder : str):
+    """An installed package 'myengines' with one engine in the entry point group.
+    """
+    with open(os.path.join(folder, 'myengines.py'), 'w') as f:
+        f.write('import pandas as pd\n'
+                'from analyzeflow import kymFlowEngine\n'
+                'class myEngine(kymFlowEngine):\n'
+                '    name = "myEngine"\n'
+                '    params = {"windowSize": 64}\n'
+                '    windowSizeParam = "windowSize"\n'
+                '    def numWindows(self, shape, windowSize=64, **params):\n'
+                '        return shape[0] // windowSize\n'
+                '    def estimate(self, data, delx, delt, rois, executor=None, **params):\n'
+                '        params = self.getParams(**params)\n'
+                '        n = self.numWindows(data.shape, **params)\n'
+                '        (roiName, (startPixel, stopPixel)), = rois.items()\n'
+                '        return pd.DataFrame({"time": [i * params["windowSize"] * delt for i in range(n)],\n'
+                '                "velocity": 1.0, "windowSize": params["windowSize"], "roi": roiName,\n'
+                '                "startPixel": startPixel, "stopPixel": stopPixel})\n')
+    distInfo = os.path.join(folder, 'myengines-0.1.dist-info')
+    os.makedirs(distInfo)
+    with open(os.path.join(distInfo, 'METADATA'), 'w') as f:
+        f.write('Metadata-Version: 2.1\nName: myengines\nVersion: 0.1\n')
+    with open(os.path.join(distInfo, 'entry_points.txt'), 'w') as f:
+        f.write(f'[{analyzeflow.kymFlowEngines.entryPointGroup}]\nmyEngine = myengines:myEngine\n')
+
+def test_engineRegistry(tmp_path, monkeypatch):
+    monkeypatch.setattr(analyzeflow.kymFlowEngines, 'velocityEngines',
+                        dict(analyzeflow.kymFlowEngines.velocityEngines))
+    monkeypatch.setattr(analyzeflow.kymFlowEngines, '_entryPointsLoaded', False)
+    _entryPointPackage(str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    registerEngine(_zeroEngine)
+    with pytest.raises(ValueError):
+        registerEngine(_zeroEngine)
+
+    names = analyzeflow.kymFlowEngines.getEngineNames()
+    assert names == ['mpRadon', 'lspiv', 'chhatbar', 'structureTensor', 'zero', 'myEngine']
+
+    tifData = _streaks(1.5, nlines=600, noise=20)
+    kff = _kymFlowFile(tifData)
+    params = {'mpRadon': {'radonEngine': 'fourier'}}
+    for name in names:
+        kff.analyzeFlow(name, **params.get(name, {}))
+    assert kff.getAlgorithms() == names
+    for name in names:
+        hint = analyzeflow.kymFlowEngines.getEngine(name).costHint(tifData.shape)
+        assert len(kff._getRows(algorithm=name)) == hint['numWindows'], name
+
+    # analyzeFlow('mpRadon') is mpAnalyzeFlow()
+    thetas, the_t, _ = mpAnalyzeFlow(tifData, windowSize, engine='fourier')
+    assert np.array_equal(kff.getVelocity(absValue=False), thetaToVelocity(thetas, delx, delt),
+                            equal_nan=True)
+    assert np.array_equal(kff.getTime(), the_t * delt)
+
+    # params are checked
+    with pytest.raises(ValueError):
+        kff.analyzeFlow('lspiv', windowSize=16)
+
+def _legacyAnalysis(kff : kymFlowFile) -> pd.DataFrame:
+    """Rows of an older analysis, mpRadon with one roi and window size (no 'roi'/'windowSize').
+    """
+    thetas, the_t, _ = mpAnalyzeFlow(kff.tifData, 32, engine='fourier', backend='serial')
+    df = pd.DataFrame()
+    df['time'] = the_t * delt
+    df['velocity'] = thetaToVelocity(thetas, delx, delt)
+    df['parentFolder'] = 'data'
+    df['file'] = kff.getFileName()
+    df['algorithm'] = 'mpRadon'
+    df['delx'] = delx
+    df['delt'] = delt
+    df['numLines'] = kff.numLines()
+    df['pntsPerLine'] = kff.pntsPerLine()
+    df['cleanVelocity'] = df['velocity']
+    df['absVelocity'] = np.abs(df['velocity'])
+    return df
+
+def test_legacyAnalysisThenSecondEngine(tmp_path):
+    folder = os.path.join(tmp_path, 'data')
+    os.makedirs(folder)
+    tifData = _streaks(1.5, nlines=600, noise=20)
+    kff = _kymFlowFile(tifData, os.path.join(folder, 'kym.tif'))
+    kff._df = _legacyAnalysis(kff)
+    kff.saveAnalysis()
+    legacyVelocity = kff.getVelocity(absValue=False)
+
+    kff = _kymFlowFile(tifData, os.path.join(folder, 'kym.tif'))
+    kff.loadAnalysis()
+    assert 'roi' not in kff._df.columns
+    kff.analyzeFlowWithLspiv(shiftamt=1)
+    for _kff in [kff, None]:
+        if _kff is None:
+            # saved and loaded again, 'roi' and 'windowSize' are filled
+            # (without a header saveAnalysis() appends)
+            os.remove(os.path.join(folder, 'data-analysis', 'kym.csv'))
+            kff.saveAnalysis()
+            _kff = _kymFlowFile(tifData, os.path.join(folder, 'kym.tif'))
+            _kff.loadAnalysis()
+        assert _kff.getAlgorithms() == ['mpRadon', 'lspiv']
+        assert _kff.getRoiNames() == ['default']
+        assert _kff.getWindowSizes() == [32]
+        assert np.array_equal(_kff.getVelocity(absValue=False), legacyVelocity, equal_nan=True)
+        for algorithm in _kff.getAlgorithms():
+            assert np.isfinite(_kff.getReport(algorithm=algorithm)['meanVel'])
+
+def test_nSkippedWithLspivRows(tmp_path):
+    folder = os.path.join(tmp_path, 'data')
+    os.makedirs(folder)
+    tifData = _streaks(1.5, nlines=600, noise=20)
+    tifData[200:300] = 10
+    kff = _kymFlowFile(tifData, os.path.join(folder, 'kym.tif'))
+    kff.analyzeFlowWithRadon(windowSize, engine='fourier', minIntensity=100)
+    nSkipped = kff.getReport()['nSkipped']
+    assert nSkipped > 0
+    kff.analyzeFlowWithLspiv(shiftamt=1)
+    for _kff in [kff, None]:
+        if _kff is None:
+            # the 'skipped' column of radon and lspiv rows is object after load
+            kff.saveAnalysis()
+            _kff = _kymFlowFile(tifData, os.path.join(folder, 'kym.tif'))
+            _kff.loadAnalysis()
+        assert _kff.getReport()['nSkipped'] == nSkipped
+        assert _kff.getReport(algorithm='lspiv')['nSkipped'] == 0
+
+def test_loadAnalysisRoisWithoutBounds(tmp_path):
+    folder = os.path.join(tmp_path, 'data')
+    os.makedirs(folder)
+    tifData = _streaks(1.5, nlines=600, noise=20)
+    tifPath = os.path.join(folder, 'kym.tif')
+    kff = _kymFlowFile(tifData, tifPath)
+    kff.addRoi('left', 0, 20)
+    kff.analyzeFlow('mpRadon', radonEngine='fourier')
+    # rows of a third-party engine with a nan and a missing roi span
+    for startPixel in [np.nan, None]:
+        kff._df = pd.concat([kff._df, pd.DataFrame({'time': [0.0], 'velocity': [1.0],
+                                'windowSize': [64], 'algorithm': ['other'], 'roi': ['vessel'],
+                                'startPixel': [startPixel], 'stopPixel': [startPixel]})],
+                            ignore_index=True)
+        kff.saveAnalysis()
+        _kff = _kymFlowFile(tifData, tifPath)
+        _kff.loadAnalysis()
+        assert _kff.getRois() == {'left': (0, 20)}
+        assert _kff.getAlgorithms() == ['mpRadon', 'other']
+        os.remove(os.path.join(folder, 'data-analysis', 'kym.csv'))
+        kff._df = kff._df[kff._df['algorithm'] == 'mpRadon']
+    kff._df = kff._df.drop(columns=['startPixel', 'stopPixel'])
+    kff.saveAnalysis()
+    _kff = _kymFlowFile(tifData, tifPath)
+    _kff.loadAnalysis()
+    assert _kff.getRois() == {}